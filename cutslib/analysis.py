@@ -282,8 +282,8 @@ def preselect_dets(corrmat, preselector):
 
 def analyze_calibration(tod, cutparams, cuts=None, write=False, **kwargs):
     import moby2
-    from moby2 import products
     from moby2 import TODCuts
+    from cutslib.calibration import get_flatfield, get_responsivity
     # load parameters
     params = moby2.util.MobyDict.from_file(cutparams)
     cutParams = moby2.util.MobyDict.from_file(cutparams.replace('cutp','cutP'))
@@ -294,9 +294,9 @@ def analyze_calibration(tod, cutparams, cuts=None, write=False, **kwargs):
     name = tod.info.name
     # get calibration
     flatfield = pathop["calibration"]["flatfield"]
-    resp = products.get_calibration(pathop["calibration"]["config"], tod.info)
-    resp_sel = (resp.cal != 0.0)
-    flatfield_object = moby2.detectors.RelCal.from_dict(flatfield)
+    resp = get_responsivity(pathop["calibration"]["config"], tod.info)
+    resp_sel = (resp != 0.0)
+    flatfield_object = get_flatfield(flatfield)
     dets = tod.info.array_data['det_uid']
     _, ff = flatfield_object.get_property('cal', det_uid=dets, default=1.)
     _, stable = flatfield_object.get_property('stable', det_uid=dets, default=False)
@@ -318,7 +318,7 @@ def analyze_calibration(tod, cutparams, cuts=None, write=False, **kwargs):
             sf = np.ones(pa.dets.size,dtype=bool)
         else:
             sf = tod.info.array_data['nom_freq'] == freq
-        calib[sf] = resp.cal[sf]*ff[sf]
+        calib[sf] = resp[sf]*ff[sf]
     calib *= tod.info.array_data["optical_sign"]
 
     # Store results
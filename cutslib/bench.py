@@ -0,0 +1,477 @@
+"""Benchmarks of the hot paths of the cuts pipeline on synthetic TODs.
+
+The synthetic TODs mimic what the pathology analysis sees in a real
+observation: a detector array scanning in azimuth, an atmospheric common
+mode plus a scan synchronous signal in the live detectors, a thermal mode
+in the dark detectors, dead (zero or very noisy) detectors, glitches and
+jumps. They are made from random numbers only, so the benchmarks need no
+depot, calibration or tod files and run offline on any machine.
+
+Example:
+    from cutslib import bench
+    tod = bench.make_tod(ndet=500, nsamps=2**16)
+    res = bench.run_stages(tod)
+    bench.print_results(res)
+    res = bench.scaling('ndet', [250, 500, 1000], nsamps=2**16)
+
+or through the recipe: cuts bench run 500 65536
+
+"""
+
+import time, gc
+import numpy as np
+
+from cutslib import fft
+from cutslib.tools import nextregular, get_time_domain_modes
+
+
+class ArrayData(dict):
+    """A minimal replacement of the moby2 array data with the fields used
+    by the pathology and correlation code"""
+    def get_property(self, props, det_uid=None):
+        if det_uid is None: det_uid = self['det_uid']
+        if isinstance(props, str): return self[props][det_uid]
+        return [self[p][det_uid] for p in props]
+
+
+class TODInfo:
+    def __init__(self, name, array_data, sample_index=0, downsample_level=1):
+        self.name = name
+        self.array_data = array_data
+        self.det_uid = array_data['det_uid'].copy()
+        self.sample_index = sample_index
+        self.downsample_level = downsample_level
+
+
+class SyntheticTOD:
+    """TOD-like object with the attributes used by the cuts pipeline. The
+    truth of the simulation is kept in the attributes live, dark, dead,
+    glitches (det, sample) and jumps (det, sample)"""
+    def __init__(self, data, ctime, az, info):
+        self.data = data
+        self.ctime = ctime
+        self.az = az
+        self.info = info
+        self.det_uid = info.det_uid
+        self.nsamps = data.shape[1]
+        self.ndata = self.nsamps
+        self.rows = info.array_data['row']
+        self.cols = info.array_data['col']
+        self.abuses = []
+        self.cuts = None
+
+    def copy(self):
+        tod = SyntheticTOD(self.data.copy(), self.ctime, self.az, self.info)
+        for k in ['live', 'dark', 'dead', 'glitches', 'jumps']:
+            if hasattr(self, k): setattr(tod, k, getattr(self, k))
+        return tod
+
+    def listUncut(self):
+        dets = np.where(self.live)[0]
+        return list(dets), list(self.rows[dets]), list(self.cols[dets])
+
+
+def make_tod(ndet=1000, nsamps=2**17, srate=400., ncols=32, scan_freq=0.1,
+             scan_amp=5., dark_frac=0.05, dead_frac=0.05, glitch_rate=0.05,
+             njumps=5, white=1., atm=30., knee=1., seed=0, dtype='float32'):
+    """Make a synthetic TOD.
+
+    Parameters
+    ----------
+    ndet: number of detectors
+    nsamps: number of samples
+    srate: sampling rate in Hz
+    ncols: number of columns of the array layout
+    scan_freq: azimuth scan frequency in Hz
+    scan_amp: azimuth scan half amplitude in deg
+    dark_frac, dead_frac: fraction of dark and dead detectors
+    glitch_rate: number of glitches per detector per second
+    njumps: number of detectors with a jump
+    white: white noise rms of the detectors
+    atm: rms of the atmospheric common mode
+    knee: 1/f knee of the atmosphere in Hz
+    seed: random seed
+    dtype: data type of the tod data
+
+    Returns
+    -------
+    SyntheticTOD
+
+    """
+    rng = np.random.RandomState(seed)
+    dt = 1./srate
+    t = np.arange(nsamps)*dt
+    ctime = 1.5e9 + t
+    # triangle scan with a smooth turnaround of 1s
+    phase = (t*scan_freq) % 1
+    tri = 4*np.abs(phase-0.5)-1
+    nsm = int(srate)
+    az = np.convolve(np.r_[np.full(nsm, tri[0]), tri, np.full(nsm, tri[-1])],
+                     np.ones(nsm)/nsm, mode='same')[nsm:-nsm]
+    az = np.deg2rad(180. + scan_amp*az)
+    # array layout and detector types
+    det_uid = np.arange(ndet)
+    rows, cols = det_uid // ncols, det_uid % ncols
+    kind = rng.permutation(ndet)
+    dark = np.zeros(ndet, dtype=bool); dead = np.zeros(ndet, dtype=bool)
+    ndark, ndead = int(dark_frac*ndet), int(dead_frac*ndet)
+    dark[kind[:ndark]] = True
+    dead[kind[ndark:ndark+ndead]] = True
+    live = ~dark * ~dead
+    nom_freq = np.where(cols < ncols//2, 90., 150.)
+    nom_freq[dark] = 0.
+    array_data = ArrayData(det_uid=det_uid, row=rows, col=cols,
+                           nom_freq=nom_freq)
+    info = TODInfo("%d.%d.ar0" % (ctime[0], ctime[-1]), array_data)
+    # atmosphere: white noise shaped by a 1/f^(4/3) spectrum above knee
+    f = np.fft.rfftfreq(nsamps, dt)
+    shape = np.zeros_like(f)
+    shape[1:] = (1 + (knee/f[1:])**(4./3)) ** 0.5
+    fatm = (rng.normal(size=f.size) + 1j*rng.normal(size=f.size)) * shape
+    atmo = np.fft.irfft(fatm, nsamps)
+    atmo *= atm/atmo.std()
+    # thermal drift seen by the dark detectors
+    therm = np.cumsum(rng.normal(size=nsamps))
+    therm *= 5*white/therm.std()
+    # scan synchronous pickup
+    sync = 0.5*atm*np.sin(2*np.pi*(az-az.mean())/np.deg2rad(2*scan_amp))
+    # fill the detectors one at a time to keep the memory in check
+    data = np.empty((ndet, nsamps), dtype=dtype)
+    gain = 1 + 0.1*rng.normal(size=ndet)
+    for d in range(ndet):
+        x = white*rng.normal(size=nsamps)
+        if live[d]: x += gain[d]*(atmo + sync) + 0.2*therm
+        elif dark[d]: x += gain[d]*therm
+        data[d] = x
+    # dead detectors: half of them are zero and half are very noisy
+    deads = np.where(dead)[0]
+    data[deads[::2]] = 0
+    data[deads[1::2]] *= 1e3
+    # glitches: a few samples long spikes of 20-200 white noise rms
+    nglitch = rng.poisson(glitch_rate*ndet*nsamps*dt)
+    gdet = rng.randint(ndet, size=nglitch)
+    gsamp = rng.randint(nsamps-5, size=nglitch)
+    amp = white*rng.uniform(20, 200, size=nglitch)
+    for i, w in enumerate([1., .5, .25]):
+        data[gdet, gsamp+i] += w*amp
+    # jumps: steps of 50 white noise rms
+    jdet = rng.choice(np.where(live)[0], size=min(njumps, live.sum()),
+                      replace=False)
+    jsamp = rng.randint(nsamps//10, 9*nsamps//10, size=len(jdet))
+    for d, s in zip(jdet, jsamp): data[d, s:] += 50*white
+    tod = SyntheticTOD(data, ctime, az, info)
+    tod.live, tod.dark, tod.dead = live, dark, dead
+    tod.glitches = (gdet, gsamp)
+    tod.jumps = (jdet, jsamp)
+    return tod
+
+
+def default_params():
+    """Pathology parameters of the stages, following the cutParams template"""
+    presel_dark = {'method': 'median', 'Nmin': 2, 'minSel': 2, 'initCorr': 0.9}
+    presel_live = {'method': 'median', 'Nmin': 10, 'initCorr': 0.98,
+                   'minCorr': 0.90, 'groupCorr': 0.93, 'normLimit': 1e9}
+    frange = {'fmin': 0.017, 'fshift': 0.009, 'band': 0.071}
+    return {
+        'DEModes': 3, 'MFEModes': 8, 'HFLiveModes': 10, 'HFDarkModes': 3,
+        'driftFilter': 0.036, 'midFreqFilter': [0.3, 1.0],
+        'highFreqFilter': [9.0, 19.0], 'getPartial': True,
+        'darkModesParams': {'useDarks': False, 'useSVD': True, 'Nmodes': 1,
+                            'useTherm': False},
+        'darkCorrPar': {'presel': presel_dark, 'useTaper': False,
+                        'cancelSync': False, 'doubleMode': True,
+                        'freqRange': dict(frange, Nwin=1)},
+        'liveCorrPar': {'presel': presel_live, 'useTaper': False,
+                        'cancelSync': True, 'doubleMode': False,
+                        'removeDark': False,
+                        'freqRange': dict(frange, Nwin=10)},
+    }
+
+
+def _stages(tod, par):
+    """Generate (name, func) of the benchmarked stages, in the order of
+    Pathologies.findPathologies followed by the correlation objects and
+    the cuts algebra of recoverScanCuts. The stages share a state dict
+    so that each one gets the inputs it sees in the pipeline."""
+    from cutslib import pathologies as pa
+    from cutslib import correlations as co
+    from cutslib.glitch import CutsRanges
+    st = {}
+    live, dark = tod.live, tod.dark
+    dt = (tod.ctime[-1]-tod.ctime[0])/(tod.nsamps-1)
+    def scan():
+        st['scan'] = pa.analyzeScan(np.unwrap(tod.az), dt)
+    def stats():
+        zero = ~tod.data[:,::100].any(axis=1)
+        st['live'] = live * ~zero * (np.std(tod.data, axis=1) < 1e8)
+    def rfft():
+        st['nf'] = nextregular(tod.nsamps)
+        st['fdata'] = fft.tod_rfft(tod.data, st['nf'])
+        st['df'] = 1./(dt*st['nf'])
+    def dark_corr():
+        st['dark'] = pa.multiFreqCorrAnal(st['fdata'], dark, st['df'], st['nf'],
+            tod.nsamps, st['scan']['scan_freq'], par, "darkCorrPar")
+    def live_corr():
+        st['res'] = pa.multiFreqCorrAnal(st['fdata'], st['live'], st['df'],
+            st['nf'], tod.nsamps, st['scan']['scan_freq'], par, "liveCorrPar")
+    def drift():
+        n_h = nextregular(int(round(par['driftFilter']/st['df']))) + 1
+        fcm = st['fdata'][st['res']['preSel'],1:n_h].mean(axis=0)
+        get_time_domain_modes(fcm, 1, tod.nsamps, st['df'])
+        pa.highFreqAnal(st['fdata'], st['live'], [1,n_h], tod.nsamps,
+                        nmodes=par["DEModes"], preSel=st['res']['preSel'])
+    def mid_freq():
+        n_l = int(round(par["midFreqFilter"][0]/st['df']))
+        n_h = int(round(par["midFreqFilter"][1]/st['df']))
+        pa.highFreqAnal(st['fdata'], st['live'], [n_l,n_h], tod.nsamps,
+                        nmodes=par["MFEModes"], preSel=st['res']['preSel'])
+    def high_freq():
+        n_l = int(round(par["highFreqFilter"][0]/st['df']))
+        n_h = int(round(par["highFreqFilter"][1]/st['df']))
+        n_h = nextregular(n_h-n_l) + n_l
+        pa.highFreqAnal(st['fdata'], st['live'], [n_l,n_h], tod.nsamps,
+                        nmodes=par["HFLiveModes"], highOrder=True,
+                        scanParams=st['scan'] if par['getPartial'] else None)
+        pa.highFreqAnal(st['fdata'], dark, [n_l,n_h], tod.nsamps,
+                        nmodes=par["HFDarkModes"])
+    def find_correlation():
+        st['corr'] = co.liveCorrObj(tod, dets=np.where(live)[0])
+        st['corr'].findCorrelation(nmin=0)
+    def gauss_cm():
+        st['corr'].removeGaussCM()
+    def cuts():
+        # glitch cuts buffered by 10 samples and a partial cut on the
+        # first scan of every live detector, as combined in recoverScanCuts
+        gdet, gsamp = tod.glitches
+        g = CutsRanges(gdet, np.maximum(gsamp-10, 0),
+                       np.minimum(gsamp+13, tod.nsamps), len(live), tod.nsamps)
+        dets = np.where(live)[0]
+        p = CutsRanges(dets, np.zeros_like(dets), np.full_like(dets, 1000),
+                       len(live), tod.nsamps)
+        c = (g | p).normalize()
+        c.fraction(); c.det_count()
+    stages = [('analyzeScan', scan), ('fullRMS', stats), ('tod_rfft', rfft),
+              ('darkCorrAnal', dark_corr), ('liveCorrAnal', live_corr),
+              ('driftError', drift), ('midFreqAnal', mid_freq),
+              ('highFreqAnal', high_freq),
+              ('findCorrelation', find_correlation),
+              ('removeGaussCM', gauss_cm), ('scanCuts', cuts)]
+    return stages
+
+
+def run_stages(tod, par=None, stages=None, repeat=1):
+    """Time the pipeline stages on a tod.
+
+    Parameters
+    ----------
+    tod: SyntheticTOD (see make_tod)
+    par: findPathoParams-like parameters (default: default_params())
+    stages: names of the stages to report (default: all)
+    repeat: number of times to run the stages, the best time is kept
+
+    Returns
+    -------
+    dict of stage name -> wall time in seconds
+
+    """
+    if par is None: par = default_params()
+    res = {}
+    for _ in range(repeat):
+        # the stages modify the tod (e.g. removeGaussCM)
+        t = tod.copy()
+        for name, func in _stages(t, par):
+            gc.collect()
+            tic = time.perf_counter()
+            func()
+            toc = time.perf_counter() - tic
+            if stages is None or name in stages:
+                res[name] = min(res.get(name, np.inf), toc)
+        del t
+    return res
+
+
+def scaling(key, values, stages=None, repeat=1, verbose=True, **kwargs):
+    """Time the stages for a range of values of a make_tod parameter.
+
+    Parameters
+    ----------
+    key: make_tod parameter to vary (e.g. 'ndet' or 'nsamps')
+    values: list of values of the parameter
+    stages: names of the stages to report (default: all)
+    repeat: number of repetitions of each run, the best time is kept
+    kwargs: other make_tod parameters
+
+    Returns
+    -------
+    dict of stage name -> array of wall times (one per value), and the
+    power law index of the time with the parameter under 'slope'
+
+    """
+    times = []
+    for v in values:
+        tod = make_tod(**dict(kwargs, **{key: v}))
+        times.append(run_stages(tod, stages=stages, repeat=repeat))
+        if verbose:
+            print("%s = %d: %.2f s" % (key, v, sum(times[-1].values())))
+        del tod
+    res = {k: np.array([t[k] for t in times]) for k in times[0]}
+    x = np.log(np.asarray(values, dtype=float))
+    res['slope'] = {k: np.polyfit(x, np.log(np.maximum(t, 1e-9)), 1)[0]
+                    if len(values) > 1 else np.nan for k, t in res.items()}
+    return res
+
+
+def _statistics(tod, par, dtype):
+    """The live detector statistics of Pathologies.findPathologies
+    computed from fourier coefficients of the given precision"""
+    from cutslib import pathologies as pa
+    dt = (tod.ctime[-1]-tod.ctime[0])/(tod.nsamps-1)
+    scan = pa.analyzeScan(np.unwrap(tod.az), dt)
+    live = tod.live * tod.data[:,::100].any(axis=1)
+    nf = nextregular(tod.nsamps)
+    df = 1./(dt*nf)
+    fdata = fft.tod_rfft(tod.data, nf, dtype=dtype)
+    res = pa.multiFreqCorrAnal(fdata, live, df, nf, tod.nsamps,
+                               scan['scan_freq'], par, "liveCorrPar")
+    out = {k: res[k] for k in ['preSel', 'corr', 'gain', 'norm']}
+    n_h = nextregular(int(round(par['driftFilter']/df))) + 1
+    out['DE'] = pa.highFreqAnal(fdata, live, [1,n_h], tod.nsamps,
+                                nmodes=par["DEModes"], preSel=res['preSel'])
+    n_l = int(round(par["midFreqFilter"][0]/df))
+    n_h = int(round(par["midFreqFilter"][1]/df))
+    out['MFE'] = pa.highFreqAnal(fdata, live, [n_l,n_h], tod.nsamps,
+                                 nmodes=par["MFEModes"], preSel=res['preSel'])
+    n_l = int(round(par["highFreqFilter"][0]/df))
+    n_h = int(round(par["highFreqFilter"][1]/df))
+    n_h = nextregular(n_h-n_l) + n_l
+    rms, skewt, kurtt = pa.highFreqAnal(fdata, live, [n_l,n_h], tod.nsamps,
+                                        nmodes=par["HFLiveModes"], highOrder=True)
+    out['rms'] = rms
+    out['skew'] = np.zeros(len(live)); out['skew'][live] = skewt[0]
+    out['kurt'] = np.zeros(len(live)); out['kurt'][live] = kurtt[0]
+    return out, live
+
+
+def compare_precision(tod=None, par=None, **kwargs):
+    """Check the accuracy of the single precision fourier analysis
+    (singlePrecision in findPathoParams) against double precision.
+
+    Parameters
+    ----------
+    tod: SyntheticTOD (default: make_tod(**kwargs))
+    par: findPathoParams-like parameters (default: default_params())
+
+    Returns
+    -------
+    dict of statistic -> max difference relative to the rms of the
+    double precision values, under 'preSel' the fraction of live dets
+    whose preselection differs, and under 'dets' the dets compared: the
+    live dets preselected in both precisions. Dets whose value is not
+    finite or is the fill value of a masked statistic (1e20) in either
+    precision are left out of that statistic. Statistics that are at
+    round-off level in double precision (i.e. DE of short tods, whose
+    drift band has hardly more frequencies than DEModes) show large
+    relative differences.
+
+    """
+    if tod is None: tod = make_tod(**kwargs)
+    if par is None: par = default_params()
+    double, live = _statistics(tod, par, np.float64)
+    single, _ = _statistics(tod, par, np.float32)
+    dets = np.where(live * double['preSel'] * single['preSel'])[0]
+    res = {'preSel': np.mean(double['preSel'][live] != single['preSel'][live])}
+    for k in double:
+        if k == 'preSel': continue
+        d, s = double[k][dets], single[k][dets]
+        ok = np.isfinite(d) * np.isfinite(s) * (np.abs(d) < 1e19) * \
+             (np.abs(s) < 1e19)
+        d, s = d[ok], s[ok]
+        rms = np.sqrt(np.mean(d**2)) if len(d) > 0 else 0.
+        res[k] = np.max(np.abs(s-d)) / (rms if rms > 0 else 1.) \
+                 if len(d) > 0 else np.nan
+    res['dets'] = dets
+    return res
+
+
+def _preprocess_memory(queue, block, dtype, kwargs):
+    from cutslib.tools import blocked_std, peak_rss, reset_peak_rss
+    tod = make_tod(**kwargs)
+    gc.collect()
+    reset_peak_rss()
+    rss0 = peak_rss()
+    blocked_std(tod.data, block)
+    fdata = fft.tod_rfft(tod.data, nextregular(tod.nsamps), dtype=dtype,
+                         block=block)
+    queue.put((peak_rss()-rss0, tod.data.nbytes/2.**20, fdata.nbytes/2.**20))
+
+
+def preprocess_memory(block=0, dtype=np.float64, **kwargs):
+    """Measure the peak memory of the rms and fourier transform of
+    Pathologies.findPathologies (detBlock and singlePrecision) on a
+    synthetic tod. It runs in a new process so that the peak memory
+    isn't the one of earlier work.
+
+    Parameters
+    ----------
+    block: number of detectors processed at a time (0: all at once)
+    dtype: precision of the fourier transform
+    kwargs: make_tod parameters
+
+    Returns
+    -------
+    (peak memory on top of the tod data, size of the tod data, size of
+    the spectrum), in MB
+
+    """
+    import multiprocessing as mp
+    ctx = mp.get_context('fork')
+    queue = ctx.Queue()
+    proc = ctx.Process(target=_preprocess_memory,
+                       args=(queue, block, dtype, kwargs))
+    proc.start()
+    res = queue.get()
+    proc.join()
+    return res
+
+
+def plan_cache_memory(nsamps, ndet=200, dtype=np.float32):
+    """Check that the fft plan cache stays bounded over a TOD loop, whose
+    TODs all have different lengths.
+
+    Parameters
+    ----------
+    nsamps: list of the number of samples of the successive tods
+    ndet: number of detectors
+    dtype: type of the tod data
+
+    Returns
+    -------
+    list of the MB held by the cache after each tod, and the size in MB
+    of the largest tod data
+
+    """
+    fft.clear_plans()
+    res = []
+    for n in nsamps:
+        data = np.zeros((ndet, n), dtype=dtype)
+        fdata = fft.tod_rfft(data, nextregular(n))
+        del data, fdata
+        res.append(fft.cache_bytes()/2.**20)
+    fft.clear_plans()
+    return res, ndet*max(nsamps)*np.dtype(dtype).itemsize/2.**20
+
+
+def print_results(res, values=None, key=None):
+    """Print the results of run_stages or scaling"""
+    if values is None:
+        total = sum(res.values())
+        for k, t in res.items():
+            print("%-16s %9.3f s %5.1f%%" % (k, t, 100*t/total))
+        print("%-16s %9.3f s" % ("total", total))
+        return
+    slope = res['slope']
+    print("%-16s" % key + "".join(["%10d" % v for v in values]) + "     slope")
+    for k, t in res.items():
+        if k == 'slope': continue
+        print("%-16s" % k + "".join(["%10.3f" % x for x in t]) +
+              "%10.2f" % slope[k])
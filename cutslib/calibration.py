@@ -0,0 +1,120 @@
+"""Process level indices of the calibration products (abscal, flatfield
+and responsivity). Each product is read once per process and later
+lookups are served from memory, so that looping over many TODs doesn't
+repeat the same I/O and searches for every TOD."""
+
+import os.path as op
+import numpy as np, h5py
+import moby2
+from moby2.scripting import products
+
+from .depot import SharedDepot
+
+# caches of the loaded products, keyed by file name (abscal and flatfield)
+# or by calibration config and tod name (responsivity)
+abscal_cache = {}
+flatfield_cache = {}
+resp_cache = {}
+max_cached_resp = 64
+
+
+def tod_key(name):
+    """Basename of a tod without extension, as used in the indices"""
+    return op.basename(name).replace('.zip', '')
+
+
+class AbsCal:
+    """Index of an abscal table. The tods of each band are kept sorted
+    so that lookups are binary searches, either for one tod (get) or
+    for many tods at once (lookup)."""
+    def __init__(self, filename):
+        with h5py.File(filename, "r") as f:
+            data = f['abscal'][:]
+        self.filename = filename
+        band_id = data['band_id'].astype(str)
+        tod_id = np.array([tod_key(t) for t in data['tod_id'].astype(str)])
+        cal = data['cal']
+        del data
+        self.bands = {}
+        for band in np.unique(band_id):
+            m = band_id == band
+            order = np.argsort(tod_id[m], kind='stable')
+            self.bands[band] = (tod_id[m][order], cal[m][order])
+
+    def lookup(self, tods, band, default=np.nan):
+        """Get the abscal of a list of tods in a band
+
+        Parameters
+        ----------
+        tods: list of tod names
+        band: band id (i.e. f090, f150)
+        default: value of the tods not in the table
+
+        Returns
+        -------
+        array of abscal with the same length as tods
+
+        """
+        tods = np.array([tod_key(t) for t in np.atleast_1d(tods)])
+        cal = np.full(len(tods), default, dtype=float)
+        if band not in self.bands or len(tods) == 0: return cal
+        names, cals = self.bands[band]
+        if len(names) == 0: return cal
+        idx = np.clip(np.searchsorted(names, tods), 0, len(names)-1)
+        found = names[idx] == tods
+        cal[found] = cals[idx[found]]
+        return cal
+
+    def get(self, tod, band):
+        """Get the abscal of one tod, raise a KeyError if it's missing"""
+        cal = self.lookup([tod], band)[0]
+        if np.isnan(cal): raise KeyError(f"{tod} ({band}) not in {self.filename}")
+        return cal
+
+    def __contains__(self, key):
+        tod, band = key
+        return not np.isnan(self.lookup([tod], band)[0])
+
+
+def get_abscal(tag=None, filename=None):
+    """Get the (cached) abscal index of a tag in the shared depot or
+    of a file"""
+    if filename is None:
+        filename = SharedDepot().get_deep(('TODAbsCal', f'abscal_{tag}.h5'))
+    if filename not in abscal_cache:
+        abscal_cache[filename] = AbsCal(filename)
+    return abscal_cache[filename]
+
+
+def get_flatfield(filename):
+    """Get the (cached) flatfield RelCal object of a .dict or .fits file.
+    The object is shared by all callers, don't modify it in place."""
+    if filename not in flatfield_cache:
+        if '.fits' in filename:
+            ff = moby2.detectors.RelCal.from_fits_table(filename)
+        else:
+            ff = moby2.detectors.RelCal.from_dict(filename)
+        flatfield_cache[filename] = ff
+    return flatfield_cache[filename]
+
+
+def get_responsivity(config, tod_info):
+    """Get the responsivities (calibration.cal) of a tod for a calibration
+    config. The results of the last max_cached_resp tods are kept, so the
+    several lookups of the same tod in a pipeline read it once. They are
+    keyed by the det_uid too, since cal follows the dets loaded. A copy is
+    returned so that it can be modified freely."""
+    det_uid = getattr(tod_info, 'det_uid', None)
+    if det_uid is not None: det_uid = tuple(np.asarray(det_uid).tolist())
+    key = (repr(config), tod_key(tod_info.name), det_uid)
+    if key not in resp_cache:
+        while len(resp_cache) >= max_cached_resp:
+            del resp_cache[next(iter(resp_cache))]
+        resp_cache[key] = products.get_calibration(config, tod_info).cal
+    return resp_cache[key].copy()
+
+
+def clear_cache():
+    abscal_cache.clear()
+    flatfield_cache.clear()
+    resp_cache.clear()
@@ -54,18 +54,32 @@ class Catalog():
         # if biasstep_tag is not in the catalog, add it
         if 'bs_tag' not in self.data.columns:
             self.data['bs_tag'] = ['']*len(self.data)
-        # fill biasstep_tag
-        for i, r in self.data.iterrows():
-            # search for bias_step
-            ctime = r['ctime']
-            res = df[np.logical_and(df.ctime0 <= ctime, df.ctime1 > ctime)]
-            if len(res) == 0:
-                continue
-            elif len(res) == 1:
-                self.data.loc[i,'bs_tag'] = res['biasstep_tag'].values[0]
-            else:
+        if len(df) == 0:
+            return self
+        # fill biasstep_tag: find the last interval starting before each
+        # ctime and check that the ctime is before its end
+        df = df.sort_values('ctime0', kind='stable')
+        t0 = df.ctime0.values
+        t1 = df.ctime1.values
+        tags = df['biasstep_tag'].values
+        ctime = self.data['ctime'].values
+        idx = np.searchsorted(t0, ctime, side='right') - 1
+        found = (idx >= 0) * (ctime < t1[np.maximum(idx, 0)])
+        # if an earlier interval is still open at ctime, the last one is
+        # not the only candidate: search all intervals for these ctimes
+        t1max = np.maximum.accumulate(t1)
+        prev = np.maximum(idx-1, 0)
+        nested = (idx >= 1) * (ctime < t1max[prev])
+        found *= ~nested
+        bs_tag = self.data['bs_tag'].values.copy()
+        bs_tag[found] = tags[idx[found]]
+        for i in np.where(nested)[0]:
+            res = np.where((t0 <= ctime[i]) * (t1 > ctime[i]))[0]
+            if len(res) == 1:
+                bs_tag[i] = tags[res[0]]
+            elif len(res) > 1:
                 raise ValueError("Unexpected happens!")
-
+        self.data['bs_tag'] = bs_tag
         return self
 
     def select(self, query={}):
@@ -93,18 +107,17 @@ class Catalog():
         return self
 
     def add_radec(self):
-        from moby2.ephem import ACTEphem
-        # load ephem
-        eph = ACTEphem()
-        for i, row in self.data.iterrows():
-            ctime = row['ctime']
-            alt = row['alt']
-            az = row['az']
-            eph.set_ctime(ctime)
-            ra, dec = eph.altaz_to_radec(alt, az)
-            if ra>np.pi: ra -= 2*np.pi  # make sure range is -pi to pi
-            self.data.loc[i, 'ra'] = ra
-            self.data.loc[i, 'dec'] = dec
+        """Add the ra, dec (in rad) of the boresight at the start of each
+        tod, evaluated for all tods at once"""
+        from moby2.pointing import get_coords
+        # alt and az in the catalog are in deg
+        ctime = self.data['ctime'].values.astype(float)
+        alt = np.deg2rad(self.data['alt'].values.astype(float))
+        az = np.deg2rad(self.data['az'].values.astype(float))
+        ra, dec = get_coords(ctime, az, alt, fields=['ra', 'dec'])
+        ra = np.where(ra > np.pi, ra - 2*np.pi, ra)  # make sure range is -pi to pi
+        self.data['ra'] = ra
+        self.data['dec'] = dec
 
     def narrow_down(self, tod_list):
         """Narrow down the catalog to a given todlist, it wraps
@@ -66,10 +66,12 @@ class correlationObject( object ):
         if self.commonMode is not None:
             self.commonMode.generateNoiseCoeff( noise )
 
-    def findCorrelation( self, dets = None, nstart = 0, ndata = -1, nmin = 8000 ):
+    def findCorrelation( self, dets = None, nstart = 0, ndata = -1, nmin = 8000, block = 0 ):
         '''
         @brief   Find the correlation matrix.
         @param   dets  List of detectors to use in correlation calculations.
+        @param   block Number of detectors per block of the covariance products, to bound the
+                       memory for large arrays. 0 for a single dense product.
         '''
 
         if dets is None:
@@ -88,9 +90,7 @@ class correlationObject( object ):
 
         psLib.trace('moby', 1, 'Covariance calculation started')
         tic = time.time()
-        data = self.tod.data[dets,nstart:nstart+ndata].copy()
-        self.cov = np.cov(data)
-        del data
+        self.cov = blockCovariance(self.tod.data, dets, nstart, ndata, block = block)
         toc = time.time()
         dtime = (toc - tic)/60.0
         psLib.trace('moby', 1, 'Covariance done %g minutes' %dtime)
@@ -100,20 +100,13 @@ class correlationObject( object ):
         self.varianceFigure = np.median(self.covDiag)
 
         self.correlationFull = np.zeros([self.tod.det_uid.size, self.tod.det_uid.size])
-        for i in range(len(dets)):
-            self.correlationFull[dets[i]][dets[i]] = self.cov[i][i]/self.covDiag[i]**2
-            for j in range(i+1, len(dets)):
-                self.correlationFull[dets[i]][dets[j]] = self.cov[i][j]/self.covDiag[i]/self.covDiag[j]
-                self.correlationFull[dets[j]][dets[i]] = self.correlationFull[dets[i]][dets[j]]
+        self.correlationFull[np.ix_(dets, dets)] = \
+            self.cov / self.covDiag[:,np.newaxis] / self.covDiag[np.newaxis,:]
 
         self.reformatMatrix(rowDominant = self.rowDominance)
 
-        self.quality = 0.0
         n = np.size(self.correlation, 1)
-        for i in range(0, n-1):
-            for j in range(i+1, n):
-                self.quality += self.correlation[i][j]**2
-        self.quality = np.sqrt(self.quality/(n*(n-1)/2.0))
+        self.quality = np.sqrt(np.sum(np.triu(self.correlation, 1)**2)/(n*(n-1)/2.0))
 
         self.log.append({'name':'findCorrelation'})
 
@@ -136,41 +129,27 @@ class correlationObject( object ):
         psLib.trace('moby', 1, 'Reformatting the correlation matrix')
 
 
-        dets = np.array(self.corrDets)
+        dets = np.array(self.corrDets, dtype=int)
         rows = dets // self.Ncols
         cols = dets % self.Ncols
-
-        index_list = []
-        self.separators = {}
-        if self.rowDominance:
-            for row in range (0, self.Nrows):
-                sep_found = False
-                for col in range (0, self.Ncols):
-                    index = dets[(rows == row)*(cols == col)]
-                    if len(index) > 0:
-                        if not sep_found:
-                            self.separators[row] = len(index_list)
-                            sep_found = True
-                        index_list.append(index)
-        else:
-            for col in range (0, self.Ncols):
-                sep_found = False
-                for row in range (0, self.Nrows):
-                    index = dets[(rows == row)*(cols == col)]
-                    if len(index) > 0:
-                        if not sep_found:
-                            self.separators[col] = len(index_list)
-                            sep_found = True
-                        index_list.append(index)
+        if self.rowDominance: major, minor = rows, cols
+        else: major, minor = cols, rows
+
+        # sort the detectors in the array by major then minor index, keeping
+        # the first detector of every (row, col) as the loop over the array did
+        inside = (rows >= 0) * (rows < self.Nrows)
+        order = np.lexsort((np.arange(len(dets)), minor, major))
+        order = order[inside[order]]
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = (np.diff(major[order]) != 0) + (np.diff(minor[order]) != 0)
+        order = order[first]
+        index_list = dets[order]
+        groups, starts = np.unique(major[order], return_index=True)
+        self.separators = dict(zip(groups.tolist(), starts.tolist()))
 
         self.num_index = len(index_list)
         psLib.trace('moby', 1, 'There are '+repr(self.num_index)+' live detectors')
-        self.correlation = np.zeros((self.num_index, self.num_index))
-        for i in range(0,self.num_index):
-            for j in range(0,self.num_index):
-                index_i = index_list[i]
-                index_j = index_list[j]
-                self.correlation[i,j] = self.correlationFull[index_i,index_j]
+        self.correlation = self.correlationFull[np.ix_(index_list, index_list)]
 
 
     def plotCovMatrix(self, filename=None, show = True, separators=True, cbmin=-0.3, cbmax=0.3,
@@ -859,11 +838,9 @@ class liveCorrObj( correlationObject ):
 
                 br, bc = TOD.blockToList(r,c)
                 br, bc, dets = self.tod.listFromRowCol(br, bc)
-                sdets = []
-                for d in dets:
-                    if np.any(alldets == d): sdets.append(d)
+                dets = np.asarray(dets, dtype='int32')
+                sdets = dets[np.isin(dets, alldets)]
                 if len(sdets) > MIN_VICTIMS:
-                    sdets = np.array(sdets, dtype='int32')
                     #cm = np.empty(self.tod.ndata)
                     if useMedian:
                         cm = moby2.libactpol.data_median_axis0(self.tod.data, sdets)
@@ -876,30 +853,42 @@ class liveCorrObj( correlationObject ):
         return modes
 
 
-    def removeGaussCM( self, sigma = 10. ):
+    def removeGaussCM( self, sigma = 10., block = 0 ):
         """
         @brief  Remove a common mode calculated for every detector by averaging the detectors
                 around it weighted by a gaussian of a given sigma.
         @param sigma  Sigma of the gausian used for weighting in units of detector number.
+        @param block  Number of detectors whose modes are found and fitted at a time, to bound
+                      the memory used by the modes. 0 for all detectors at once.
         """
         sigma = float(sigma)
         dets, rows, cols = self.tod.listUncut()
-        dets = np.array(dets)
-        data2 = self.tod.data.copy()
-        for i in dets:
-            xx = self.tod.rows - self.tod.rows[i]
-            yy = self.tod.cols - self.tod.cols[i]
-            xx = xx[dets]
-            yy = yy[dets]
+        dets = np.array(dets, dtype=int)
+        if len(dets) == 0: return
+        # the modes are made from the data before any removal
+        data2 = self.tod.data[dets]
+        rows = self.tod.rows[dets]
+        cols = self.tod.cols[dets]
+        if block <= 0: block = len(dets)
+        for i in range(0, len(dets), block):
+            bdets = dets[i:i+block]
+            # gaussian weights of the detectors around each of the block
+            xx = rows[i:i+block,np.newaxis] - rows[np.newaxis,:]
+            yy = cols[i:i+block,np.newaxis] - cols[np.newaxis,:]
             w = np.exp(-(xx**2+yy**2)/sigma**2)
-            dets2 = dets[w>0.1]
-            w = w[w>0.1]
-            mode = np.dot(data2[dets2].transpose(), w.transpose())
-            norm = np.linalg.norm(mode)
-            if norm == 0.:
-                psLib.trace('moby', 2, "WARNING, zero norm for detector %d" % i )
-            else:
-                self.tod.data[i] -= mode * np.dot(data2[i], mode)/norm**2
+            w[w <= 0.1] = 0.
+            modes = np.dot(w.astype(data2.dtype), data2)
+            # least squares fit of every detector to its mode
+            norm2 = np.einsum('ij,ij->i', modes, modes, dtype=np.float64)
+            coeff = np.einsum('ij,ij->i', data2[i:i+block], modes, dtype=np.float64)
+            zero = norm2 == 0.
+            for d in bdets[zero]:
+                psLib.trace('moby', 2, "WARNING, zero norm for detector %d" % d )
+            coeff[zero] = 0.
+            coeff[~zero] /= norm2[~zero]
+            modes *= coeff[:,np.newaxis].astype(modes.dtype)
+            self.tod.data[bdets] -= modes
+            del modes
         del data2
 
 
@@ -1497,14 +1486,46 @@ def correlate( A ):
     """
     mat = np.cov(A)
     covDiag = np.sqrt(np.diag(mat))
-    for i in range(len(A)):
-        mat[i][i] /= covDiag[i]*covDiag[i]
-        for j in range(i+1, len(A)):
-            mat[i][j] /= covDiag[i]*covDiag[j]
-            mat[j][i] = mat[i][j]
+    mat /= covDiag[:,np.newaxis]
+    mat /= covDiag[np.newaxis,:]
     return mat
 
 
+def blockCovariance( data, dets, nstart = 0, ndata = None, block = 0 ):
+    """
+    @brief   Covariance matrix of the detectors (as np.cov of data[dets,nstart:nstart+ndata])
+             computed with matrix products of blocks of detectors. Only the blocks on and above
+             the diagonal are computed, and only two blocks of demeaned data are in memory at a
+             time instead of a copy of the whole selection.
+    @param   data    Array with the detector vectors.
+    @param   dets    List of detectors to correlate.
+    @param   block   Number of detectors per block. 0 for a single dense product.
+    @return  Covariance matrix.
+    """
+    dets = np.asarray(dets, dtype=int)
+    if ndata is None: ndata = data.shape[1] - nstart
+    sl = slice(nstart, nstart+ndata)
+    def demeaned(d):
+        x = np.array(data[d,sl], dtype=np.float64)
+        x -= x.mean(axis=1)[:,np.newaxis]
+        return x
+    n = len(dets)
+    if block <= 0 or block >= n:
+        x = demeaned(dets)
+        cov = np.dot(x, x.T)
+    else:
+        cov = np.empty((n, n))
+        for i in range(0, n, block):
+            x = demeaned(dets[i:i+block])
+            cov[i:i+block,i:i+block] = np.dot(x, x.T)
+            for j in range(i+block, n, block):
+                y = demeaned(dets[j:j+block])
+                cov[i:i+block,j:j+block] = np.dot(x, y.T)
+                cov[j:j+block,i:i+block] = cov[i:i+block,j:j+block].T
+    cov /= ndata - 1
+    return cov
+
+
 def correlateMode( tod, mode):
     """
     @brief   Find the cross correlation of a mode fitted to the whole array.
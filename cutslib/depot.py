@@ -64,3 +64,81 @@ class Depot(SharedDepot):
 
     def get_full_path(self, *args, **kwargs):
         return self.moby2_depot.get_full_path(*args, **kwargs)
+
+
+class DepotIndex:
+    """Answer the existence queries of depot products from memory. The
+    directory of a tag is listed once (by the root rank if a communicator
+    is given, and shared with the others) instead of checking every file
+    on the shared filesystem, which floods its metadata server when many
+    ranks loop over tods. Products of tags that were not scanned are
+    looked up by listing their directory once. Writes through the index
+    keep it up to date.
+
+    Example:
+        index = DepotIndex(moby2.util.Depot(path), comm=comm)
+        index.scan(moby2.TODCuts, tag)
+        if index.exists(moby2.TODCuts, tag=tag, tod=tod): ...
+    """
+    def __init__(self, depot, comm=None):
+        # accept both our Depot and the moby2 depot
+        self.depot = getattr(depot, 'moby2_depot', depot)
+        self.comm = comm
+        self._roots = {}  # tag root -> set of file paths under it
+        self._dirs = {}   # directory -> set of file names in it
+
+    def tag_root(self, structure, tag):
+        """Directory holding all products of a tag, None if the depot
+        structure of the class doesn't have one"""
+        try:
+            fmt = structure._depot_structure
+            head = fmt.split('{tag}')[0].format(**{'class': structure.__name__})
+            return os.path.normpath(os.path.join(self.depot.depot_path, head, tag))
+        except (AttributeError, KeyError, IndexError):
+            return None
+
+    def scan(self, structure, tag):
+        """List the directory of a tag once. This is collective if the
+        index has a communicator."""
+        if tag is None: return
+        root = self.tag_root(structure, tag)
+        if root is None or root in self._roots: return
+        files = None
+        if self.comm is None or self.comm.rank == 0:
+            files = []
+            for dirpath, _, filenames in os.walk(root):
+                files.extend(os.path.join(dirpath, f) for f in filenames)
+        if self.comm is not None and self.comm.size > 1:
+            files = self.comm.bcast(files, root=0)
+        self._roots[root] = set(files)
+
+    def get_full_path(self, *args, **kwargs):
+        return self.depot.get_full_path(*args, **kwargs)
+
+    def exists(self, structure, tag=None, tod=None, **kwargs):
+        path = os.path.normpath(self.get_full_path(structure, tag=tag,
+                                                   tod=tod, **kwargs))
+        for root, files in self._roots.items():
+            if path.startswith(root + os.sep): return path in files
+        d, f = os.path.split(path)
+        if d not in self._dirs:
+            self._dirs[d] = set(os.listdir(d)) if os.path.isdir(d) else set()
+        return f in self._dirs[d]
+
+    def add(self, path):
+        """Record a new product file"""
+        path = os.path.normpath(path)
+        for root, files in self._roots.items():
+            if path.startswith(root + os.sep):
+                files.add(path)
+                return
+        d, f = os.path.split(path)
+        if d in self._dirs: self._dirs[d].add(f)
+
+    def read_object(self, *args, **kwargs):
+        return self.depot.read_object(*args, **kwargs)
+
+    def write_object(self, obj, tag=None, tod=None, **kwargs):
+        res = self.depot.write_object(obj, tag=tag, tod=tod, **kwargs)
+        self.add(self.get_full_path(obj.__class__, tag=tag, tod=tod))
+        return res
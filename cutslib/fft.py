@@ -1,5 +1,10 @@
 """This is a convenience wrapper of pyfftw. Copied from pixell to avoid dependency
-overhead.
+overhead. On top of the pixell interface this module keeps a cache of plans
+(see get_plan and tod_rfft) so that the repeated transforms of equally shaped
+TODs in the cuts pipeline skip planning and buffer allocation. The cache is
+limited to max_cache_bytes of buffers. The engine can
+be chosen with set_engine or the CUTS_FFT_ENGINE environment variable, and
+the number of threads with set_nthread or OMP_NUM_THREADS.
 
 """
 
@@ -16,23 +21,27 @@ class numpy_FFTW:
 		self.a, self.b = a, b
 		self.axes = axes
 		self.direction = direction
-	def __call__(self, normalise_idft=False):
+	def __call__(self, input_array=None, output_array=None, normalise_idft=False):
+		# mimic pyfftw in allowing the arrays to be swapped at execution time,
+		# but only for this call so that no reference to them is kept
+		a = self.a if input_array  is None else input_array
+		b = self.b if output_array is None else output_array
 		if self.direction == 'FFTW_FORWARD':
-			if self.a.shape == self.b.shape:
+			if a.shape == b.shape:
 				# Complex to complex
-				self.b[:] = np.fft.fftn(self.a, axes=self.axes)
+				b[:] = np.fft.fftn(a, axes=self.axes)
 			else:
 				# Real to complex
-				self.b[:] = np.fft.rfftn(self.a, axes=self.axes)
+				b[:] = np.fft.rfftn(a, axes=self.axes)
 		else:
-			if self.a.shape == self.b.shape:
+			if a.shape == b.shape:
 				# Complex to complex
-				self.b[:] = np.fft.ifftn(self.a, axes=self.axes)
+				b[:] = np.fft.ifftn(a, axes=self.axes)
 			else:
-				self.b[:] = np.fft.irfftn(self.a, s=[self.b.shape[i] for i in self.axes], axes=self.axes)
+				b[:] = np.fft.irfftn(a, s=[b.shape[i] for i in self.axes], axes=self.axes)
 			# Numpy already normalizes, so undo this if necessary
 			if not normalise_idft:
-				self.b *= np.product([self.b.shape[i] for i in self.axes])
+				b *= np.prod([b.shape[i] for i in self.axes])
 
 def numpy_n_byte_align_empty(shape, alignment, dtype):
 	"""This dummy function just skips the alignment, since numpy
@@ -67,11 +76,122 @@ except (KeyError, ValueError):
 nthread_ifft=nthread_fft
 default_flags=['FFTW_ESTIMATE']
 alignment = 32
+# plans are only reusable with arrays of the alignment they were made for
+if "fftw" in engines:
+	alignment = max(alignment, getattr(engines["fftw"], "simd_alignment", alignment))
+if os.environ.get("CUTS_FFT_ENGINE") in engines:
+	engine = os.environ["CUTS_FFT_ENGINE"]
+
+# cache of (plan, input buffer, output buffer) keyed by the transform layout,
+# limited by the bytes of the buffers it holds (see get_plan)
+plan_cache = {}
+max_cache_bytes = 2**28
 
 def set_engine(eng):
 	global engine
+	if eng not in engines:
+		raise ValueError("Unknown fft engine %s, available: %s" % (eng, ", ".join(engines)))
 	engine = eng
 
+def set_nthread(nthread):
+	"""Set the default number of threads used by all transforms. 0 restores
+	the default based on OMP_NUM_THREADS or the number of cores."""
+	global nthread_fft, nthread_ifft
+	if not nthread:
+		try: nthread = int(os.environ['OMP_NUM_THREADS'])
+		except (KeyError, ValueError): nthread = multiprocessing.cpu_count()
+	nthread_fft = nthread_ifft = nthread
+
+def clear_plans():
+	"""Drop all cached plans together with their buffers"""
+	plan_cache.clear()
+
+def cache_bytes():
+	"""Return the number of bytes held by the buffers of the cached plans"""
+	return sum(a.nbytes + (b.nbytes if b is not None else 0)
+		for _, a, b in plan_cache.values())
+
+def get_plan(ishape, itype, oshape, otype, axes=[-1], direction='FFTW_FORWARD',
+		nthread=0, flags=None, out=None):
+	"""Return a cached (plan, a, b) triplet transforming the buffer a of shape
+	ishape and type itype into the buffer b of shape oshape and type otype.
+	Plans are keyed by engine, layout and thread count, so the repeated
+	nextregular lengths of a TOD loop only get planned once. If out is given
+	the plan writes into it instead and is made for this call only, since a
+	plan keeps a reference to its arrays: only the input buffer is cached
+	and b is out, and only the input buffer of the last such shape is kept.
+	The least recently created entries are dropped to keep the buffers under
+	max_cache_bytes, an entry larger than that is kept alone."""
+	if direction == 'FFTW_FORWARD': nt = nthread or nthread_fft
+	else: nt = nthread or nthread_ifft
+	if flags is None: flags = default_flags
+	if out is None:
+		key = (engine, tuple(ishape), np.dtype(itype).str, tuple(oshape),
+			np.dtype(otype).str, tuple(axes), direction, nt, tuple(flags))
+	else:
+		key = (engine, tuple(ishape), np.dtype(itype).str)
+	if key not in plan_cache:
+		nbytes = np.prod(ishape)*np.dtype(itype).itemsize
+		if out is None: nbytes += np.prod(oshape)*np.dtype(otype).itemsize
+		else:
+			# the padded input of a whole tod is only kept for the last length
+			for k in [k for k, v in plan_cache.items() if v[0] is None]:
+				del plan_cache[k]
+		while plan_cache and cache_bytes() + nbytes > max_cache_bytes:
+			del plan_cache[next(iter(plan_cache))]
+		a = empty(ishape, itype)
+		if out is None:
+			b = empty(oshape, otype)
+			plan = engines[engine].FFTW(a, b, flags=flags, direction=direction, threads=nt, axes=axes)
+			plan_cache[key] = (plan, a, b)
+		else:
+			plan_cache[key] = (None, a, None)
+	plan, a, b = plan_cache[key]
+	if out is not None:
+		plan = engines[engine].FFTW(a, out, flags=flags, direction=direction, threads=nt, axes=axes)
+		b = out
+	return plan, a, b
+
+def tod_rfft(tod, n=None, ft=None, nthread=0, dtype=np.float64, flags=None,
+		block=0):
+	"""Real-to-complex transform of tod along its last axis, zero padded or
+	truncated to length n. This is equivalent to np.fft.rfft(tod, n), but the
+	plan and the padded input buffer are cached so that they are reused for
+	every TOD of the same shape. The input is cast to dtype while it is
+	copied into the padded buffer, so no other temporary is made. If ft is
+	given (it should be allocated with empty to have the right alignment)
+	the transform is written into it, otherwise a new array is returned.
+	With block > 0 the rows of a 2d tod are transformed block rows at a
+	time, so that the padded buffer is the size of a block instead of a
+	second copy of the tod."""
+	tod = np.asarray(tod)
+	nsamp = tod.shape[-1]
+	if n is None: n = nsamp
+	ishape = tod.shape[:-1] + (n,)
+	oshape = tod.shape[:-1] + (n//2+1,)
+	otype = np.result_type(dtype, np.complex64)
+	if tod.size == 0: return np.zeros(oshape, otype)
+	m = min(n, nsamp)
+	if ft is None: ft = empty(oshape, otype)
+	if block and tod.ndim == 2 and block < tod.shape[0]:
+		plan, a, b = get_plan((block, n), dtype, (block, n//2+1), otype,
+			nthread=nthread, flags=flags)
+		a[:,m:] = 0
+		for i in range(0, tod.shape[0], block):
+			k = min(block, tod.shape[0]-i)
+			# the rows past k of the last block are left from the
+			# previous one, they are transformed but not used
+			a[:k,:m] = tod[i:i+k,:m]
+			plan(a, b)
+			ft[i:i+k] = b[:k]
+		return ft
+	plan, a, _ = get_plan(ishape, dtype, oshape, otype, nthread=nthread,
+		flags=flags, out=ft)
+	a[...,:m] = tod[...,:m]
+	a[...,m:] = 0
+	plan()
+	return ft
+
 def fft(tod, ft=None, nthread=0, axes=[-1], flags=None):
 	"""Compute discrete fourier transform of tod, and store it in ft. What
 	transform to do (real or complex, number of dimension etc.) is determined
@@ -112,7 +232,7 @@ def ifft(ft, tod=None, nthread=0, normalize=False, axes=[-1],flags=None):
 	# pyfftw's normalize function.. So normalize manually instead
 	#plan(normalise_idft=normalize)
 	plan(normalise_idft=False)
-	if normalize: tod /= np.product([tod.shape[i] for i in axes])
+	if normalize: tod /= np.prod([tod.shape[i] for i in axes])
 	return tod
 
 def rfft(tod, ft=None, nthread=0, axes=[-1], flags=None):
@@ -3,6 +3,8 @@ import numpy as np
 from scipy import stats
 
 import moby2
+from cutslib import fft
+from cutslib.tools import nextregular, sweep_cuts, ranges_from_sweep, find_overlaps
 
 class TODSnippet:
     def __init__(self, tod=None, det_uid=None, tslice=None):
@@ -72,7 +74,8 @@ class TODSnippet:
         template: 1d np.ndarray
 
         """
-        return np.apply_along_axis(lambda x: template_match(x, template), 1, self.data)
+        snr, _ = match_templates([self.data], template)
+        return snr[:,0]
     def max_snr_template(self, template):
         """Return the maximum snr in the snippet after correlating
         with a known template"""
@@ -166,14 +169,13 @@ def glitch_det_count(cuts, dets=None):
     cuts: TODCuts object
 
     """
-    if dets is None:
-        return np.sum([c.get_mask() for c in cuts.cuts], axis=0)
-    else:
-        return np.sum([c.get_mask() for i, c in enumerate(cuts.cuts)
-                       if cuts.det_uid[i] in dets], axis=0)
+    cr = CutsRanges.from_tod_cuts(cuts)
+    if dets is None: return cr.det_count()
+    return cr.det_count(np.where(np.isin(cuts.det_uid, dets))[0])
 
 def pcuts2mask(cuts):
-    """Convert partial cuts to a 2d boolean mask"""
+    """Convert partial cuts to a 2d boolean mask (ndet x nsamps), see
+    CutsRanges for the counts and overlaps without a dense mask"""
     mask = np.stack([c.get_mask() for c in cuts.cuts], axis=0)
     return mask
 
@@ -190,10 +192,8 @@ def is_cut(cv, t):
     True if t is cut else False
 
     """
-    for c in cv:
-        if c[0] <= t <= c[1]:
-            return True
-    return False
+    cv = np.asarray(cv).reshape(-1,2)
+    return bool(np.any((cv[:,0] <= t) * (t <= cv[:,1])))
 
 def dets_affected_at_t(cuts, t):
     """Find dets affected by the given cuts at a specific time t
@@ -208,7 +208,10 @@ def dets_affected_at_t(cuts, t):
     [det_uid]
 
     """
-    return [d for (d, cv) in zip(cuts.det_uid, cuts.cuts) if is_cut(cv, t)]
+    cr = CutsRanges.from_tod_cuts(cuts)
+    # as in is_cut the last sample of a range counts as cut
+    det = np.unique(cr.det[(cr.start <= t) * (t <= cr.stop)])
+    return list(np.asarray(cuts.det_uid)[det])
 
 def pixels_affected_at_t(cuts, t, pr):
     """Find pixels affected by the given cuts at a specific time t
@@ -249,8 +252,9 @@ def dets_affected_in_cv(cuts, cv, dets):
     dets (boolean array): an narrowed-down list of dets to look at
 
     """
-    get_dets = lambda x: np.where((np.sum(x,axis=1)>0)*dets)[0]
-    return slices_map(get_dets, pcuts2mask(cuts), cv2slices(cv))
+    cr = CutsRanges.from_tod_cuts(cuts)
+    affected = cr.dets_in(cv)
+    return [d[dets[d]] for d in affected]
 
 class PixelReader:
     def __init__(self, season='2016', array='AR3', mask=None, adj=False):
@@ -499,6 +503,126 @@ class CutsMatrix:
     def __repr__(self):
         return f"CutsMatrix(shape={self.shape})"
 
+class CutsRanges:
+    """Cut ranges of all dets kept in flat arrays, so that the cut algebra
+    across dets runs in numpy without building dense masks"""
+    def __init__(self, det, start, stop, ndet, nsamps):
+        """
+        Parameters
+        ----------
+        det: index of the det (in the list of cuts) each range belongs to
+        start, stop: first and last+1 sample of each range
+        ndet: number of dets
+        nsamps: number of samples
+
+        """
+        self.det = np.asarray(det, dtype=int)
+        self.start = np.asarray(start, dtype=int)
+        self.stop = np.asarray(stop, dtype=int)
+        self.ndet, self.nsamps = ndet, nsamps
+    @classmethod
+    def from_cvs(cls, cvs, nsamps):
+        """Build from a list of CutsVector (one per det)"""
+        cvs = [np.asarray(cv, dtype=int).reshape(-1,2) for cv in cvs]
+        lens = [len(cv) for cv in cvs]
+        if sum(lens) == 0: ranges = np.zeros((0,2), dtype=int)
+        else: ranges = np.concatenate(cvs, axis=0)
+        det = np.repeat(np.arange(len(cvs)), lens)
+        return cls(det, ranges[:,0], ranges[:,1], len(cvs), nsamps)
+    @classmethod
+    def from_tod_cuts(cls, cuts):
+        """Build from a TODCuts object, dets follow the order in cuts.cuts"""
+        return cls.from_cvs(cuts.cuts, cuts.nsamps)
+    def to_cvs(self):
+        """Convert to a list of CutsVector (one per det)"""
+        c = self.normalize()
+        bounds = np.searchsorted(c.det, np.arange(1, c.ndet))
+        ranges = np.split(np.stack([c.start, c.stop], axis=1), bounds)
+        return [CutsVector(r, c.nsamps) for r in ranges]
+    def _keys(self):
+        # offset each det so that sorting and merging never mixes dets
+        off = self.det * (self.nsamps+1)
+        return self.start + off, self.stop + off, off
+    def normalize(self):
+        """Sort the ranges and merge those that overlap or touch"""
+        if len(self.det) == 0: return self
+        s, e, off = self._keys()
+        order = np.argsort(s, kind='stable')
+        s, e, off = s[order], e[order], off[order]
+        # a range starts a new group if it begins after all previous ones end
+        emax = np.maximum.accumulate(e)
+        new = np.r_[True, s[1:] > emax[:-1]]
+        first = np.where(new)[0]
+        stop = np.maximum.reduceat(e, first) - off[first]
+        keep = stop > s[first] - off[first]
+        return CutsRanges(self.det[order][first][keep], (s[first]-off[first])[keep],
+                          stop[keep], self.ndet, self.nsamps)
+    def complement(self):
+        """Return the uncut ranges"""
+        c = self.normalize()
+        dets = np.arange(c.ndet)
+        # uncut ranges run from 0 or the end of a cut to the next cut or nsamps
+        start = np.r_[np.zeros(c.ndet, dtype=int), c.stop]
+        sdet = np.r_[dets, c.det]
+        stop = np.r_[c.start, np.full(c.ndet, c.nsamps)]
+        edet = np.r_[c.det, dets]
+        so = np.lexsort((start, sdet))
+        eo = np.lexsort((stop, edet))
+        start, stop, det = start[so], stop[eo], sdet[so]
+        keep = stop > start
+        return CutsRanges(det[keep], start[keep], stop[keep], c.ndet, c.nsamps)
+    def __or__(self, other):
+        assert (self.ndet, self.nsamps) == (other.ndet, other.nsamps), "Shape mismatch!"
+        return CutsRanges(np.r_[self.det, other.det], np.r_[self.start, other.start],
+                          np.r_[self.stop, other.stop], self.ndet, self.nsamps).normalize()
+    def __and__(self, other):
+        return ~(~self | ~other)
+    def __invert__(self):
+        return self.complement()
+    def count(self):
+        """Number of cut ranges in each det"""
+        return np.bincount(self.det, minlength=self.ndet)
+    def ncut(self):
+        """Number of cut samples in each det"""
+        c = self.normalize()
+        return np.bincount(c.det, weights=c.stop-c.start, minlength=c.ndet).astype(int)
+    def fraction(self):
+        """Fraction of cut samples in each det"""
+        return self.ncut() / self.nsamps
+    def det_count(self, dets=None):
+        """Number of dets cut at each sample, optionally only counting
+        the dets with the given indices"""
+        c = self.normalize()
+        sel = np.ones(len(c.det), dtype=bool) if dets is None else np.isin(c.det, dets)
+        edges = np.bincount(c.start[sel], minlength=c.nsamps+1) - \
+            np.bincount(c.stop[sel], minlength=c.nsamps+1)
+        return np.cumsum(edges)[:c.nsamps]
+    def sweep(self, dets=None):
+        """Number of dets cut between the sorted samples where it changes,
+        without a time series: returns edges and count, where count[i]
+        dets are cut in edges[i]:edges[i+1] (see tools.sweep_cuts)"""
+        c = self.normalize()
+        sel = np.ones(len(c.det), dtype=bool) if dets is None else np.isin(c.det, dets)
+        return sweep_cuts(c.start[sel], c.stop[sel])
+    def common_cuts(self, min_dets=1, dets=None):
+        """Ranges of samples with at least min_dets dets cut, as a
+        CutsVector"""
+        edges, count = self.sweep(dets)
+        return CutsVector(ranges_from_sweep(edges, count, min_dets), self.nsamps)
+    def dets_in(self, cv):
+        """Indices of the dets cut somewhere in each range of cv (a list
+        of [start, stop) such as a CutsVector)"""
+        cv = np.asarray(cv, dtype=int).reshape(-1,2)
+        c = self.normalize()
+        iq, ir = find_overlaps(c.start, c.stop, cv[:,0], cv[:,1])
+        # the ranges of a det are disjoint, but several may hit a query
+        dets = np.split(c.det[ir], np.searchsorted(iq, np.arange(1, len(cv))))
+        return [np.unique(d) for d in dets]
+    def __len__(self):
+        return len(self.det)
+    def __repr__(self):
+        return f"CutsRanges(ndet={self.ndet},nsamps={self.nsamps},nranges={len(self)})"
+
 #############
 # utilities #
 #############
@@ -559,6 +683,80 @@ def template_match(data, template):
     # find snr of the maxima
     return np.max(np.abs(corr)) / nl
 
+def match_templates(data, templates, block=4096):
+    """Batched template search. The series are stacked and correlated
+    with all templates at once in the frequency domain. Each series is
+    demeaned and detrended and its snr is found as in template_match,
+    but the lag of the best match is returned as well.
+
+    Parameters
+    ----------
+    data: list of 1d series or of 2d arrays of equally long series
+          (i.e. the data of TODSnippet), or a 2d array
+    templates: 1d template, or a list (2d array) of templates
+    block: number of series correlated at a time, to bound the memory
+
+    Returns
+    -------
+    (snr, lag): arrays of shape (number of series, number of templates)
+    with the snr of the best match and the sample of the series where
+    the template starts for it
+
+    """
+    if isinstance(data, np.ndarray) and data.ndim == 2: data = [data]
+    series = [r for d in data for r in np.atleast_2d(d)]
+    if np.ndim(templates[0]) == 0: templates = [templates]
+    templates = [np.asarray(t, dtype=float) for t in templates]
+    nseries = len(series)
+    snr = np.full((nseries, len(templates)), np.nan)
+    lag = np.full((nseries, len(templates)), -1, dtype=int)
+    for i0 in range(0, nseries, block):
+        blk = series[i0:i0+block]
+        L = np.array([len(x) for x in blk])
+        nmax = L.max()
+        # stack the series, zero padded to the longest one
+        x = np.zeros((len(blk), nmax))
+        for j, d in enumerate(blk): x[j,:len(d)] = d
+        samps = np.arange(nmax)
+        pad = samps[np.newaxis,:] >= L[:,np.newaxis]
+        r = np.arange(len(blk))
+        # demean and detrend
+        x -= (x.sum(axis=1)/L)[:,np.newaxis]
+        x[pad] = 0
+        slope = (x[r,L-1] - x[:,0]) / L
+        x -= slope[:,np.newaxis] * samps
+        x[pad] = 0
+        # noise level from the inter-quartile range of each series
+        xs = np.where(pad, np.inf, x)
+        xs.sort(axis=1)
+        q = []
+        for p in [0.25, 0.75]:
+            pos = p*(L-1)
+            lo = np.floor(pos).astype(int)
+            hi = np.minimum(lo+1, L-1)
+            q.append(xs[r,lo] + (xs[r,hi]-xs[r,lo])*(pos-lo))
+        del xs
+        nl = 0.741 * (q[1]-q[0])
+        # cross-correlate with the templates, there is no wrap around
+        # over the valid lags 0..L-M with a transform of length >= nmax
+        nf = nextregular(nmax)
+        fx = fft.tod_rfft(x, nf)
+        for k, t in enumerate(templates):
+            M = len(t)
+            ft = np.conj(np.fft.rfft(t, nf))
+            corr = np.abs(fft.irfft(fx*ft, n=nf, normalize=True)[:,:nmax])
+            corr[samps[np.newaxis,:] > (L-M)[:,np.newaxis]] = -1
+            best = np.argmax(corr, axis=1)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                snr[i0:i0+block,k] = corr[r,best] / nl
+            lag[i0:i0+block,k] = best
+            # series shorter than the template are correlated directly
+            for j in np.where(L < M)[0]:
+                c = np.abs(np.correlate(x[j,:L[j]], t, mode='valid'))
+                snr[i0+j,k] = np.max(c) / nl[j]
+                lag[i0+j,k] = np.argmax(c)
+    return snr, lag
+
 #########################
 # visualization related #
 #########################
@@ -6,6 +6,7 @@ import moby2
 from moby2.util import MobyDict
 from . import util
 from .depot import Depot, SharedDepot
+from .calibration import get_abscal, get_flatfield, get_responsivity
 from .pathologies import Pathologies, get_pathologies
 from .pathologies_tools import get_pwv
 
@@ -103,14 +104,7 @@ def load_tod(todname, tag=None, planet=None, partial=None, depot=None,
         # get abscal
         if 'abscal' in autoloads:
             try:
-                abscal_file = SharedDepot().get_deep(('TODAbsCal',f'abscal_{abscal}.h5'))
-                with h5py.File(abscal_file, "r") as f:
-                    abscal_data = f['abscal'][:]
-                    bmask = abscal_data['band_id'].astype(str) == fcode
-                    todmask = abscal_data['tod_id'].astype(str) == tod.info.name
-                    cal = abscal_data['cal'][bmask*todmask][0]
-                    del abscal_data, bmask
-                    tod.abscal = cal
+                tod.abscal = get_abscal(abscal).get(tod.info.name, fcode)
                 if verbose: print(f"-> abscal loaded in tod.abscal tagged: {abscal}")
             except:
                 print("Warning: abscal not loaded successfully")
@@ -279,14 +273,14 @@ def get_partial(tod, params=None, depot=None, tag=None, force=False, write=True)
 
 def get_ff(tod, flatfield):
     """return flatfield readings"""
-    ff_ = moby2.detectors.RelCal.from_dict(flatfield)
+    ff_ = get_flatfield(flatfield)
     ff_sel, ff = ff_.get_property('cal', tod.det_uid, default=0)
     _, stable  = ff_.get_property('stable', tod.det_uid, default=False)
     return ff, ff_sel, stable
 
 def get_resp(tod, param):
     """return responsivity measurement"""
-    resp = moby2.scripting.products.get_calibration(param, tod.info).cal
+    resp = get_responsivity(param, tod.info)
     resp_sel = resp != 0
     return resp, resp_sel
 
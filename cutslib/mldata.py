@@ -0,0 +1,104 @@
+"""Columnar hdf5 data sets for machine learning studies. Each tod is a
+group with one dataset per feature, detectors along the first axis and
+their det_uid as the detector index:
+
+    <group>/<tod_name>/det_uid    (ndet,)
+    <group>/<tod_name>/<feature>  (ndet,) or (ndet, nsamps), chunked by dets
+    <group>/<tod_name>/label      (ndet,)
+
+and the per-tod values (i.e. alt, pwv) as attributes of the tod group.
+A tod is written and read with a few large operations instead of one
+tiny dataset per detector."""
+import numpy as np, h5py
+
+
+def write_tod(group, name, det_uid, features, attrs={}, chunk_dets=64):
+    """Write the features of a tod, replacing it if it exists
+
+    Parameters
+    ----------
+    group: hdf5 group of the data set (i.e. train)
+    name: tod name
+    det_uid: detector index of the rows
+    features: dict of (ndet,) or (ndet, ...) arrays, including the label
+    attrs: dict of per-tod scalars
+    chunk_dets: number of dets per chunk of the multi-dimensional features
+
+    """
+    if name in group: del group[name]
+    g = group.create_group(name)
+    g.create_dataset('det_uid', data=np.asarray(det_uid))
+    for k, v in features.items():
+        v = np.asarray(v)
+        chunks = None
+        if v.ndim > 1 and len(v) > 0:
+            chunks = (min(chunk_dets, len(v)),) + v.shape[1:]
+        g.create_dataset(k, data=v, chunks=chunks)
+    for k, v in attrs.items():
+        g.attrs[k] = v
+    return g
+
+
+def read_tod(group, name, features=None):
+    """Read the features of a tod, the per-tod attributes requested in
+    features are broadcasted to the dets
+
+    Parameters
+    ----------
+    group: hdf5 group of the data set
+    name: tod name
+    features: list of features to read (default all)
+
+    Returns
+    -------
+    dict of arrays with the dets along the first axis, with det_uid
+
+    """
+    g = group[name]
+    if features is None:
+        features = [k for k in g if k != 'det_uid'] + list(g.attrs)
+    det_uid = g['det_uid'][()]
+    res = {'det_uid': det_uid}
+    for k in features:
+        if k in g: res[k] = g[k][()]
+        elif k in g.attrs: res[k] = np.full(len(det_uid), g.attrs[k])
+        else: raise KeyError(f"{k} not found in {name}")
+    return res
+
+
+def load(filename, group, features=None, tods=None):
+    """Load the features of many tods as rows (one per det per tod)
+
+    Parameters
+    ----------
+    filename: hdf5 file
+    group: data set (i.e. train, validate, test)
+    features: list of features to read (default all)
+    tods: list of tod names (default all)
+
+    Returns
+    -------
+    dict of arrays with one row per det per tod, with det_uid and tod
+    (index in the list of tods)
+
+    """
+    with h5py.File(filename, "r") as f:
+        g = f[group]
+        if tods is None: tods = list(g)
+        rows = [read_tod(g, t, features) for t in tods]
+    if len(rows) == 0: return {}
+    res = {k: np.concatenate([r[k] for r in rows]) for k in rows[0]}
+    res['tod'] = np.concatenate([np.full(len(r['det_uid']), i)
+                                 for i, r in enumerate(rows)])
+    return res
+
+
+def iter_batches(filename, group, features=None, batch_size=16, shuffle=False):
+    """Iterate over the data set in batches of tods, yielding
+    (tod names, rows) with rows as returned by load"""
+    with h5py.File(filename, "r") as f:
+        tods = np.array(list(f[group]))
+    if shuffle: np.random.shuffle(tods)
+    for i in range(0, len(tods), batch_size):
+        batch = [str(t) for t in tods[i:i+batch_size]]
+        yield batch, load(filename, group, features, batch)
@@ -6,13 +6,17 @@ import pickle, numpy as np, sys, os
 from moby2.util.database import TODList
 from cutslib.pathologies_tools import get_pathologies
 from cutslib import Catalog
+from cutslib.season import SeasonStore, SlotStore
 from cutslib.pathologies import Pathologies
-from cutslib import util
 
 class Module:
     def __init__(self, config):
         self.limit = config.getint("limit", None)
-        self.split = config.getint("split", 1)
+        # also save a chunked season store for lazy loading in SeasonStats
+        self.store = config.getboolean("store", True)
+        # also save the season stats pickle file, this loads all the
+        # stats in memory at the end
+        self.pickle = config.getboolean("pickle", True)
 
     def run(self, p):
         limit = self.limit
@@ -29,133 +33,119 @@ class Module:
         depot = moby2.util.Depot(p.depot)
         if limit:
             base_arr = base_arr[:limit,:]
-        # the list is usually huge so it's worthwhile to split into
-        # sublists and process each one
-        base_arr_splits = np.array_split(base_arr, self.split)
-        for i_split in range(self.split):
-            base_arr = base_arr_splits[i_split]
-            res = {
-                'tods': [],
-                'sel': [],
-                'psel': [],
-                'scanf': [],
-                'resp': [],
-                'resp_sel': [],
-                'cal': [],
-                'ctimes': [],
-                'pwv': [],
-                'alt': [],
-                'tod_sel': []
-            }
-            for key in all_keys:
-                res[key] = []
-                res[f"{key}_sel"] = []
-            n_tot = base_arr.shape[0]
-            print(f"Collecting Criteria for {n_tot} files in [{i_split+1}/{self.split}] split")
-            for i in range(p.rank, n_tot, p.size):
-                obs = base_arr[i,0]
-                pwv = base_arr[i,1]
-                print(f"{p.rank:3d} {obs} {i:>5d}/{n_tot:>5d} {pwv:.2f}")
-                # try loading, if failed add it to tod_sel
-                try:
-                    tod = moby2.scripting.get_tod({"filename": obs,
-                                                   "read_data": False})
-                except:
-                    # failed to process
-                    res['tod_sel'].append(False)
-                    continue
-                if os.path.isfile(depot.get_full_path(Pathologies, tod=tod, tag=p.tag)) and \
-                   os.path.isfile(depot.get_full_path(moby2.TODCuts, tod=tod, tag=p.tag)):
-                    pa = get_pathologies(tod, cpar)
-                    # get all crit cuts
-                    # for final cuts we will get from TODCuts objects instead of here
-                    # because the externally included cuts will not be stored here
-                    pa.makeNewSelections()
-                    # store pathologies crits
-                    for k in all_keys:
-                        if "values" in pa.crit[k]:
-                            res[k].append(pa.crit[k]["values"])
-                        if "sel" in pa.crit[k]:
-                            res[f"{k}_sel"].append(pa.crit[k]["sel"])
-                    # fix_tod_length(tod, pa.offsets)
-                    # get preselection
-                    res['psel'].append(pa.preLiveSel)
-                    resp, _, _, re_sel, _, _ = pa.getpWCalibration()
-                    res['tods'].append(tod.info.name)
-                    res['scanf'].append(pa.scan_freq)
-                    res['resp'].append(resp)
-                    res['resp_sel'].append(re_sel)
-                    res['cal'].append(resp*pa.calData['ff'])
-                    res['ctimes'].append(tod.info.ctime)
-                    res['pwv'].append(pwv)
-                    res['alt'].append(np.mean(tod.alt))
-                    res['tod_sel'].append(True)
-                    # get final cuts
-                    cuts = depot.read_object(moby2.TODCuts, tod=tod, tag=p.tag)
-                    res['sel'].append(cuts.get_mask())
-                else:
-                    res['tod_sel'].append(False)
-
-            p.comm.Barrier()
-            data = {}
-            data['name'] = util.allgatherv(res['tods'], p.comm)
-            data["scan_freq"] = util.allgatherv(res['scanf'], p.comm)
-            data['sel'] = util.allgatherv(res['sel'], p.comm).T
-            data['psel'] = util.allgatherv(res['psel'], p.comm).T
-            data["resp"] = util.allgatherv(res['resp'], p.comm).T
-            data["resp_sel"] = util.allgatherv(res['resp_sel'], p.comm).T
-            data["cal"] = util.allgatherv(res['cal'], p.comm).T
-            data["ctime"] = util.allgatherv(res['ctimes'], p.comm)
-            data["alt"] = util.allgatherv(res['alt'], p.comm)
-            data["pwv"] = util.allgatherv(res['pwv'], p.comm)
-            data['tod_sel'] = util.allgatherv(res['tod_sel'],p.comm)
-            for k in all_keys:
-                data[k] = util.allgatherv(np.array(res[k]), p.comm).T
-                ksel = f'{k}_sel'
-                data[ksel] = util.allgatherv(np.array(res[ksel]), p.comm).T
-            if p.rank == 0:
-                data["live"] = pa.liveCandidates
-                data["dark"] = pa.origDark
-                data["ff"] = pa.calData['ff']
-                data["ff_sel"] = pa.calData['ffSel']
-                data["stable"] = pa.calData['stable']
-                array_data = moby2.scripting.get_array_data({
-                    'instrument': 'actpol',
-                    'array_name': p.i.ar,
-                    'season': p.i.season
-                })
-                tes_sel = (array_data['nom_freq']== p.i.freq) * \
-                    (array_data['det_type'] == 'tes')
-                data['tes_sel'] = tes_sel
-                outfile = p.o.pickle_file+f'.{i_split}'
+        array_data = moby2.scripting.get_array_data({
+            'instrument': 'actpol',
+            'array_name': p.i.ar,
+            'season': p.i.season
+        })
+        ndet = len(array_data['det_uid'])
+        n_tot = base_arr.shape[0]
+        # every tod has a slot in an on-disk store that each rank writes
+        # its tods into, so nothing grows in memory with the season
+        fields = {
+            'name': ('S64', ()),
+            'scan_freq': (float, ()),
+            'ctime': (float, ()),
+            'alt': (float, ()),
+            'pwv': (float, ()),
+            'tod_sel': (bool, ()),
+            'sel': (bool, (ndet,)),
+            'psel': (bool, (ndet,)),
+            'resp': (float, (ndet,)),
+            'resp_sel': (bool, (ndet,)),
+            'cal': (float, (ndet,)),
+        }
+        for key in all_keys:
+            fields[key] = (float, (ndet,))
+            fields[f"{key}_sel"] = (bool, (ndet,))
+        slot_dir = op.splitext(p.o.pickle_file)[0] + '_slots'
+        if p.rank == 0:
+            SlotStore.create(slot_dir, n_tot, fields)
+        p.comm.Barrier()
+        slots = SlotStore(slot_dir)
+        # per-det fields, the same for all tods
+        meta = None
+        print(f"Collecting Criteria for {n_tot} files")
+        for i in range(p.rank, n_tot, p.size):
+            obs = base_arr[i,0]
+            pwv = base_arr[i,1]
+            print(f"{p.rank:3d} {obs} {i:>5d}/{n_tot:>5d} {pwv:.2f}")
+            # try loading, if failed leave it out of tod_sel
+            try:
+                tod = moby2.scripting.get_tod({"filename": obs,
+                                               "read_data": False})
+            except:
+                # failed to process
+                continue
+            if os.path.isfile(depot.get_full_path(Pathologies, tod=tod, tag=p.tag)) and \
+               os.path.isfile(depot.get_full_path(moby2.TODCuts, tod=tod, tag=p.tag)):
+                pa = get_pathologies(tod, cpar,
+                                     skip=Pathologies.bulky_keys)
+                # get all crit cuts
+                # for final cuts we will get from TODCuts objects instead of here
+                # because the externally included cuts will not be stored here
+                pa.makeNewSelections()
+                row = {}
+                # store pathologies crits
+                for k in all_keys:
+                    if "values" in pa.crit[k]:
+                        row[k] = pa.crit[k]["values"]
+                    if "sel" in pa.crit[k]:
+                        row[f"{k}_sel"] = pa.crit[k]["sel"]
+                # fix_tod_length(tod, pa.offsets)
+                # get preselection
+                row['psel'] = pa.preLiveSel
+                resp, _, _, re_sel, _, _ = pa.getpWCalibration()
+                row['name'] = tod.info.name
+                row['scan_freq'] = pa.scan_freq
+                row['resp'] = resp
+                row['resp_sel'] = re_sel
+                row['cal'] = resp*pa.calData['ff']
+                row['ctime'] = tod.info.ctime
+                row['pwv'] = pwv
+                row['alt'] = np.mean(tod.alt)
+                row['tod_sel'] = True
+                # get final cuts
+                cuts = depot.read_object(moby2.TODCuts, tod=tod, tag=p.tag)
+                row['sel'] = cuts.get_mask()
+                slots.write(i, row)
+                if meta is None:
+                    meta = {
+                        "live": pa.liveCandidates,
+                        "dark": pa.origDark,
+                        "ff": pa.calData['ff'],
+                        "ff_sel": pa.calData['ffSel'],
+                        "stable": pa.calData['stable'],
+                    }
+        slots.close()
+        metas = p.comm.gather(meta, root=0)
+        p.comm.Barrier()
+        # only the per-det metadata is left to write, the season
+        # stats are converted from the slots chunk by chunk
+        if p.rank == 0:
+            meta = [m for m in metas if m is not None][0]
+            tes_sel = (array_data['nom_freq']== p.i.freq) * \
+                (array_data['det_type'] == 'tes')
+            meta['tes_sel'] = tes_sel
+            if self.store:
+                outfile = op.splitext(p.o.pickle_file)[0] + '.h5'
+                print("Saving season store: %s" % outfile)
+                SeasonStore.write_slots(outfile, slots, meta)
+            if self.pickle:
+                tod_sel = np.array(slots.read('tod_sel'))
+                idx = np.where(tod_sel)[0]
+                data = {}
+                for k in slots.fields:
+                    if k == 'tod_sel': continue
+                    data[k] = np.array(slots.read(k, idx)).T
+                data['name'] = data['name'].astype(str)
+                data['tod_sel'] = tod_sel
+                data.update(meta)
+                outfile = p.o.pickle_file
                 print("Saving data: %s" % outfile)
                 with open(outfile, 'wb') as f:
                     pkl = pickle.Pickler(f,2)
                     pkl.dump(data)
-            p.comm.Barrier()
-        # merge all splits
-        if p.rank == 0:
-            data_splits = []
-            print("Collecting and removing split data...")
-            for i in range(self.split):
-                infile = p.o.pickle_file+f".{i}"
-                with open(infile, "rb") as f:
-                    data = pickle.load(f)
-                data_splits.append(data)
-                os.remove(infile)
-            data = {}
-            for k in ['name','scan_freq','sel','psel','resp','resp_sel',\
-                      'cal','ctime','alt','pwv','tod_sel']:
-                data[k] = np.hstack([d[k] for d in data_splits])
-            for k in all_keys:
-                data[k] = np.hstack([d[k] for d in data_splits])
-                ksel = f'{k}_sel'
-                data[ksel] = np.hstack([d[ksel] for d in data_splits])
-            # those that only needs one time
-            for k in ['live','dark','ff','ff_sel','stable','tes_sel']:
-                data[k] = data_splits[0][k]
-            outfile = p.o.pickle_file
-            print("Saving data: %s" % outfile)
-            with open(outfile, 'wb') as f:
-                pkl = pickle.Pickler(f,2)
-                pkl.dump(data)
+                del data
+            slots.remove()
+        p.comm.Barrier()
@@ -1,6 +1,7 @@
 """Convert pickle file to h5 file"""
 import os.path as op, h5py, pickle, numpy as np
 from cutslib.util import pickle_load
+from cutslib import mldata
 
 class Module:
     def __init__(self, config):
@@ -9,6 +10,9 @@ class Module:
             randomize: if tods should be chosen randomly
             limit: number of tods to export to h5
             pickle_file_label: if want to use a different pkl file for label
+            layout: columnar (one group per tod with a dataset per feature,
+              see cutslib.mldata) or det (one dataset per det per tod with
+              the features in its attributes)
         """
         self.outdir = config.get("outdir",".")
         self.train_portion = config.getfloat("train_portion", 0.6)
@@ -17,6 +21,7 @@ class Module:
         self.randomize = config.getboolean("randomize", True)
         self.limit = config.getint("limit", None)
         self.pickle_file_label = config.get("pickle_file_label", None)
+        self.layout = config.get("layout", "columnar")
 
     def run(self, p):
         outdir = self.outdir
@@ -59,10 +64,12 @@ class Module:
             obs = obs[:limit]
         nobs = len(obs)
         # find their corresponding indices
-        indices = np.array([data['name'].index(e) for e in obs])
+        name_index = {n: i for i, n in enumerate(data['name'])}
+        indices = np.array([name_index[e] for e in obs], dtype=int)
         if pickle_file_label:
-            indices_label = np.array([data_label['name'].index(e) for \
-                                      e in obs])
+            name_index_label = {n: i for i, n in enumerate(data_label['name'])}
+            indices_label = np.array([name_index_label[e] for e in obs],
+                                     dtype=int)
         # get train,test,validate indices
         train_idx = int(nobs*train_portion)
         validate_idx = train_idx + int(nobs*validate_portion)
@@ -117,6 +124,16 @@ class Module:
                         print(data_label['name'][i_label])
                         import sys;sys.exit(-1)
                 print("TOD: %d/%d"%(ii+1,len(idx)))
+                if self.layout == 'columnar':
+                    features = {k: data[k][dets, i] for k in keys_ptd}
+                    features.update({k: data[k][dets] for k in keys_pd})
+                    if pickle_file_label:
+                        features['label'] = data_label['sel'][dets, i_label]
+                    else:
+                        features['label'] = data['sel'][dets, i]
+                    attrs = {k: data[k][i] for k in keys_pt}
+                    mldata.write_tod(g, data['name'][i], dets, features, attrs)
+                    continue
                 for det_uid in dets:
                     # name of dataset
                     name_ = "%s.%d" % (data['name'][i],det_uid)
@@ -139,3 +156,4 @@ class Module:
                                                              i_label]
                     else:
                         d.attrs['label'] = data['sel'][det_uid, i]
+        hf.close()
@@ -3,14 +3,23 @@ and generate cuts+cal based on its prediction."""
 
 import pickle, os.path as op, numpy as np
 import moby2
+from cutslib import mldata
 
 
 class Module:
     def __init__(self, config):
         self.model_file = config.get("model_file")
         self.tag_out = config.get("tag_out", None)
+        # optionally read the features from a columnar h5 data set
+        # (see cutslib.mldata) instead of the pickle file, the dets
+        # not in the data set are cut
+        self.h5_file = config.get("h5_file", None)
+        self.group = config.get("group", "test")
+        self.batch_size = config.getint("batch_size", 16)
 
     def run(self, p):
+        if self.h5_file:
+            return self.run_h5(p)
         model_file = self.model_file
         tag_out = self.tag_out
         # load pickle file
@@ -62,3 +71,32 @@ class Module:
                 depot = moby2.util.Depot(p.depot)
                 depot.write_object(cuts, tod=tod,
                                    force=True, tag=tag_out)
+
+    def run_h5(self, p):
+        with open(self.model_file, "rb") as f:
+            model = pickle.load(f)
+        if self.tag_out:
+            depot = moby2.util.Depot(p.depot)
+        # each batch of tods is read with one read per feature per tod
+        for tods, rows in mldata.iter_batches(self.h5_file, self.group,
+                                              features=model.features,
+                                              batch_size=self.batch_size):
+            if len(rows) == 0: continue
+            features = np.vstack([rows[k] for k in model.features]).T
+            pred = model.predict(features).astype(bool)
+            for i, obs in enumerate(tods):
+                print("TOD: %s" % obs)
+                m = rows['tod'] == i
+                try:
+                    tod = moby2.scripting.get_tod({'filename': obs,
+                                                   'read_data': False})
+                except IOError as e:
+                    print("Failed to read tod, skipping...")
+                    continue
+                good = np.zeros(len(tod.info.det_uid), dtype=bool)
+                good[rows['det_uid'][m][pred[m]]] = True
+                cuts = moby2.TODCuts.for_tod(tod, assign=False)
+                cuts.set_always_cut(~good)
+                if self.tag_out:
+                    depot.write_object(cuts, tod=tod,
+                                       force=True, tag=self.tag_out)
@@ -0,0 +1,42 @@
+"""This is not a module but a helper for the plotting modules to
+render their independent figures in parallel. The figures are spread
+over the mpi ranks when the module runs with mpi=True, and over a pool
+of local processes with the nproc option of the module section, i.e.
+
+[plot_cal_per_tod]
+nproc=8
+
+Figures are rendered with the non-interactive Agg backend.
+
+"""
+import multiprocessing as mp
+
+# function called by the pool workers, set before they are forked so
+# that it doesn't need to be pickled
+_func = None
+
+def _call(task):
+    return _func(task)
+
+def pmap(p, func, tasks):
+    """Call func(task) for every task, where each task saves its own
+    figures. The tasks are divided among the ranks if the module runs
+    on all of them (p.mod_mpi), then among p.nproc local processes."""
+    global _func
+    import matplotlib.pyplot as plt
+    plt.switch_backend('Agg')
+    tasks = list(tasks)
+    use_mpi = getattr(p, 'mod_mpi', False) and p.size > 1
+    if use_mpi:
+        tasks = tasks[p.rank::p.size]
+    nproc = min(getattr(p, 'nproc', 1), len(tasks))
+    if nproc <= 1:
+        for task in tasks: func(task)
+    else:
+        _func = func
+        try:
+            with mp.get_context('fork').Pool(nproc) as pool:
+                pool.map(_call, tasks, chunksize=1)
+        finally:
+            _func = None
+    if use_mpi: p.comm.Barrier()
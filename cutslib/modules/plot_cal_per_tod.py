@@ -3,6 +3,7 @@ import pickle as pickle
 import numpy as np
 import moby2
 from cutslib import visual as v
+from cutslib.modules.parallel import pmap
 
 class Module:
     def __init__(self, config):
@@ -17,7 +18,7 @@ class Module:
 
         resp = np.ma.array(data['resp'], mask=~data['sel'].astype(bool))
         gain = np.ma.array(data['gainLive'], mask=~data['sel'].astype(bool))
-        for i in range(len(data['name'])):
+        def plot(i):
             outfile = p.o.cal.resp+"/{}_resp.png".format(data['name'][i])
             print("Saving plot: %s" % outfile)
             v.array_plots(resp[dets,i], dets, season=p.i.season,
@@ -29,3 +30,4 @@ class Module:
             v.array_plots((1./gain)[dets,i], dets, season=p.i.season,
                          array=p.i.ar, title=data['name'][i] + " gainLive^-1",
                          pmin=1e-10, display='save', save_name=outfile)
+        pmap(p, plot, range(len(data['name'])))
@@ -10,6 +10,7 @@ import moby2
 import pandas as pd
 from cutslib.visual import array_plots
 from cutslib import Catalog
+from cutslib.modules.parallel import pmap
 
 class Module:
     def __init__(self, config):
@@ -26,7 +27,7 @@ class Module:
         min_samples = self.min_samples
         use_sel = self.use_sel
         pmin = self.pmin
-        pmax = self.pax
+        pmax = self.pmax
 
         # load parameters
         params = moby2.util.MobyDict.from_file(p.i.cutparam)
@@ -51,25 +52,32 @@ class Module:
         lbins = np.arange(nbins+1)
         lbins_l = lbins[:-1]
         lbins_h = lbins[1:]
-        # produce flatfield for each bin
-        for i in range(nbins):
+        def stats(i):
             # get bin edges
             bin_l, bin_h = lbins_l[i], lbins_h[i]
             # get list of tods inside this bin
             tod_sel = (loadings >= bin_l) * (loadings < bin_h)
-            m, s = getArrayStats(gains, sel, tod_sel, use_sel, gain_limit,
+            return getArrayStats(gains, sel, tod_sel, use_sel, gain_limit,
                                  min_samples, sigmas)
-            # set color range
+        # set color range: unset limits are taken from the first bin
+        # and shared by all bins so the plots stay comparable
+        if not pmin or not pmax:
+            m, s = stats(0)
             if not pmin:
                 pmin = m.min()
             if not pmax:
                 pmax = m.max()
+        # produce flatfield for each bin
+        def plot(i):
+            bin_l, bin_h = lbins_l[i], lbins_h[i]
+            m, s = stats(i)
             # plot flatfield on the array and save figure
             outfile = op.join(p.o.ff, "ff_binned_%d.png" % i)
             print("Saving plot: %s" % outfile)
             array_plots(m[det_uid],det_uid,season=p.i.season,array=p.i.ar,fr=p.i.freq,
                         pmin=pmin,pmax=pmax,display='save',save_name=outfile,
                         title="Flatfield: loading bin [%.1f,%.1f)" % (bin_l,bin_h))
+        pmap(p, plot, range(nbins))
 
 ####################
 # utility function #
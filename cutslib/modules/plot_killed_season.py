@@ -3,6 +3,7 @@ that shows how many detectors pass each cut criteria as a function
 of time."""
 
 from cutslib.pathologyReport import pathoReport
+from cutslib.modules.parallel import pmap
 
 class Module:
     def __init__(self, config):
@@ -23,10 +24,11 @@ class Module:
                        'normLive', 'darkRatioLive', 'MFELive',
                        'gainLive', 'DELive', 'jumpLive']
 
-        for target in targets:
+        def plot(target):
             outfile = p.o.patho.season.root+"/%s.png" % target
             print("Saving plot: %s" % outfile)
             try:
                 pr.seasonplot(crit=target, filename=outfile)
             except KeyError:
                 print("Key %s not found!" % target)
+        pmap(p, plot, targets)
@@ -5,6 +5,7 @@ import numpy as np
 import pickle
 import pandas as pd
 from cutslib import visual as v
+from cutslib.modules.parallel import pmap
 
 class Module:
     def __init__(self, config):
@@ -74,7 +75,7 @@ class Module:
 
         sel = array_data['nom_freq'] == int(proj.i.freq)
         peak_masked = np.ma.masked_equal(peak_DAC*cal,0)[:]
-        for i in range(peak_masked.shape[1]):
+        def plot_cal(i):
             outfile = proj.o.cal.array+'/{}_{}.png'.format(df.tods.iloc[i], tag_calib)
             print("Saving plot: %s" % outfile)
             peak = peak_masked[:,i]
@@ -86,6 +87,7 @@ class Module:
                 title = '{} - {}'.format(df.tods.iloc[i], tag_calib),
                 display='save',
                 save_name=outfile)
+        pmap(proj, plot_cal, range(peak_masked.shape[1]))
 
         sa_dict = moby2.util.MobyDict.from_file("/home/yguan/work/cuts_analysis/data/pa4_s16_f150_solid_angles.dict")
         sa_det_uid = np.array(sa_dict['det_uid']).astype(int)
@@ -96,7 +98,7 @@ class Module:
         sa_sel[sa_det_uid] = True
         sel = np.logical_and(sa_sel, sel)
         peak_masked = np.ma.masked_equal(peak_DAC,0)[:]
-        for i in range(len(df.index)):
+        def plot_peak(i):
             outfile = proj.o.cal.peak+"/{}_peak_corrected.png".format(df.tods.iloc[i])
             peak = peak_masked[:,i]
             peak[sa_sel] *= sa_cal
@@ -106,3 +108,4 @@ class Module:
                           title=df.tods.iloc[i] + " peak_DAC (uncalibrated) - %s"
                           % tag_calib, pmin=1e-10, display='save',
                           save_name=outfile)
+        pmap(proj, plot_peak, range(len(df.index)))
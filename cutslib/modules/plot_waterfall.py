@@ -5,6 +5,7 @@ Example config
 --------------
 [waterfall]
 mpi=True
+nproc=1
 tod_list = tod.txt
 fmin = 0.01
 outdir = plots/ar7
@@ -22,6 +23,7 @@ from cutslib import analysis as ana
 import moby2
 from moby2.util.database import TODList
 from cutslib.load import quick_transform
+from cutslib.modules.parallel import pmap
 
 def cov_frange(fsw, sel, fmin, fmax, n_deproj=0, plot=True, vmin=-1, vmax=1):
     freq = fsw.matfreqs
@@ -71,7 +73,7 @@ class Module:
         p.comm.Barrier()
         # load tod
         todnames = TODList.from_file(tod_list)
-        for tn in todnames[p.rank:len(todnames):p.size]:
+        def plot(tn):
             print(f"{p.rank}: {tn}")
             # create directory
             tod_dir = op.join(outdir, op.basename(tn))
@@ -130,4 +132,6 @@ class Module:
                 outfile = op.join(tod_dir, 'fft.png')
                 plt.savefig(outfile)
                 plt.close()
+        # the tods are divided among the ranks and the local processes
+        pmap(p, plot, todnames)
         p.comm.Barrier()
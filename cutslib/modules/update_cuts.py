@@ -5,7 +5,7 @@ run"""
 import os.path as op, os
 import moby2
 from cutslib import TODList
-from cutslib.pathologies_tools import reportPathologies
+from cutslib.pathologies_tools import reportPathologies, pathoList
 import traceback
 
 class Module:
@@ -24,7 +24,7 @@ class Module:
         obsnames = TODList.from_file(source_scans)
         # remove existing obs in the db files
         if op.exists(p.i.db):
-            completed = TODList.from_file(p.i.db)
+            completed = TODList(pathoList(p.i.db).data['todName'])
             print(f"Remove {len(completed)} completed TODs from the list")
             obsnames -= completed
         # initialize reportPathologies object to collect results
@@ -9,9 +9,16 @@ from __future__ import print_function
 import sys, os, traceback
 
 class FakeCommunicator:
+    """Single rank stand-in for a communicator, the collectives are
+    no-ops so that mpi code paths also run without mpi4py"""
     def __init__(self):
         self.size = 1
         self.rank = 0
+    def Barrier(self): pass
+    def barrier(self): pass
+    def bcast(self, obj, root=0): return obj
+    def gather(self, obj, root=0): return [obj]
+    def allgather(self, obj): return [obj]
 
 FAKE_WORLD = FakeCommunicator()
 COMM_WORLD = FAKE_WORLD
@@ -24,3 +31,62 @@ try:
         disabled = False
 except:
     pass
+
+class TaskQueue:
+    """Hand out task indices on demand through a counter shared by all
+    ranks of a communicator. Each call of next returns a task that no
+    other rank has received, so fast ranks keep pulling work while slow
+    ones are busy instead of waiting on a fixed share. The counter lives
+    in a one-sided window on rank 0, hence no rank has to be dedicated
+    to serving tasks. With a FakeCommunicator (or a single rank) the
+    queue is a plain local counter.
+
+    Args:
+        tasks: list of tasks to hand out, the order is kept
+        comm: communicator (default: COMM_WORLD)
+
+    Example:
+        >>> for task in TaskQueue(tasks):
+        ...     process(task)
+    """
+    def __init__(self, tasks, comm=None):
+        import numpy as np
+        self.tasks = list(tasks)
+        self.comm = comm if comm is not None else COMM_WORLD
+        self.win = None
+        self._count = 0
+        if self.comm.size > 1:
+            nbytes = 8 if self.comm.rank == 0 else 0
+            self.win = Win.Allocate(nbytes, 8, comm=self.comm)
+            # allocated memory is not guaranteed to be zeroed
+            if self.comm.rank == 0:
+                self.win.Lock(0)
+                self.win.Put(np.zeros(1, dtype='i8'), 0)
+                self.win.Unlock(0)
+            self.comm.Barrier()
+    def next_index(self):
+        """Claim the next task and return its index in the task list,
+        or None if all tasks have been handed out"""
+        import numpy as np
+        if self.win is None:
+            i = self._count
+            self._count += 1
+        else:
+            one, res = np.ones(1, dtype='i8'), np.zeros(1, dtype='i8')
+            self.win.Lock(0)
+            self.win.Fetch_and_op(one, res, 0, 0, SUM)
+            self.win.Unlock(0)
+            i = int(res[0])
+        if i >= len(self.tasks): return None
+        return i
+    def __iter__(self):
+        while True:
+            i = self.next_index()
+            if i is None: break
+            yield self.tasks[i]
+    def free(self):
+        """Release the shared window, this is collective"""
+        if self.win is not None:
+            self.comm.Barrier()
+            self.win.Free()
+            self.win = None
@@ -3,7 +3,7 @@ from __future__ import absolute_import
 from __future__ import division
 from past.builtins import basestring
 
-import numpy as np, time, pickle, os, matplotlib
+import numpy as np, time, pickle, os, matplotlib, h5py
 import scipy.stats as stat, scipy
 
 pylab = None
@@ -21,6 +21,8 @@ from moby2.scripting import products
 from scipy.cluster.vq import kmeans2
 
 from cutslib.tools import *
+from cutslib import fft
+from cutslib.calibration import get_flatfield, get_responsivity
 
 
 class Pathologies( object ):
@@ -31,6 +33,12 @@ class Pathologies( object ):
     """
     # Depot support
     _depot_structure = '{class}/{tag}/{first_five}/{tod_name}.pickle'
+    # format used by writeToPath: 'hdf5' or 'pickle' (the file name is
+    # kept for both and readFromPath recognizes either)
+    file_format = 'hdf5'
+    # large intermediate products that are not needed to remake selections,
+    # readers that only need the criteria can skip them
+    bulky_keys = ['dsCM', 'dsCM_dt', 'dsDCM', 'res', 'multiFreqData']
 
 
     def __init__(self, tod, params, calibrated=False, calibratedTOD=False, noExclude=True):
@@ -272,7 +280,7 @@ class Pathologies( object ):
         self.crit[key] = {"sel": selection, "apply": apply, "proc": False}
         if apply: self.activeLiveKeys.append(key)
 
-    def findPathologies(self, retrend=False, verbose=False):
+    def findPathologies(self, retrend=False, verbose=False, pool=None):
         """
         @brief Finds the common mode for both live and dark detectors and calculates the
         standard deviation of the detectors around the common modes, normalized by their
@@ -283,10 +291,14 @@ class Pathologies( object ):
         @param  kneeHardLimit Maximum allowable 1/f knee frequency.
         @param  retrend       Retrend TOD after analysis
         @param  verbose       Show resulting number of selected detectors
+        @param  pool          BufferPool to borrow the fourier transform
+                              buffer from (see todloop.BufferPool)
         """
         assert self.tod.data is not None
         tictic = time.time()
         par = self.params['findPathoParams']
+        # process the detectors in blocks of detBlock to bound the memory
+        block = par.get("detBlock", 0)
 
         # ANALYZE SCAN
         self.scan = analyzeScan(np.unwrap(self.tod.az), self.sampleTime,
@@ -308,11 +320,11 @@ class Pathologies( object ):
 
         # GET CANDIDATE DETECTORS
         fullRMSlim = par.get("fullRMSlim",1e8)
-        self.fullRMSsel = np.std(self.tod.data,axis=1) < fullRMSlim
+        self.fullRMSsel = blocked_std(self.tod.data, block) < fullRMSlim
         live = self.liveCandidates * ~self.zeroSel * self.fullRMSsel
         dark = self.origDark * ~self.zeroSel * self.fullRMSsel
 
-        # Calibrate TOD to pW
+        # Calibrate TOD to pW (in place)
         tic = time.time(); psLib.trace('moby', 2, "Calibrating")
         self.calibrate2pW()
         resp = self.calData["resp"]; ff = self.calData["ff"]
@@ -334,9 +346,18 @@ class Pathologies( object ):
             self.crit["ampLive"]["values"] = self.tod.data.max(axis=1) - self.tod.data.min(axis=1)
 
         # FREQUENCY SPACE ANALYSIS
+        # the tod data is float32, it's promoted to double precision for
+        # the fourier analysis unless singlePrecision is set
+        dtype = np.float32 if par.get("singlePrecision", False) else np.float64
+        # the detrending is in place, and with detBlock the padded fft
+        # input is the size of a block of detectors
         trend = moby2.tod.detrend_tod(self.tod)
         nf = nextregular(self.tod.nsamps)
-        fdata = np.fft.rfft(self.tod.data, nf)
+        ft = None
+        if pool is not None:
+            ft = pool.empty((self.tod.data.shape[0], nf//2+1),
+                            np.result_type(dtype, np.complex64), alloc=fft.empty)
+        fdata = fft.tod_rfft(self.tod.data, nf, ft=ft, dtype=dtype, block=block)
         dt = (self.tod.ctime[-1]-self.tod.ctime[0])/(self.tod.nsamps-1)
         df = 1./(dt*nf)
 
@@ -488,6 +509,8 @@ class Pathologies( object ):
         toctoc = time.time()
         dtime = (toctoc-tictic)/60
         psLib.trace('moby', 1, "It took %4.3f minutes to find pathologies." % dtime)
+        psLib.trace('moby', 1, "Peak memory %.0f MB (tod data %.0f MB, spectrum %.0f MB)" %
+                    (peak_rss(), self.tod.data.nbytes/2.**20, fdata.nbytes/2.**20))
         return 0
 
 
@@ -621,34 +644,31 @@ class Pathologies( object ):
         if flatfield is None:
             flatfield = self.params["calibration"]["flatfield"]
         # Get responsivity
-        resp = products.get_calibration(self.params["calibration"]["config"], self.tod.info)
-        respSel = (resp.cal != 0.0)
+        resp = get_responsivity(self.params["calibration"]["config"], self.tod.info)
+        respSel = (resp != 0.0)
         # Get flatfield
-        if '.dict' in flatfield:
-            self.flatfield_object = moby2.detectors.RelCal.from_dict(flatfield)
-        elif '.fits' in flatfield:
-            self.flatfield_object = moby2.detectors.RelCal.from_fits_table(flatfield)
+        self.flatfield_object = get_flatfield(flatfield)
         ffSel, ff = self.flatfield_object.get_property('cal', det_uid=self.dets, default=1.)
         # Default resposibity to median of stable detectors
         _, stable = self.flatfield_object.get_property('stable', det_uid = self.dets, default=False)
         # make sure stable has the right type
         stable = stable.astype(bool)
         if self.params["calibration"].get("forceNoResp",False):
-            rm = np.median(resp.cal[stable*respSel])
-            resp.cal[~respSel] = rm
+            rm = np.median(resp[stable*respSel])
+            resp[~respSel] = rm
         if self.flatfield_object.calRMS is not None:
             _, ffRMS = self.flatfield_object.get_property(
                 'calRMS', det_uid = self.dets, default=1.)
         else:
             ffRMS = np.zeros_like(self.dets)
-        self.calData = {"resp": resp.cal,
+        self.calData = {"resp": resp,
                         "ff": ff,
                         "ffRMS": ffRMS,
                         "ffSel": ffSel,
                         "respSel": respSel,
                         "calSel": ffSel*respSel,
                         "stable": stable}
-        return resp.cal, ff, ffRMS, respSel, ffSel, stable
+        return resp, ff, ffRMS, respSel, ffSel, stable
 
     def calibrate2pW(self, flatfield=None, full=False):
         """
@@ -1065,11 +1085,17 @@ class Pathologies( object ):
         else:                      psLib.trace('moby', 0, '        zeroSel: live')
 
 
-    def writeToPath(self, path):
+    def writeToPath(self, path, format=None):
         """
         @brief Stores the pathologies object in Path.
         @param  path   directory path where to store the data object.
+        @param  format 'hdf5' or 'pickle', defaults to self.file_format.
+                       In hdf5 each criterion is a group with one dataset per
+                       array, so that they can be read selectively.
         """
+        if format is None: format = self.file_format
+        if format not in ['hdf5', 'pickle']:
+            raise ValueError("Unknown pathologies format: %s" % format)
         # Remove TOD from pathologies object
 
         tod = self.tod
@@ -1080,29 +1106,50 @@ class Pathologies( object ):
         if path[-1] == '/':
             path = path[0:-1]
         # filename = "%s.pickle" % path
-        f = open( path, 'wb' )
-        p = pickle.Pickler( f, 2 )
-        p.dump( data )
-        f.close()
+        if format == 'hdf5':
+            with h5py.File(path, 'w') as f:
+                f.attrs['_format'] = 'pathologies'
+                _write_h5_group(f, data)
+        else:
+            f = open( path, 'wb' )
+            p = pickle.Pickler( f, 2 )
+            p.dump( data )
+            f.close()
 
         self.tod = tod
         del tod
 
     @staticmethod
-    def readFromPath(path, tod=None, params=None):
+    def readFromPath(path, tod=None, params=None, crit=None, skip=None):
         """
-        @brief  Reloads a stored pathologies object.
+        @brief  Reloads a stored pathologies object (hdf5 or pickle).
         @param  path   Path to the directory where the data is stored.
         @param  tod    TOD that corresponds to the object you want to read.
+        @param  crit   List of the criteria to read (i.e. ['gainLive']), the
+                       others are left empty. All criteria are read if None.
+        @param  skip   List of other attributes not to read, i.e.
+                       Pathologies.bulky_keys.
         @return pa     Pathologies object with the data read.
         """
         if path[-1] == '/':
             path = path[0:-1]
-        with open( path, 'rb' ) as f:
-            try:
-                data = pickle.load(f)
-            except UnicodeDecodeError as e:
-                data = pickle.load(f, encoding='latin1')
+        skip = [] if skip is None else list(skip)
+        if h5py.is_hdf5(path):
+            with h5py.File(path, 'r') as f:
+                data = _read_h5_group(f, skip=skip+['crit'])
+                data['crit'] = {}
+                for k in f['crit']:
+                    if crit is None or k in crit:
+                        data['crit'][k] = _read_h5_group(f['crit'][k])
+        else:
+            with open( path, 'rb' ) as f:
+                try:
+                    data = pickle.load(f)
+                except UnicodeDecodeError as e:
+                    data = pickle.load(f, encoding='latin1')
+            for k in skip: data.pop(k, None)
+            if crit is not None and 'crit' in data:
+                data['crit'] = {k: v for k, v in data['crit'].items() if k in crit}
         if "todName" in data:
             old = True
             todName = data.get("todName")
@@ -1111,7 +1158,7 @@ class Pathologies( object ):
             todName = data.get("name")
         assert tod.info.basename == todName, \
             "ERROR: TOD %s and stored name %s don't match" % \
-            ( tod.info.name, data['todName'] )
+            ( tod.info.name, todName )
         if params is None: params = data.get('params')
         else: data["params"] = params
         pa = Pathologies( tod, params )
@@ -1124,12 +1171,52 @@ class Pathologies( object ):
 
 
     @classmethod
-    def read_from_path(cls, filename, tod=None, params = None):
-        return cls.readFromPath(filename, tod, params)
+    def read_from_path(cls, filename, tod=None, params = None, crit=None,
+                       skip=None):
+        return cls.readFromPath(filename, tod, params, crit=crit, skip=skip)
 
     write_to_path = writeToPath
 
 
+def _write_h5_group(group, data):
+    """
+    @brief Store a dictionary in an hdf5 group. Dictionaries become sub-groups
+    and numerical arrays datasets, anything else is pickled and stored as an
+    attribute (or as a dataset when it is too large for one).
+    """
+    for k, v in data.items():
+        if type(v) is dict and all(isinstance(kk, str) and '/' not in kk
+                                   for kk in v):
+            _write_h5_group(group.create_group(k), v)
+        elif isinstance(v, np.ndarray) and v.dtype.kind in 'biufc':
+            group.create_dataset(k, data=v)
+        else:
+            b = np.void(pickle.dumps(v, 2))
+            if b.nbytes < 32768:
+                group.attrs[k] = b
+            else:
+                group.create_dataset(k, data=b).attrs['pickled'] = True
+
+def _read_h5_group(group, skip=()):
+    """
+    @brief Read back a dictionary stored by _write_h5_group, leaving out
+    the keys in skip.
+    """
+    data = {}
+    for k, v in group.attrs.items():
+        if k == '_format' or k in skip: continue
+        data[k] = pickle.loads(v.tobytes())
+    for k in group:
+        if k in skip: continue
+        v = group[k]
+        if isinstance(v, h5py.Group):
+            data[k] = _read_h5_group(v)
+        elif v.attrs.get('pickled', False):
+            data[k] = pickle.loads(v[()].tobytes())
+        else:
+            data[k] = v[()]
+    return data
+
 def selectBySigma(data, preSelection, thrld):
     """
     @brief  Select the detectors that fall inside a normal distribution within a given standard deviation from the mean. The distribution mean and
@@ -1354,10 +1441,19 @@ def multiFreqCorrAnal(fdata, sel, df, nf, nsamps, scan_freq, par, parTag,
     fcm=[]; cm=[]; cmdt=[];
     fcmi=None; cmi = None; cmdti=None
     minFreqElem = 16
+    windows = []
     for i in range(Nwin):
         n_l = int(round((fmin + i*fshift)/df))
         n_h = int(round((fmin + i*fshift + band)/df))
         if n_h - n_l < minFreqElem: n_h = n_l+minFreqElem
+        windows.append((n_l, n_h))
+    # without taper or dark modes the correlation matrices of all windows
+    # are computed in a single pass over the fourier coefficients
+    shared = not(par[parTag].get("useTaper",False)) and \
+             not(par[parTag].get("removeDark",False))
+    if shared:
+        cmats = bandCorrelations(fdata, sel, windows, df, scan_freq, par[parTag])
+    for n_l, n_h in windows:
         if par[parTag].get("removeDark",False):
             if darkSel is None:
                 print("ERROR: no dark selection supplied")
@@ -1366,7 +1462,8 @@ def multiFreqCorrAnal(fdata, sel, df, nf, nsamps, scan_freq, par, parTag,
                                             df, nf, nsamps, par, tod)
             fcm.append(fcmi); cm.append(cmi); cmdt.append(cmdti)
         r = lowFreqAnal(fdata, sel, [n_l,n_h], df, nsamps, scan_freq, par.get(parTag,{}),
-                        fcmodes=fcmi, respSel=respSel, flatfield=flatfield)
+                        fcmodes=fcmi, respSel=respSel, flatfield=flatfield,
+                        c=next(cmats) if shared else None)
         psel.append(r["preSel"]); corr.append(r["corr"]); gain.append(np.abs(r["gain"]))
         norm.append(r["norm"]); darkRatio.append(r["ratio"])
         if full: all_data.append(r)
@@ -1408,6 +1505,44 @@ def multiFreqCorrAnal(fdata, sel, df, nf, nsamps, scan_freq, par, parTag,
     return res
 
 
+def bandCorrelations(fdata, sel, windows, df, scan_freq, par, refresh=3):
+    """
+    @brief Generate the correlation matrices (X X^H) of the selected detectors
+           for a list of frequency windows, as used by lowFreqAnal. The windows
+           of multiFreqCorrAnal slide with a fixed shift and overlap, so each
+           matrix is obtained from the previous one by removing the product of
+           the frequencies that left the window and adding those that entered.
+           Every coefficient is then multiplied in at most twice, instead of
+           once per window that contains it. Windows that do not overlap the
+           previous one are computed from scratch. Scan synchronous harmonics
+           are removed as in lowFreqAnal, taper and dark modes are not supported.
+    @param refresh  number of incremental updates after which the matrix is
+           recomputed from scratch. The rounding errors of the updates add up
+           and are largest for steep (1/f) spectra, where the power that leaves
+           the window dominates. With 3 the error stays around 1e-14 relative
+           to the largest element.
+    """
+    lo = min(w[0] for w in windows)
+    hi = max(w[1] for w in windows)
+    data = fdata[sel,lo:hi].copy()
+    # Scan frequency rejection, the harmonics are the same in all windows
+    if par.get("cancelSync",False) and (scan_freq/df > 7):
+        i_harm = get_iharm([lo,hi], df, scan_freq, wide = par.get("wide",True))
+        data[:,i_harm] = 0.0
+    prod = lambda a, b: np.dot(data[:,a-lo:b-lo], data[:,a-lo:b-lo].T.conjugate())
+    c = None
+    for n_l, n_h in windows:
+        if c is None or n_l < p_l or n_h < p_h or n_l >= p_h or k >= refresh:
+            c = prod(n_l, n_h)
+            k = 0
+        else:
+            if n_l > p_l: c -= prod(p_l, n_l)
+            if n_h > p_h: c += prod(p_h, n_h)
+            k += 1
+        p_l, p_h = n_l, n_h
+        yield c.copy()
+
+
 def getDarkModes(fdata, darkSel, frange, df, nf, nsamps, par, tod=None):
     """
     @brief Get dark or thermal modes from dark detectors and thermometer
@@ -1430,7 +1565,7 @@ def getDarkModes(fdata, darkSel, frange, df, nf, nsamps, par, tod=None):
                 thermometers.append(thermometer)
         if len(thermometers) > 0:
             thermometers = np.array(thermometers)
-            fth = np.fft.rfft( thermometers, nf )[:,n_l:n_h]
+            fth = fft.tod_rfft( thermometers, nf )[:,n_l:n_h]
             fc_inputs.extend(list(fth))
     elif par["darkModesParams"].get("useTherm", False) and tod is None:
             print("WARNING: TOD requiered to obtain thermometer data")
@@ -1443,9 +1578,15 @@ def getDarkModes(fdata, darkSel, frange, df, nf, nsamps, par, tod=None):
     # Obtain main svd modes to deproject from data
     if par["darkModesParams"].get("useSVD",False):
         Nmodes = par["darkModesParams"].get("Nmodes",None)
-        u, s, v = scipy.linalg.svd( fc_inputs, full_matrices=False )
-        if Nmodes is None: fcmodes = v[s > s.max()/10]
-        else: fcmodes = v[:Nmodes]
+        if Nmodes is None:
+            u, s, v = scipy.linalg.svd( fc_inputs, full_matrices=False )
+            fcmodes = v[s > s.max()/10]
+        else:
+            # only the leading modes are needed
+            w, u = get_top_modes(np.dot(fc_inputs, fc_inputs.T.conjugate()),
+                                 min(Nmodes, len(fc_inputs)))
+            fcmodes = np.dot(u.T.conjugate(), fc_inputs) / \
+                      np.sqrt(np.maximum(w, 0.))[:,np.newaxis]
     else:
         fcmodes = fc_inputs
 
@@ -1457,9 +1598,12 @@ def getDarkModes(fdata, darkSel, frange, df, nf, nsamps, par, tod=None):
 
 
 def lowFreqAnal(fdata, sel, frange, df, nsamps, scan_freq, par,
-                fcmodes=None, respSel=None, flatfield=None):
+                fcmodes=None, respSel=None, flatfield=None, c=None):
     """
     @brief Find correlations and gains to the main common mode over a frequency range
+    @param c  precomputed correlation matrix of the selected detectors in the
+              frequency range (see bandCorrelations), only used without taper
+              and dark modes
     """
     # this has shape (nsel, nfreq)
     lf_data = fdata[sel,frange[0]:frange[1]].copy()
@@ -1502,8 +1646,9 @@ def lowFreqAnal(fdata, sel, frange, df, nsamps, scan_freq, par,
 
     # Get correlation matrix
     # shape is (nsel, nsel)
-    c = np.dot(lf_data,lf_data.T.conjugate())
-    a = np.linalg.norm(lf_data,axis=1)
+    if c is None or fcmodes is not None or par.get("useTaper",False):
+        c = np.dot(lf_data,lf_data.T.conjugate())
+    a = np.sqrt(np.abs(np.diag(c)))
     aa = np.outer(a,a)
     aa[aa==0.] = 1.
     cc = c/aa
@@ -1565,22 +1710,29 @@ def lowFreqAnal(fdata, sel, frange, df, nsamps, scan_freq, par,
     preSel[sel] = sl
 
     # Apply gain ratio in case of multichroic
+    csl = c[sl][:,sl]
     if (flatfield is not None) and ("scale" in flatfield.fields):
         scl = flatfield.get_property("scale",det_uid=np.where(sel)[0],
                                      default = 1.)
         lf_data *= np.repeat([scl],lf_data.shape[1],axis=0).T
-
-    # Get common mode using the pre-selected data
-    u, s, v = scipy.linalg.svd( lf_data[sl], full_matrices=False )
-    cm = v[0]
+        scl = np.broadcast_to(scl, sl.shape)[sl]
+        csl = csl * np.outer(scl, scl)
+
+    # Get common mode using the pre-selected data: the leading eigenvector
+    # of their correlation matrix is the first left singular vector of
+    # their data, which gives the first right singular vector (the common
+    # mode) without a full svd
+    w, u = get_top_modes(csl, 1)
+    s0 = np.sqrt(max(w[0], 0.))
+    cm = np.dot(u[:,0].conj(), lf_data[sl]) / s0
     # Get gain for all data (not limited to pre-selected data)
     gain = np.zeros(ndet)
-    gain[sel] = np.abs(np.dot(lf_data, np.conjugate(cm)))/s[0]
+    gain[sel] = np.abs(np.dot(lf_data, np.conjugate(cm)))/s0
     # Get correlations
-    # note that the s[0] here is from the pre-selected data which
-    # might be different to the actual s[0] using un-preseleected data
+    # note that the s0 here is from the pre-selected data which
+    # might be different to the actual s0 using un-preseleected data
     corr = np.zeros(ndet)
-    corr[sel] = gain[sel] * s[0] / fnorm
+    corr[sel] = gain[sel] * s0 / fnorm
     # Get Correlations
     # u, s, v = scipy.linalg.svd( lf_data, full_matrices=False )
     # corr = np.zeros(ndet)
@@ -1626,23 +1778,15 @@ def highFreqAnal(fdata, sel, range, nsamps,
     # be calculated here
     if highOrder:
         hfd, _ = get_time_domain_modes(hf_data, 1, nsamps)
-        skewt = stat.skewtest(hfd,axis=1)
-        kurtt = stat.kurtosistest(hfd,axis=1)
+        _, skewt, kurtt = normal_tests(hfd)
         if scanParams is not None:
             T = scanParams["T"]
             pivot = scanParams["pivot"]
             N = scanParams["N"]
             f = hfd.shape[1]/nsamps
             t = int(T*f); p = int(pivot*f)
-            prms = []; pskewt = []; pkurtt = []
-            for c in np.arange(N):
-               # calculating the statistics for each swing (scan chunk)
-               prms.append(hfd[:,c*t+p:(c+1)*t+p].std(axis=1))
-               pskewt.append(stat.skewtest(hfd[:,c*t+p:(c+1)*t+p],axis=1))
-               pkurtt.append(stat.kurtosistest(hfd[:,c*t+p:(c+1)*t+p],axis=1))
-            prms = np.array(prms).T
-            pskewt = np.array(pskewt)
-            pkurtt = np.array(pkurtt)
+            # calculating the statistics for each swing (scan chunk)
+            prms, pskewt, pkurtt = chunk_normal_tests(hfd, t, p, N)
             return (rms, skewt, kurtt, prms, pskewt, pkurtt)
         else:
             return (rms, skewt, kurtt)
@@ -13,9 +13,10 @@ from moby2.util.database import TODList
 from cutslib import pathologies
 import h5py
 from moby2.tod.cuts import CutsVector
+from cutslib.glitch import CutsRanges
 
 
-def get_pathologies(tod, params):
+def get_pathologies(tod, params, crit=None, skip=None):
     cutParams = moby2.util.MobyDict.from_file(params.get("cutParams"))
     pathop = cutParams['pathologyParams']
     depot = moby2.util.Depot(params.get("depot"))
@@ -26,7 +27,8 @@ def get_pathologies(tod, params):
         pa = depot.read_object(pathologies.Pathologies,
                                tag=params.get("tag_patho"),
                                tod=tod,
-                               options={"tod" : tod, "params": pathop},
+                               options={"tod" : tod, "params": pathop,
+                                        "crit": crit, "skip": skip},
                                structure=params.get("structure"))
         return pa
     else:
@@ -44,7 +46,12 @@ class reportPathologies( object ):
         self.params = moby2.util.MobyDict.from_file(params)
         self.cutParams = moby2.util.MobyDict.from_file(self.params.get("cutParams"))
         p = self.params.get
-        self.depot_file = os.path.abspath(os.path.join(p("outdir"),p("report")+".db"))
+        # report format: db (ascii table) or h5 (columnar hdf5)
+        self.format = p("report_format", "db")
+        if self.format not in ["db", "h5"]:
+            raise ValueError("Unknown report format: %s" % self.format)
+        self.depot_file = os.path.abspath(os.path.join(p("outdir"),
+                                                       p("report")+"."+self.format))
 
     def _initializeFiles( self, pa ):
         # ENTRIES FOR STATISTICS REPORT
@@ -81,35 +88,45 @@ class reportPathologies( object ):
             dname = os.path.dirname(rname)
             if not(os.path.isdir(dname)): os.makedirs(dname)
 
-            hd1 = '# todName | '
-            hd2 = '# str | '
-            for k in self.sel_keys:
-                hd1 += k[0] + ' | '
-                hd2 += k[1] + ' | '
-            for k in self.stat_keys:
-                hd1 += '%s_m | %s_s | '%(k[0],k[0])
-                hd2 += '%s | %s | '%(k[1],k[1])
-            hd1 = hd1[:-3] + '\n'
-            hd2 = hd2[:-3] + '\n'
-
             p = self.params.get
             cp = self.cutParams.get
+            hdr = '#\n# Date: %s\n' % time.asctime()
+            hdr += '#\n# tag: %s\n' % p('tag_patho')
+            hdr += '# tag_partial: %s\n' % p('tag_partial')
+            hdr += '#\n# Pathologies parameters:\n'
+            hdr += printDictionary(cp('pathologyParams'), tabLevel = 1,
+                                   prefix = '#', verbose = False )
+            hdr += '#\n# Glitches paramteres:\n'
+            hdr += printDictionary(cp('glitchParams'), tabLevel = 1,
+                                   prefix = '#', verbose = False )
+
+            keys, types = self._columns()
+            if self.format == "h5":
+                header = [l[1:] for l in hdr.splitlines()]
+                writeH5(self.depot_file, keys, types, header)
+                return
+
+            hd1 = '# ' + ' | '.join(keys) + '\n'
+            hd2 = '# ' + ' | '.join(types) + '\n'
             f = open(self.depot_file, 'w')
             f.write('# BEGIN HEADER\n')
-            f.write('#\n# Date: %s\n' % time.asctime())
-            f.write('#\n# tag: %s\n' % p('tag_patho'))
-            f.write('# tag_partial: %s\n' % p('tag_partial'))
-            f.write('#\n# Pathologies parameters:\n')
-            f.write(printDictionary(cp('pathologyParams'), tabLevel = 1,
-                                    prefix = '#', verbose = False ))
-            f.write('#\n# Glitches paramteres:\n')
-            f.write(printDictionary(cp('glitchParams'), tabLevel = 1,
-                                    prefix = '#', verbose = False ))
+            f.write(hdr)
             f.write('# END HEADER\n#\n')
             f.write(hd1)
             f.write(hd2)
             f.close()
 
+    def _columns( self ):
+        """
+        @Brief Names and types of the columns in the report
+        """
+        keys = ['todName'] + [k[0] for k in self.sel_keys]
+        types = ['str'] + [k[1] for k in self.sel_keys]
+        for k in self.stat_keys:
+            keys += ['%s_m'%k[0], '%s_s'%k[0]]
+            types += [k[1], k[1]]
+        return keys, types
+
     def appendResult( self, obs ):
         """
         @Brief Add new entry to both results files.
@@ -142,33 +159,38 @@ class reportPathologies( object ):
         d = c_obj.get_uncut()
         liveDets = len(d)
         frac = 0.0
-        for det in d:
-            frac += np.asarray(c_obj.cuts[det].get_mask(),dtype=int).sum()/ \
-                    c_obj.nsamps/len(d)
+        if liveDets > 0:
+            frac = CutsRanges.from_tod_cuts(c_obj).fraction()[d].mean()
         # GET TOD PARAMETERS
         length = (tod.ctime[-1] - tod.ctime[0])/60 # minutes
         Temp = pa.Temp
         DTemp = pa.dTemp
 
-        # PRINT RESULTS
-        f = open(self.depot_file, 'a')
-        f.write("%s "%tod.info.name)
-        f.write("%8.3g "%length)
-        f.write("%4d "%liveDets)
-        f.write("%8.3g "%frac)
-        f.write("%4d "%darkDets)
-        f.write("%4d "%glitches)
+        # COLLECT RESULTS
+        row = [tod.info.name, length, liveDets, frac, darkDets, glitches]
         for k in self.sel_keys[5:-4]:
-            ndet = np.asarray(pa.crit[k[0]]["sel"]*~pa.origDark, dtype=int).sum()
-            f.write('%4d '%ndet)
-        f.write('%4d '%int(pa.gainCut))
-        f.write('%4d '%int(pa.temperatureCut))
-        if Temp is not None: f.write("%8.3g "%Temp)
-        else: f.write("%8d "%(-1))
-        if DTemp is not None: f.write("%8.3g "%DTemp)
-        else: f.write("%8d "%(-1))
+            row.append(np.asarray(pa.crit[k[0]]["sel"]*~pa.origDark, dtype=int).sum())
+        row.append(int(pa.gainCut))
+        row.append(int(pa.temperatureCut))
+        row.append(Temp if Temp is not None else -1)
+        row.append(DTemp if DTemp is not None else -1)
         for k in self.stat_keys:
-            f.write('%8.3g %8.3g  '%(pa.crit[k[0]]['median'], pa.crit[k[0]]['sigma']))
+            row += [pa.crit[k[0]]['median'], pa.crit[k[0]]['sigma']]
+
+        # PRINT RESULTS
+        if self.format == "h5":
+            keys, _ = self._columns()
+            appendH5(self.depot_file, dict((k, [v]) for k, v in zip(keys, row)))
+            return
+        nsel = len(self.sel_keys)
+        f = open(self.depot_file, 'a')
+        f.write("%s "%row[0])
+        for k, v in zip(self.sel_keys, row[1:nsel+1]):
+            if k[1] == "int": f.write("%4d "%v)
+            else: f.write("%8.3g "%v)
+        stats = row[nsel+1:]
+        for i in range(0, len(stats), 2):
+            f.write('%8.3g %8.3g  '%(stats[i], stats[i+1]))
         f.write('\n')
         f.close()
 
@@ -238,17 +260,18 @@ class reportPathologies( object ):
             c_obj.merge_tod_cuts(az_cuts)
 
         # MERGE DETECTOR CUTS THAT DEPEND ON THE PARTIAL CUTS
+        dets = np.asarray(tod.info.det_uid)
+        cuts_ranges = CutsRanges.from_tod_cuts(c_obj)
         if cutParams.get('maxFraction') is not None:
-            for det in tod.info.det_uid:
-                frac = np.asarray(c_obj.cuts[det].get_mask(),dtype=int).sum()/c_obj.nsamps
-                if frac > cutParams['maxFraction']:
-                    det_cuts.set_always_cut(det)
-                    pa.liveSel[det] = False
+            bad = dets[cuts_ranges.fraction()[dets] > cutParams['maxFraction']]
+            if len(bad) > 0:
+                det_cuts.set_always_cut(bad)
+                pa.liveSel[bad] = False
         if cutParams.get_deep(("glitchParams","maxGlitch")) is not None:
-            for det in tod.info.det_uid:
-                if len(c_obj.cuts[det]) > cutParams["glitchParams"]["maxGlitch"]:
-                    det_cuts.set_always_cut(det)
-                    pa.liveSel[det] = False
+            bad = dets[cuts_ranges.count()[dets] > cutParams["glitchParams"]["maxGlitch"]]
+            if len(bad) > 0:
+                det_cuts.set_always_cut(bad)
+                pa.liveSel[bad] = False
 
         # Load external cuts to include
         include_cuts = cutParams.get_deep(('pathologyParams','include_cuts'))
@@ -318,27 +341,24 @@ class pathoList( object ):
         @param type: "pathoList" or "TODList"
         """
         self.filename = filename
-        if type == "pathoList": reader = readAscii
+        if type == "pathoList": reader = readReport
         elif type == "TODList": reader = readTODList
         else:
             psLib.trace("moby", 0, "ERROR: Unknown file type.")
             return -1
 
-        if isinstance(filename, str):
-            self.data, self.header, self.keys, self.types = reader(filename)
-        else:
-            self.data, self.header, self.keys, self.types = reader(filename[0])
-            if len(filename) > 1:
-                for i in range(1,len(filename)):
-                    d, h, k, t = reader(filename[i])
-                    for k in list(d.keys()): self.data[k] += d[k]
+        if isinstance(filename, str): filename = [filename]
+        results = [reader(f) for f in filename]
+        self.data, self.header, self.keys, self.types = results[0]
+        if len(results) > 1:
+            for k in list(self.data.keys()):
+                self.data[k] = np.concatenate([r[0][k] for r in results])
 
         self.selParams = {}
         self.keys.append("ctime")
         self.types.append("int")
-        self.data['ctime'] = []
-        for name in self.data['todName']:
-            self.data['ctime'].append(int(name.split('/')[-1].split('.')[0]))
+        self.data['ctime'] = [int(name.split('/')[-1].split('.')[0])
+                              for name in self.data['todName']]
         self.ndata = len(self.data['todName'])
         for k in list(self.data.keys()):
             self.data[k] = np.array(self.data[k])
@@ -348,12 +368,10 @@ class pathoList( object ):
         """
         @Brief merge the self pathologies list with an external list keeping only unrepeated elements.
         """
-        tod1 = self.data['todName']
+        new = ~np.isin(pl2.data['todName'], self.data['todName'])
         keys = list(self.data.keys())
-        for i in range(pl2.ndata):
-            if not(np.any(tod1 == pl2.data['todName'][i])):
-                for k in keys:
-                    self.data[k] = np.hstack([self.data[k],pl2.data[k][i]])
+        for k in keys:
+            self.data[k] = np.concatenate([self.data[k], pl2.data[k][new]])
         s = np.argsort(self.data['todName'])
         for k in keys:
             self.data[k] = np.array(self.data[k])[s]
@@ -991,16 +1009,85 @@ def readAscii( filename ):
     ft_output = []
     for i in range(len(names)):
         frmt[names[i].strip()] = {'type':ft[i].strip(), 'column':i}
-        data[names[i].strip()] = []
         names_output.append(names[i].strip())
         ft_output.append(ft[i].strip())
-    for l in f:
-        ll = l.split()
-        for k in list(frmt.keys()):
-            data[k].append(eval(frmt[k]["type"])(ll[frmt[k]["column"]]))
+    rows = [l.split() for l in f if l.strip() and l[0] != '#']
     f.close()
+    # convert one column at a time instead of cell by cell
+    for k in names_output:
+        col = [r[frmt[k]['column']] for r in rows]
+        t = frmt[k]['type']
+        if t in h5_dtypes: data[k] = np.array(col, dtype=str).astype(t)
+        else: data[k] = np.array([eval(t)(c) for c in col])
     return data, header, names_output, ft_output
 
+def readH5( filename ):
+    """
+    @brief Read a report written in the columnar hdf5 format, it returns
+    the same (data, header, keys, types) as readAscii.
+    """
+    with h5py.File(filename, 'r') as f:
+        keys = [k.decode() for k in f.attrs['keys']]
+        types = [t.decode() for t in f.attrs['types']]
+        header = f.attrs['header']
+        if isinstance(header, bytes): header = header.decode()
+        header = header.split('\n') if header else []
+        data = {}
+        for k in keys:
+            data[k] = f[k][()]
+            if data[k].dtype.kind == 'S': data[k] = data[k].astype(str)
+    return data, header, keys, types
+
+def readReport( filename ):
+    """
+    @brief Read a report in either the ascii (.db) or the hdf5 (.h5) format
+    """
+    if h5py.is_hdf5(filename): return readH5(filename)
+    return readAscii(filename)
+
+# storage type of each report column type in the hdf5 format
+h5_dtypes = {'str': 'S64', 'int': 'i8', 'float': 'f8'}
+
+def writeH5( filename, keys, types, header=[] ):
+    """
+    @brief Create an empty report in the columnar hdf5 format. Each column
+    is stored as a resizable dataset so that rows can be appended cheaply.
+    """
+    with h5py.File(filename, 'w') as f:
+        f.attrs['keys'] = np.array(keys, dtype='S')
+        f.attrs['types'] = np.array(types, dtype='S')
+        f.attrs['header'] = '\n'.join(header)
+        for k, t in zip(keys, types):
+            f.create_dataset(k, shape=(0,), maxshape=(None,), chunks=(1024,),
+                             dtype=h5_dtypes.get(t, 'S64'))
+
+def appendH5( filename, data ):
+    """
+    @brief Append rows to a report in the hdf5 format
+    @param data  dictionary with a sequence of values for each column
+    """
+    with h5py.File(filename, 'a') as f:
+        keys = [k.decode() for k in f.attrs['keys']]
+        n = f[keys[0]].shape[0]
+        m = len(data[keys[0]])
+        for k in keys:
+            v = np.asarray(data[k])
+            if f[k].dtype.kind == 'S': v = np.char.encode(v.astype(str))
+            f[k].resize((n+m,))
+            f[k][n:] = v
+
+def convertAscii( filename, outfile=None ):
+    """
+    @brief Convert a report from the ascii (.db) format to the hdf5 format
+    @param outfile  output file (default: filename with .db replaced by .h5)
+    """
+    if outfile is None:
+        outfile = os.path.splitext(filename)[0] + ".h5"
+    data, header, keys, types = readAscii(filename)
+    writeH5(outfile, keys, types, header)
+    appendH5(outfile, data)
+    return outfile
+
 def getdtype(st):
     s1 = st.split("-")
     if (len(s1) == 1) or (s1[0] == ""):
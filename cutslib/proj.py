@@ -88,6 +88,9 @@ def init_post(cutparam, output_dir=None):
     i.pickle_file = o.pickle_file
     i.run_dir = op.join(i.root, "run_" + i.version)
     i.db = op.join(i.run_dir, tag + ".db")
+    # prefer the columnar report if it exists
+    if op.exists(op.join(i.run_dir, tag + ".h5")):
+        i.db = op.join(i.run_dir, tag + ".h5")
     # export for reporting
     e = DotMap()
     e.root = mkdir(root+'/report')
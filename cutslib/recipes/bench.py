@@ -0,0 +1,71 @@
+"""Benchmark recipes, see cutslib.bench"""
+
+def run(ndet=1000, nsamps=2**17, repeat=1):
+    """Time the stages of the pipeline on a synthetic TOD
+    Example:
+        cuts bench run 1000 131072
+    """
+    from cutslib import bench
+    tod = bench.make_tod(ndet=int(ndet), nsamps=int(nsamps))
+    res = bench.run_stages(tod, repeat=int(repeat))
+    print(f"ndet = {ndet}, nsamps = {nsamps}")
+    bench.print_results(res)
+
+def scaling(key="ndet", *values):
+    """Time the stages for a list of ndet or nsamps and report the
+    scaling with it. The other dimension takes its make_tod default.
+    Example:
+        cuts bench scaling ndet 250 500 1000 2000
+        cuts bench scaling nsamps 32768 65536 131072
+    """
+    from cutslib import bench
+    if len(values) == 0:
+        values = [250, 500, 1000] if key == "ndet" else [2**15, 2**16, 2**17]
+    values = [int(v) for v in values]
+    res = bench.scaling(key, values)
+    bench.print_results(res, values, key)
+
+def precision(ndet=500, nsamps=2**16):
+    """Compare the pathology statistics computed in single and double
+    precision on a synthetic TOD
+    Example:
+        cuts bench precision 500 65536
+    """
+    from cutslib import bench
+    res = bench.compare_precision(ndet=int(ndet), nsamps=int(nsamps))
+    dets = res.pop('dets')
+    print(f"ndet = {ndet}, nsamps = {nsamps}, {len(dets)} dets preselected in both")
+    for k, v in res.items():
+        if k == 'preSel': print("%-8s %.2e (fraction of live dets changed)" % (k, v))
+        else: print("%-8s %.2e (max diff / rms)" % (k, v))
+
+def memory(ndet=1000, nsamps=2**17, block=128):
+    """Peak memory of the rms and fourier transform of the pathologies,
+    at once and in blocks of detectors (detBlock), in both precisions
+    Example:
+        cuts bench memory 1000 131072 128
+    """
+    import numpy as np
+    from cutslib import bench
+    print(f"ndet = {ndet}, nsamps = {nsamps}")
+    print("%-8s %-8s %10s %10s %10s" % ("dtype", "detBlock", "peak(MB)",
+                                         "data(MB)", "fft(MB)"))
+    for dtype in [np.float64, np.float32]:
+        for b in [0, int(block)]:
+            peak, data, spec = bench.preprocess_memory(b, dtype, ndet=int(ndet),
+                                                       nsamps=int(nsamps))
+            print("%-8s %-8d %10.0f %10.0f %10.0f" % (np.dtype(dtype).name, b,
+                                                      peak, data, spec))
+
+def cache(ndet=200, nsamps=40000, ntod=10):
+    """Memory held by the fft plan cache over a loop of tods of different
+    lengths, around nsamps
+    Example:
+        cuts bench cache 200 40000 10
+    """
+    from cutslib import bench
+    nsamps = [int(nsamps) + 1000*i for i in range(int(ntod))]
+    res, size = bench.plan_cache_memory(nsamps, ndet=int(ndet))
+    print(f"ndet = {ndet}, tod size up to {size:.0f} MB")
+    for n, mb in zip(nsamps, res):
+        print("%-8d %8.0f MB" % (n, mb))
@@ -0,0 +1,51 @@
+import glob, os
+import numpy as np
+
+def summary(cpar, sort="wall"):
+    """Summarize the per-routine profile traces (profile.txt.<rank>) of a
+    run made with --profile, across all ranks. Routines are ranked by
+    their total cost.
+    Example:
+        cuts profile summary v0
+        cuts profile summary v0 peak
+    """
+    ver = cpar.split(".par")[0][-1]
+    cpar_dir = os.path.dirname(os.path.abspath(cpar))
+    run_dir = os.path.join(cpar_dir, f"run_v{ver}")
+    files = sorted(glob.glob(run_dir+"/profile.txt*"))
+    if len(files) == 0:
+        print("No profile traces found in {}".format(run_dir))
+        return
+    names, rows, tods, ranks = [], [], set(), set()
+    for f in files:
+        with open(f) as ff:
+            for line in ff:
+                if line.startswith("#") or len(line.strip()) == 0: continue
+                r, tod, name, wall, cpu, peak, delta = line.split()
+                ranks.add(r)
+                tods.add(tod)
+                names.append(name)
+                rows.append((float(wall), float(cpu), float(peak), float(delta)))
+    names = np.array(names)
+    rows = np.array(rows).reshape(-1, 4)
+    total = rows[:,0].sum()
+    stats = []
+    for name in np.unique(names):
+        m = names == name
+        wall, cpu, peak, delta = rows[m].T
+        stats.append({
+            'routine': name, 'n': m.sum(), 'wall': wall.sum(),
+            'mean': wall.mean(), 'max': wall.max(), 'cpu': cpu.sum(),
+            'peak': peak.max(), 'delta': delta.mean(),
+        })
+    stats.sort(key=lambda s: s[sort], reverse=True)
+    print("{} tods, {} ranks, {:.1f} s total in routines".format(
+        len(tods), len(ranks), total))
+    print("{:<24s} {:>6s} {:>10s} {:>6s} {:>8s} {:>8s} {:>10s} {:>6s} {:>10s} {:>10s}".format(
+        "routine", "n", "wall(s)", "%", "mean(s)", "max(s)", "cpu(s)",
+        "cpu/w", "peak(MB)", "dRSS(MB)"))
+    for s in stats:
+        print("{:<24s} {:>6d} {:>10.1f} {:>6.1f} {:>8.2f} {:>8.2f} {:>10.1f} {:>6.2f} {:>10.0f} {:>10.1f}".format(
+            s['routine'], s['n'], s['wall'], 100*s['wall']/max(total, 1e-12),
+            s['mean'], s['max'], s['cpu'], s['cpu']/max(s['wall'], 1e-12),
+            s['peak'], s['delta']))
@@ -6,11 +6,23 @@ def combine(cpar):
     Example:
         cuts results combine v0
     """
-    tags = ["*.db", "done_list.txt", "error_list.txt"]
+    tags = ["*.db", "done_list.txt", "error_list.txt", "ledger.txt"]
     rm_cmds = []
     ver = cpar.split(".par")[0][-1]
     cpar_dir = os.path.dirname(os.path.abspath(cpar))
     run_dir = os.path.join(cpar_dir, f"run_v{ver}")
+    # hdf5 reports are combined column by column
+    files = glob.glob(run_dir+"/*.h5.*")
+    if len(files) > 0:
+        from cutslib.pathologies_tools import readH5, writeH5, appendH5
+        filename = '.'.join(files[0].split('.')[:-1])
+        for f in files:
+            print(f)
+            data, header, keys, types = readH5(f)
+            if not os.path.exists(filename):
+                writeH5(filename, keys, types, header)
+            appendH5(filename, data)
+            rm_cmds.append("rm {}".format(f))
     for tag in tags:
         files = glob.glob(run_dir+"/{}.*".format(tag))
         for f in files: print(f)
@@ -42,6 +54,17 @@ def combine(cpar):
     return rm_cmds
 
 
+def convert(db, outfile=None):
+    """Convert a pathology report from the ascii .db format to
+    the columnar hdf5 format.
+    Example:
+        cuts results convert run_v0/pa4_f150_s17_c11_v0.db
+    """
+    from cutslib.pathologies_tools import convertAscii
+    outfile = convertAscii(db, outfile)
+    print("Converted {} -> {}".format(db, outfile))
+
+
 def promote(cpar):
     """Promote the version of cuts param. It will automatically
     infer the version number.
@@ -895,25 +895,17 @@ class AnalyzeHF(Routine):
         # be calculated here
         if highOrder:
             hfd, _ = get_time_domain_modes(hf_data, 1, nsamps)
-            skewt = stat.skewtest(hfd,axis=1)
-            kurtt = stat.kurtosistest(hfd,axis=1)
+            _, skewt, kurtt = normal_tests(hfd)
             if scanParams is not None:
                 T = scanParams["T"]
                 pivot = scanParams["pivot"]
                 N = scanParams["N"]
                 f = float(hfd.shape[1])/nsamps
                 t = int(T*f); p = int(pivot*f)
-                prms = []; pskewt = []; pkurtt = []
-                for c in range(N):
-                    # i see this as calculating the statistics for each
-                    # swing (no turning part) so the statistics is not
-                    # affected by the scan
-                    prms.append(hfd[:,c*t+p:(c+1)*t+p].std(axis=1))
-                    pskewt.append(stat.skewtest(hfd[:,c*t+p:(c+1)*t+p],axis=1))
-                    pkurtt.append(stat.kurtosistest(hfd[:,c*t+p:(c+1)*t+p],axis=1))
-                prms = np.array(prms).T
-                pskewt = np.array(pskewt)
-                pkurtt = np.array(pkurtt)
+                # i see this as calculating the statistics for each
+                # swing (no turning part) so the statistics is not
+                # affected by the scan
+                prms, pskewt, pkurtt = chunk_normal_tests(hfd, t, p, N)
                 return (rms, skewt, kurtt, prms, pskewt, pkurtt)
             else:
                 return (rms, skewt, kurtt)
@@ -12,7 +12,8 @@ from moby2.scripting import products
 from moby2.analysis import hwp
 
 from cutslib.todloop import Routine
-from cutslib import pathologies, analysis as ana
+from cutslib import pathologies, analysis as ana, fft
+from cutslib.depot import DepotIndex
 from cutslib.tools import *
 
 
@@ -57,15 +58,16 @@ class CutSources(Routine):
     def initialize(self):
         # get the depot
         self._depot = moby2.util.Depot(self._depot_path)
+        self._index = DepotIndex(self._depot, comm=self.get_comm())
+        self._index.scan(moby2.TODCuts, self._tag_source)
 
     def execute(self, store):
         # retrieve tod
         tod = store.get(self.inputs.get('tod'))
 
         # check if source cut results exist
-        sourceResult = os.path.exists(
-            self._depot.get_full_path(
-                moby2.TODCuts, tag=self._tag_source, tod=tod))
+        sourceResult = self._index.exists(
+            moby2.TODCuts, tag=self._tag_source, tod=tod)
         # check if hdf source cuts are needed
         if self._hdf_cuts and not sourceResult:
             f = h5py.File(self._hdf_cuts, 'r', swmr=True)
@@ -79,7 +81,7 @@ class CutSources(Routine):
                 # the sources cut in, to be safe.
                 pos_cuts_sources = moby2.tod.TODCuts.for_tod(tod, assign=False)
                 pos_cuts_sources.merge_tod_cuts(flags_sources_cuts, cut_missing=True)
-                self._depot.write_object(pos_cuts_sources,
+                self._index.write_object(pos_cuts_sources,
                                          tag=self._tag_source,
                                          force=True, tod=tod,
                                          make_dirs=True)
@@ -127,7 +129,7 @@ class CutSources(Routine):
 
             # write to depot, copied from moby2, not needed here
             if self._write_depot:
-                self._depot.write_object(pos_cuts_sources,
+                self._index.write_object(pos_cuts_sources,
                                          tag=self._tag_source,
                                          force=True, tod=tod, make_dirs=True)
 
@@ -153,15 +155,16 @@ class CutPlanets(Routine):
 
     def initialize(self):
         self._depot = moby2.util.Depot(self._depot_path)
+        self._index = DepotIndex(self._depot, comm=self.get_comm())
+        self._index.scan(moby2.TODCuts, self._tag_planet)
 
     def execute(self, store):
         # get tod
         tod = store.get(self.inputs.get('tod'))
 
         # check if planetCuts exist
-        planetResult = os.path.exists(
-            self._depot.get_full_path(
-                moby2.TODCuts, tag=self._tag_planet, tod=tod))
+        planetResult = self._index.exists(
+            moby2.TODCuts, tag=self._tag_planet, tod=tod)
 
         # if planetCuts exist load it into variable pos_cuts_planets
         if planetResult and not self._force_planet:
@@ -212,7 +215,7 @@ class CutPlanets(Routine):
             if self._write_depot:
             # write planet cut to depot, copied from moby2, not needed
             # here
-                self._depot.write_object(pos_cuts_planets,
+                self._index.write_object(pos_cuts_planets,
                                          tag=self._tag_planet, force=True, tod=tod,
                                          make_dirs=True)
 
@@ -310,6 +313,8 @@ class RemoveSyncPickup(Routine):
 
     def initialize(self):
         self._depot = moby2.util.Depot(self._depot_path)
+        self._index = DepotIndex(self._depot, comm=self.get_comm())
+        self._index.scan(moby2.tod.Sync, self._tag_sync)
 
     def execute(self, store):
         # retrieve tod
@@ -317,9 +322,8 @@ class RemoveSyncPickup(Routine):
 
         # Check for existing results, to set what operations must be
         # done/redone.
-        sync_result = os.path.exists(
-            self._depot.get_full_path(
-                moby2.tod.Sync, tag=self._tag_sync, tod=tod))
+        sync_result = self._index.exists(
+            moby2.tod.Sync, tag=self._tag_sync, tod=tod)
 
         # determine if sync is needed
         skip_sync = not self._remove_sync or (not self._force_sync
@@ -344,7 +348,7 @@ class RemoveSyncPickup(Routine):
 
                 # write sync object to disk
                 if self._write_depot:
-                    self._depot.write_object(ss, tag=self._tag_sync,
+                    self._index.write_object(ss, tag=self._tag_sync,
                                              tod=tod, make_dirs=True,
                                              force=True)
 
@@ -369,15 +373,16 @@ class CutPartial(Routine):
 
     def initialize(self):
         self._depot = moby2.util.Depot(self._depot_path)
+        self._index = DepotIndex(self._depot, comm=self.get_comm())
+        self._index.scan(moby2.TODCuts, self._tag_partial)
 
     def execute(self, store):
         # retrieve tod
         tod = store.get(self.inputs.get('tod'))
 
         # check if partial results already exist
-        partial_result = os.path.exists(
-            self._depot.get_full_path(moby2.TODCuts,
-                                      tag=self._tag_partial, tod=tod))
+        partial_result = self._index.exists(
+            moby2.TODCuts, tag=self._tag_partial, tod=tod)
         # check if we need to skip creating partial cuts
         skip_partial = not self._force_partial and partial_result
 
@@ -406,7 +411,7 @@ class CutPartial(Routine):
 
             # write to depot, not needed here
             if self._write_depot:
-                self._depot.write_object(cuts_partial,
+                self._index.write_object(cuts_partial,
                                          tag=self._tag_partial,
                                          tod=tod, make_dirs=True, force=True)
 
@@ -489,16 +494,24 @@ class FindPathologies(Routine):
         self._tag_patho = params.get('tag_patho', None)
         self._force_patho = params.get('force_patho', False)
         self._pathop = params.get('pathop', {})
+        self._fft_engine = params.get('fft_engine', None)
+        self._fft_nthread = params.get('fft_nthread', 0)
+        self._patho_format = params.get('patho_format', 'hdf5')
 
     def initialize(self):
         # get the depot
         self._depot = moby2.util.Depot(self._depot_path)
+        self._index = DepotIndex(self._depot, comm=self.get_comm())
+        self._index.scan(pathologies.Pathologies, self._tag_patho)
+        # setup the fft engine shared by all transforms
+        if self._fft_engine:
+            fft.set_engine(self._fft_engine)
+        fft.set_nthread(self._fft_nthread)
 
     def execute(self, store):
         tod = store.get("tod")
-        pathoResult = os.path.exists(
-            self._depot.get_full_path(pathologies.Pathologies,
-                                      tag=self._tag_patho, tod=tod))
+        pathoResult = self._index.exists(
+            pathologies.Pathologies, tag=self._tag_patho, tod=tod)
         skip_patho = (not self._force_patho) and pathoResult
 
         if skip_patho:
@@ -508,8 +521,10 @@ class FindPathologies(Routine):
             self.logger.info("Finding new pathologies")
             pa = pathologies.Pathologies(tod, self._pathop,
                                          noExclude=True)
-            err = pa.findPathologies()
+            err = pa.findPathologies(pool=self.get_pool())
             self.logger.info("err = %d" % err)
             if err == 0:
-                self._depot.write_object(pa, tag=self._tag_patho,
+                # the depot calls writeToPath without a format
+                pa.file_format = self._patho_format
+                self._index.write_object(pa, tag=self._tag_patho,
                                          force=True, tod=tod, make_dirs=True)
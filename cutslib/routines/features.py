@@ -8,10 +8,10 @@ from past.builtins import basestring
 
 from scipy import signal
 import numpy as np
-from scipy.fftpack import fft
 
 from cutslib.todloop import Routine
 from cutslib.tools import nextregular
+from cutslib.fft import tod_rfft
 
 
 class JesseFeatures(Routine):
@@ -32,9 +32,15 @@ class JesseFeatures(Routine):
         window = signal.hann(N)
 
         nf = nextregular(N)
-        ywf = np.abs(fft(tod.data*window*2.0/N, nf))
-
-        av = np.mean(ywf, axis=1)
+        ywf = np.abs(tod_rfft(tod.data*window*2.0/N, nf))
+
+        # the full spectrum is symmetric, so its mean is recovered from
+        # the one-sided spectrum by double counting all but the zero and
+        # the nyquist frequencies
+        w = np.full(ywf.shape[-1], 2.)
+        w[0] = 1
+        if nf % 2 == 0: w[-1] = 1
+        av = np.dot(ywf, w) / nf
 
         # initalize empty array for features
         pav_low = np.zeros(ndets)
@@ -11,7 +11,9 @@ class FindCR(Routine):
     def __init__(self, **params):
         """A routine to perform a template search in the glitches. It
         extract the snippets of each glitch that match the given
-        template above certain snr. The results are written as a pickle.
+        template above certain snr. The results are written as a pickle,
+        with the snr and lag of the best match of each det and template
+        in template_snr and template_lag of the snippets.
 
         Parameters
         ----------
@@ -21,7 +23,8 @@ class FindCR(Routine):
         mce_ndet_lim (int) : filter for mce glitch with ndet above this limit
         mce_len_lim (int)  : filter for mce glitch with len below this limit
         snr_lim (int)      : signal-to-noise threshold for template matching
-        template (str)     : path to a template to match (npy file)
+        template (str)     : path to a template to match (npy file), or
+                             to a 2d array of templates
         outdir (str)       : output dir, needs to exist
         force (bool)       : when True existing file will be overridden
         glitchp (dict)     : glitch parameters
@@ -107,8 +110,17 @@ class FindCR(Routine):
         events = gl.CutsVector.from_mask(count>0)
         dets = tod.cuts.get_mask() if self.uncut_only else np.ones_like(tod.det_uid, dtype=bool)
         snippets = gl.affected_snippets_from_cv(tod, tod.partial, events, dets)
-        # filter cr by template
-        cr_snippets = list(filter(lambda s: s.max_snr_template(self.template)>self.snr_lim, snippets))
+        # filter cr by template, matching the dets of all snippets at once
+        self.logger.info("Matching templates")
+        snr, lag = gl.match_templates([s.data for s in snippets], self.template)
+        ends = np.cumsum([len(s.det_uid) for s in snippets])
+        cr_snippets = []
+        for s, i in zip(snippets, ends):
+            # keep the scores and lags of the dets (det x template)
+            s.template_snr = snr[i-len(s.det_uid):i]
+            s.template_lag = lag[i-len(s.det_uid):i]
+            if np.nanmax(s.template_snr, initial=-np.inf) > self.snr_lim:
+                cr_snippets.append(s)
         # write file
         with open(outfile, "wb") as f:
             pickle.dump(cr_snippets, f)
@@ -26,8 +26,11 @@ class FindRebiasTime(Routine):
         self._IV_wait = IV_wait
 
     def execute(self, store):
-        # load tod
-        obs = self.get_name()
+        # save into store
+        store.set('offset', self.find_offset(self.get_name()))
+
+    def find_offset(self, obs):
+        """Return the sample offset to skip the IV/rebias of a TOD"""
         # Find IV/rebias gap time
         ct = int(obs.split("/")[-1].split(".")[0])
         ctimes = (ct-self._IV_wait,ct)
@@ -60,6 +63,4 @@ class FindRebiasTime(Routine):
 
         offset = max( offset_IV, offset_rebias, self._offset*400 )
         self.logger.info("Total offset set to %d" %offset)
-
-        # save into store
-        store.set('offset', offset)
+        return offset
@@ -6,7 +6,7 @@ from cutslib.todloop import Routine
 import pickle, h5py, os
 import numpy as np
 import copy
-from cutslib import pathologies_tools
+from cutslib import pathologies_tools, mldata
 
 
 class PathologyReport(Routine):
@@ -62,12 +62,17 @@ class PrepareDataLabel(Routine):
         self._group_name = params.get('group', None)
         self._downsample = params.get('downsample', 1)
         self._remove_mean = params.get('remove_mean', False)
+        # columnar: one group per tod with a dataset per feature (see
+        # cutslib.mldata), det: one dataset per det with the features
+        # in its attributes
+        self._layout = params.get('layout', 'columnar')
 
     def initialize(self):
         # load pickle file
         self.logger.info("Loading %s..." % self._pickle_file)
         with open(self._pickle_file, "r") as f:
             self._pickle_data = pickle.load(f)
+        self._pickle_index = {n: i for i, n in enumerate(self._pickle_data['name'])}
 
         # create output h5 file if it doesn't exist
         if os.path.isfile(self._output_file):
@@ -103,12 +108,24 @@ class PrepareDataLabel(Routine):
 
         # get relevant metadata for this tod from pickle file
         tod_name = self.get_name()
-        pickle_id = self._pickle_data['name'].index(tod_name)
+        pickle_id = self._pickle_index[tod_name]
 
         # get detectors
         live = store.get(self.inputs.get('dets'))['live_final']
         live_dets = list(np.where(live == 1))[0]
 
+        if self._layout == 'columnar':
+            if self._downsample:
+                data = tod.data[live_dets, ::self._downsample]
+            else:
+                data = tod.data[live_dets]
+            features = {k: np.asarray(report[k])[live_dets] for k in keys}
+            features['data'] = data
+            features['label'] = self._pickle_data['sel'][live_dets, pickle_id].astype(int)
+            mldata.write_tod(self._group, tod_name, live_dets, features)
+            self.logger.info("Data saved in %s" % self._output_file)
+            return
+
         # store each det timeseries in hdf5
         for tes_det in live_dets:
             if self._downsample:
@@ -152,6 +169,8 @@ class PrepareDataLabelNew(Routine):
         self._remove_mean = params.get('remove_mean', False)
         self._truncate = params.get('truncate', 1000)
         self._downsample = params.get('downsample', 5)
+        # see PrepareDataLabel
+        self._layout = params.get('layout', 'columnar')
 
     def initialize(self):
         # load pickle file
@@ -162,6 +181,7 @@ class PrepareDataLabelNew(Routine):
             except UnicodeDecodeError:
                 f.seek(0)
                 self._pickle_data = pickle.load(f, encoding='latin1')
+        self._pickle_index = {n: i for i, n in enumerate(self._pickle_data['name'])}
 
         # create output h5 file if it doesn't exist
         if os.path.isfile(self._output_file):
@@ -198,7 +218,7 @@ class PrepareDataLabelNew(Routine):
 
         # get relevant metadata for this tod from pickle file
         tod_name = self.get_name()
-        pickle_id = self._pickle_data['name'].index(tod_name)
+        pickle_id = self._pickle_index[tod_name]
 
         # get list of detectors of interests
         live = store.get(self.inputs.get('dets'))['live_final']
@@ -207,6 +227,17 @@ class PrepareDataLabelNew(Routine):
         # treat the median as the common modes
         fdata_cm = np.median(np.abs(fft[live_dets, :self._truncate]), axis=0)
 
+        if self._layout == 'columnar':
+            tdata = tod.data[live_dets, ::self._downsample][:, 400:400+self._truncate]
+            fdata = np.abs(fft[live_dets, :self._truncate]) - fdata_cm
+            features = {k: np.asarray(report[k])[live_dets] for k in keys}
+            # (ndet, 2, ntruncate) as the per-det datasets
+            features['data'] = np.stack([tdata, fdata], axis=1)
+            features['label'] = self._pickle_data['sel'][live_dets, pickle_id].astype(int)
+            mldata.write_tod(self._group, tod_name, live_dets, features)
+            self.logger.info("Data saved in %s" % self._output_file)
+            return
+
         # store each det timeseries in hdf5
         for tes_det in live_dets:
             tdata = tod.data[tes_det, ::self._downsample][400:400+self._truncate]
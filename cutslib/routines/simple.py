@@ -11,6 +11,7 @@ from cutslib import MobyDict, preselect, analysis as ana, visual as v
 from cutslib.todloop import Routine
 from cutslib.analysis import CutsManager, PathologyManager
 from cutslib.util import dets2sel
+from cutslib.calibration import get_flatfield, get_responsivity
 
 
 class PathologySimple(Routine):
@@ -63,11 +64,11 @@ class PathologySimple(Routine):
         for f_ in ['scan_flags', 'turn_flags']:
             cman.add(f_, CutsVector.from_mask(scan_params[f_]))
         # get ff
-        ff_ = moby2.detectors.RelCal.from_dict(self.cal_param['flatfield'])
+        ff_ = get_flatfield(self.cal_param['flatfield'])
         ff_sel, ff = ff_.get_property('cal', tod.det_uid, default=0)
         _, stable = ff_.get_property('stable', tod.det_uid, default=False)
         # get biasstep
-        resp = products.get_calibration(self.cal_param['config'], tod.info).cal
+        resp = get_responsivity(self.cal_param['config'], tod.info)
         resp_sel = resp != 0
         # save various cuts
         cman.add('resp_sel', resp_sel)
@@ -3,41 +3,60 @@ from __future__ import absolute_import
 from past.builtins import basestring
 
 import numpy as np
+import threading
+from collections import deque
 
 import moby2
 from moby2.scripting import products
 
 from cutslib.todloop import Routine
 from cutslib.tools import *
+from cutslib import fft
+from cutslib.calibration import get_flatfield, get_responsivity
 
 
 class LoadTOD(Routine):
-    def __init__(self, sample_end=None, load_params={}):
+    # read-ahead settings don't change the results
+    runtime_params = ['lookahead', '_prefetch_mb']
+
+    def __init__(self, sample_end=None, load_params={}, prefetch=0,
+                 prefetch_mb=None, offset_func=None):
         """A routine to load TOD. The data is stored by
         default into the key 'tod' in data store.
 
         Args:
             sample_end (int): (default None)
             load_params: user-defined loading parameters (default {})
+            prefetch (int): number of upcoming TODs to read ahead on a
+                background thread while the current one is processed
+                (default 0: no read-ahead)
+            prefetch_mb (float): maximum memory in MB of the TODs read
+                ahead but not yet used (default None: no limit)
+            offset_func: function giving the 'offset' of a TOD from its
+                name, used to read ahead the same samples as the ones
+                requested (e.g. FindRebiasTime.find_offset)
         """
         Routine.__init__(self)
         self._load_params = load_params
         self._end = sample_end
         if sample_end:
             self._end = -sample_end
+        self.lookahead = prefetch
+        self._prefetch_mb = prefetch_mb
+        self._offset_func = offset_func
+        self._prefetcher = None
 
     def initialize(self):
         # as this will usually be the first routine, update user
         # config here
         user_config = moby2.util.get_user_config()
         moby2.pointing.set_bulletin_A(params=user_config.get('bulletin_A_settings'))
+        if self.lookahead > 0:
+            self._prefetcher = TODPrefetcher(self._load, depth=self.lookahead,
+                                             max_mb=self._prefetch_mb)
 
-    def execute(self, store):
-        # get obs name
-        obs = self.get_name()
-        self.logger.info("Loading TOD: %s..." % obs)
-        # get offset from find rebias procedure
-        offset = store.get("offset")
+    def get_params(self, obs, offset=None):
+        """Loading parameters of a TOD"""
         # define load parameters
         params = {
             'filename': obs,
@@ -48,8 +67,33 @@ class LoadTOD(Routine):
         }
         # update user defined load parameters
         params.update(self._load_params)
+        return params
+
+    def _load(self, obs):
+        # runs on the prefetching thread
+        offset = self._offset_func(obs) if self._offset_func else None
+        params = self.get_params(obs, offset)
+        return params, moby2.scripting.get_tod(params)
+
+    def execute(self, store):
+        # get obs name
+        obs = self.get_name()
+        self.logger.info("Loading TOD: %s..." % obs)
+        # get offset from find rebias procedure
+        offset = store.get("offset")
+        params = self.get_params(obs, offset)
+        tod = None
+        if self._prefetcher:
+            res = self._prefetcher.get(obs)
+            # only use it if it was read with the same parameters
+            if res is not None and res[0] == params:
+                self.logger.info("Using read-ahead TOD")
+                tod = res[1]
+            # start reading the next ones while this one is processed
+            self._prefetcher.request(self.get_upcoming())
         # get tod
-        tod = moby2.scripting.get_tod(params)
+        if tod is None:
+            tod = moby2.scripting.get_tod(params)
         # check alt/az validity (not pretty)
         error = np.sum(np.logical_or(tod.alt > np.pi/2, tod.alt < 0)) > 0
         if error:
@@ -58,6 +102,98 @@ class LoadTOD(Routine):
         # save tod into data store
         store.set("tod", tod)
 
+    def finalize(self):
+        if self._prefetcher:
+            self._prefetcher.close()
+            self._prefetcher = None
+
+
+class TODPrefetcher:
+    """Load TODs ahead of time on a background thread. At most depth TODs
+    are loaded or waiting to be used, and no new one is started while the
+    waiting ones (plus one more of the size of the last TOD) would exceed
+    max_mb. A TOD that fails to load is dropped so that the caller loads
+    it again and gets the error."""
+    def __init__(self, load, depth=1, max_mb=None):
+        """
+        Args:
+            load: function of a TOD name returning (params, tod)
+            depth: maximum number of TODs read ahead
+            max_mb: memory cap in MB of the TODs read ahead (default None)
+        """
+        self._load = load
+        self._depth = depth
+        self._max_bytes = max_mb * 2**20 if max_mb else None
+        self._cond = threading.Condition()
+        self._pending = deque()   # names to load
+        self._loading = None      # name being loaded
+        self._ready = {}          # name -> (params, tod, nbytes)
+        self._last_bytes = 0
+        self._stop = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def request(self, names):
+        """Queue TODs to load, in order, dropping the ones no longer needed"""
+        with self._cond:
+            names = list(names)[:self._depth]
+            for name in list(self._ready):
+                if name not in names: del self._ready[name]
+            self._pending = deque(n for n in names if n not in self._ready
+                                  and n != self._loading)
+            self._cond.notify_all()
+
+    def get(self, name):
+        """Return (params, tod) of a TOD read ahead, waiting for it if it is
+        being loaded, or None if it was not requested"""
+        with self._cond:
+            while self._loading == name:
+                self._cond.wait()
+            if name in self._pending: self._pending.remove(name)
+            res = self._ready.pop(name, None)
+            self._cond.notify_all()
+        if res is None: return None
+        return res[:2]
+
+    def _ready_bytes(self):
+        return sum(r[2] for r in self._ready.values())
+
+    def _has_room(self):
+        if len(self._ready) >= self._depth: return False
+        if self._max_bytes is None: return True
+        # always allow one tod to be waiting
+        if len(self._ready) == 0: return True
+        return self._ready_bytes() + self._last_bytes <= self._max_bytes
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._stop and not (self._pending and self._has_room()):
+                    self._cond.wait()
+                if self._stop: return
+                name = self._pending.popleft()
+                self._loading = name
+            try:
+                params, tod = self._load(name)
+                nbytes = sum(getattr(tod, k).nbytes for k in ['data', 'ctime', 'az', 'alt']
+                             if getattr(tod, k, None) is not None)
+            except Exception:
+                params, tod, nbytes = None, None, 0
+            with self._cond:
+                self._loading = None
+                if tod is not None:
+                    self._last_bytes = nbytes
+                    self._ready[name] = (params, tod, nbytes)
+                self._cond.notify_all()
+
+    def close(self):
+        with self._cond:
+            self._stop = True
+            self._ready.clear()
+            self._pending.clear()
+            self._cond.notify_all()
+        self._thread.join()
+
 
 class CheckTODLength(Routine):
     def __init__(self, fmin, min_periods=0):
@@ -83,9 +219,32 @@ class CheckTODLength(Routine):
 
 class FouriorTransform(Routine):
     def __init__(self, **params):
+        """Detrend and fourior transform the tod
+
+        Args:
+            fft_engine: fft backend to use: numpy, fftw or intel
+                        (default: the fastest available)
+            fft_nthread: number of threads for the fft (default 0
+                         which uses OMP_NUM_THREADS)
+            single_precision: transform in float32/complex64 instead of
+                              float64/complex128 (default False)
+            det_block: transform this many detectors at a time, so that
+                       the padded input is not a second copy of the tod
+                       (default 0 which transforms all at once)
+        """
         Routine.__init__(self)
         self.inputs = params.get('inputs', None)
         self.outputs = params.get('outputs', None)
+        self._fft_engine = params.get('fft_engine', None)
+        self._fft_nthread = params.get('fft_nthread', 0)
+        self._dtype = np.float32 if params.get('single_precision', False) \
+                      else np.float64
+        self._det_block = params.get('det_block', 0)
+
+    def initialize(self):
+        if self._fft_engine:
+            fft.set_engine(self._fft_engine)
+        fft.set_nthread(self._fft_nthread)
 
     def execute(self, store):
         tod = store.get(self.inputs.get('tod'))
@@ -97,7 +256,11 @@ class FouriorTransform(Routine):
         # find the next regular, this is to make fft faster
         self.logger.info('Perform fft on the tod...')
         nf = nextregular(tod.nsamps)
-        fdata = np.fft.rfft(tod.data, nf)
+        ctype = np.result_type(self._dtype, np.complex64)
+        ft = self.get_pool().empty((tod.data.shape[0], nf//2+1), ctype,
+                                   alloc=fft.empty)
+        fdata = fft.tod_rfft(tod.data, nf, ft=ft, dtype=self._dtype,
+                             block=self._det_block)
 
         # time and freq units
         dt = (tod.ctime[-1]-tod.ctime[0])/(tod.nsamps-1)
@@ -311,13 +474,13 @@ class CalibrateTOD(Routine):
         #####################################################
 
         # get responsivity
-        resp = products.get_calibration(self._config, tod.info)
+        resp = get_responsivity(self._config, tod.info)
 
         # select only responsive detectors
-        respSel = (resp.cal != 0.0)
+        respSel = (resp != 0.0)
 
         # get flatfield and a selection mask
-        flatfield_object = moby2.detectors.RelCal.from_dict(self._flatfield)
+        flatfield_object = get_flatfield(self._flatfield)
         ffSel, ff = flatfield_object.get_property('cal',
                                                   det_uid=tod.info.det_uid,
                                                   default=1.)
@@ -330,8 +493,8 @@ class CalibrateTOD(Routine):
         # check if we want to fill default responsivity
         if self._forceNoResp:
             # fill the default with median of stable detectors
-            rm = np.median(resp.cal[stable*respSel])
-            resp.cal[~respSel] = rm
+            rm = np.median(resp[stable*respSel])
+            resp[~respSel] = rm
 
         # get the RMS for flatfield calibration if it exists
         # otherwise fill with 0
@@ -344,13 +507,13 @@ class CalibrateTOD(Routine):
 
         # summarize all the calibration data into a dictionary
         calData = {
-            "resp": resp.cal,
+            "resp": resp,
             "respSel": respSel,
             "ff": ff,
             "ffRMS": ffRMS,
             "ffSel": ffSel,
             "stable": stable,
-            "cal": resp.cal*ff,
+            "cal": resp*ff,
             "calSel": ffSel*respSel,
             "calibrated": False,
             "flatfield_object": flatfield_object
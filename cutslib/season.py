@@ -1,8 +1,9 @@
 """Interactive with season stats."""
 
 # general dependency
-import numpy as np, pickle, copy, os.path as op, pandas as pd
+import numpy as np, pickle, copy, os, os.path as op, shutil, pandas as pd
 import h5py, moby2
+from collections.abc import MutableMapping
 from matplotlib import pyplot as plt
 from functools import reduce
 from tqdm import tqdm
@@ -15,11 +16,249 @@ from .util import get_cutParam
 from .pathologyReport import pathoReport, pathoList
 from .visual import array_plots
 from .catalog import Catalog
+from .calibration import get_abscal
+
+
+# layout of the fields in the season stats: per-tod fields and
+# (ndet, ntod) fields, everything else is per-det or global. tod_sel
+# spans the whole tod list (not only the selected tods) so it is global
+T_FIELDS = ['name', 'scan_freq', 'ctime', 'alt', 'pwv']
+TD_FIELDS = ['sel', 'psel', 'resp', 'resp_sel', 'cal','gainLive', 'gainLive_sel',
+             'corrLive', 'corrLive_sel', 'normLive', 'normLive_sel', 'rmsLive', 'rmsLive_sel',
+             'kurtLive', 'kurtLive_sel', 'skewLive', 'skewLive_sel', 'MFELive', 'MFELive_sel',
+             'DELive', 'DELive_sel', 'jumpLive', 'jumpLive_sel']
+
+
+class SeasonStore(MutableMapping):
+    def __init__(self, filename, tods=None):
+        """Dict-like view of the season stats saved in hdf5 with SeasonStore.write.
+        Fields are only read from disk when they are first accessed and are then
+        kept in memory, so only the criteria in use take memory. The (ndet, ntod)
+        fields are stored transposed and chunked by tod, so a tod selection only
+        reads the chunks it touches. Fields are returned in the same (ndet, ntod)
+        layout as in the pickle file.
+
+        Parameters
+        ----------
+        filename: hdf5 file written by SeasonStore.write
+        tods: index, slice or mask of tods to load (default all)
+        """
+        self.filename = filename
+        self._file = h5py.File(filename, "r")
+        self._cache = {}
+        self._transforms = {}
+        self._idx = np.arange(self._file.attrs['ntod'])
+        if tods is not None: self._idx = self._idx[tods]
+
+    @staticmethod
+    def write(filename, data, chunk=256):
+        """Write the season stats dict (as in the pickle file) into hdf5 with
+        the (ndet, ntod) fields stored as (ntod, ndet) and chunked by tod"""
+        ntod = len(data['name'])
+        with h5py.File(filename, "w") as f:
+            f.attrs['ntod'] = ntod
+            for k, v in data.items():
+                v = np.asarray(v)
+                if v.dtype.kind == 'U': v = v.astype('S')
+                if k in TD_FIELDS:
+                    ds = f.create_dataset(k, data=v.T, chunks=(max(1, min(chunk, ntod)), v.shape[0]))
+                    ds.attrs['layout'] = 'td'
+                elif k in T_FIELDS:
+                    ds = f.create_dataset(k, data=v)
+                    ds.attrs['layout'] = 't'
+                else:
+                    ds = f.create_dataset(k, data=v)
+                    ds.attrs['layout'] = 'det'
+
+    @staticmethod
+    def write_slots(filename, slots, meta, chunk=256):
+        """Write the season stats collected in a SlotStore into hdf5, keeping
+        the tods with tod_sel (the tod_sel field itself is kept whole), and
+        the per-det fields in meta. The slots are copied chunk by chunk so
+        the memory used doesn't depend on the number of tods."""
+        tod_sel = np.array(slots.read('tod_sel'))
+        idx = np.where(tod_sel)[0]
+        ntod = len(idx)
+        with h5py.File(filename, "w") as f:
+            f.attrs['ntod'] = ntod
+            for k in slots.fields:
+                if k == 'tod_sel':
+                    ds = f.create_dataset(k, data=tod_sel)
+                    ds.attrs['layout'] = 'det'
+                    continue
+                src = slots.read(k)
+                if k in TD_FIELDS:
+                    ds = f.create_dataset(k, shape=(ntod,)+src.shape[1:], dtype=src.dtype,
+                                          chunks=(max(1, min(chunk, ntod)), src.shape[1]))
+                    ds.attrs['layout'] = 'td'
+                else:
+                    ds = f.create_dataset(k, shape=(ntod,)+src.shape[1:], dtype=src.dtype)
+                    ds.attrs['layout'] = 't'
+                for i in range(0, ntod, chunk):
+                    ds[i:i+chunk] = src[idx[i:i+chunk]]
+                del src
+            for k, v in meta.items():
+                ds = f.create_dataset(k, data=np.asarray(v))
+                ds.attrs['layout'] = 'det'
+
+    @classmethod
+    def from_pickle(cls, pickle_file, filename=None, chunk=256):
+        """Convert an existing season stats pickle file into a season store,
+        by default it's saved next to the pickle file with extension .h5"""
+        if not filename: filename = op.splitext(pickle_file)[0] + '.h5'
+        with open(pickle_file, "rb") as f:
+            data = pickle.load(f)
+        cls.write(filename, data, chunk=chunk)
+        return cls(filename)
+
+    def _layout(self, key):
+        if key in self._file: return self._file[key].attrs['layout']
+        return 'det'
+
+    def _read(self, key, s=slice(None)):
+        """Read a field for the tods s (index of the current tod selection)
+        without caching it"""
+        idx = self._idx[s]
+        ds = self._file[key]
+        layout = ds.attrs['layout']
+        if layout == 'det':
+            v = ds[()]
+        else:
+            # read chunk by chunk to avoid loading the full span
+            v = np.empty((len(idx),)+ds.shape[1:], dtype=ds.dtype)
+            order = np.argsort(idx, kind='stable')
+            sidx = idx[order]
+            step = ds.chunks[0] if ds.chunks else max(1, ds.shape[0])
+            if len(sidx) > 0:
+                for c in range(sidx[0]-sidx[0]%step, sidx[-1]+1, step):
+                    i0, i1 = np.searchsorted(sidx, [c, c+step])
+                    if i1 > i0: v[order[i0:i1]] = ds[c:c+step][sidx[i0:i1]-c]
+            if layout == 'td': v = v.T
+        if v.dtype.kind == 'S': v = v.astype(str)
+        if key in self._transforms: v = self._transforms[key](v, s)
+        return v
+
+    def __getitem__(self, key):
+        if key not in self._cache:
+            if key not in self._file: raise KeyError(key)
+            self._cache[key] = self._read(key)
+        return self._cache[key]
+
+    def __setitem__(self, key, value):
+        self._cache[key] = value
+
+    def __delitem__(self, key):
+        """Release a field from memory, it will be read again when needed"""
+        if key not in self: raise KeyError(key)
+        self._cache.pop(key, None)
+
+    def __contains__(self, key):
+        return key in self._cache or key in self._file
+
+    def __iter__(self):
+        yield from self._file.keys()
+        yield from [k for k in self._cache if k not in self._file]
+
+    def __len__(self):
+        return len(list(iter(self)))
+
+    def transform(self, key, func):
+        """Apply func(values, s) to the field whenever it is read from disk,
+        s indexes the tods read in the current tod selection"""
+        self._transforms[key] = func
+        self._cache.pop(key, None)
+
+    def select_tods(self, idx):
+        """Restrict (or reorder) the tods of all fields, idx indexes the
+        current tod selection"""
+        self._idx = self._idx[idx]
+        for k in list(self._cache):
+            if self._layout(k) != 'det':
+                self._cache[k] = self._cache[k][...,idx]
+
+    def iter_chunks(self, key, size=1024):
+        """Iterate over a field in blocks of tods without keeping it in
+        memory, it yields (slice, values) with slice indexing the tod axis"""
+        if key in self._cache or self._layout(key) == 'det':
+            yield slice(None), self[key]
+            return
+        for i in range(0, len(self._idx), size):
+            s = slice(i, i+size)
+            yield s, self._read(key, s)
+
+    def subset(self, idx, fields=None):
+        """Read the per-tod fields for the given tod indices into a dict"""
+        if fields is None: fields = list(self)
+        return {k: self._read(k, idx) for k in fields
+                if k in self._file and self._layout(k) != 'det'}
+
+    def close(self):
+        self._file.close()
+
+
+class SlotStore:
+    def __init__(self, path):
+        """Season stats being collected by many processes. Every field is an
+        (ntod, ...) npy file in the directory path, preallocated once with
+        SlotStore.create, and each process writes the rows of its tods into
+        their slots, so nothing accumulates in memory. Rows are written with
+        positioned writes rather than through a shared memory map, so that
+        processes on different nodes never write back each other's pages.
+
+        Parameters
+        ----------
+        path: directory created by SlotStore.create
+        """
+        self.path = path
+        self._files = {}
+
+    @classmethod
+    def create(cls, path, ntod, fields):
+        """Preallocate the fields, given as {name: (dtype, row shape)}, with
+        ntod zero-filled rows. Only one process should call it."""
+        os.makedirs(path, exist_ok=True)
+        for k, (dtype, shape) in fields.items():
+            m = np.lib.format.open_memmap(op.join(path, k+'.npy'), mode='w+',
+                                          dtype=dtype, shape=(ntod,)+tuple(shape))
+            del m
+        return cls(path)
+
+    @property
+    def fields(self):
+        return sorted(op.splitext(f)[0] for f in os.listdir(self.path)
+                      if f.endswith('.npy'))
+
+    def read(self, key, idx=slice(None)):
+        """Memory map of a field (or of the rows idx)"""
+        return np.load(op.join(self.path, key+'.npy'), mmap_mode='r')[idx]
+
+    def write(self, i, row):
+        """Write the values {name: value} of the tod in slot i"""
+        for k, v in row.items():
+            if k not in self._files:
+                m = self.read(k)
+                fd = os.open(op.join(self.path, k+'.npy'), os.O_WRONLY)
+                self._files[k] = (fd, m.offset, m.dtype, m.shape[1:])
+                del m
+            fd, offset, dtype, shape = self._files[k]
+            b = np.ascontiguousarray(np.broadcast_to(v, shape), dtype=dtype).tobytes()
+            os.pwrite(fd, b, offset + i*len(b))
+
+    def close(self):
+        for fd, _, _, _ in self._files.values():
+            os.fsync(fd)
+            os.close(fd)
+        self._files = {}
+
+    def remove(self):
+        self.close()
+        shutil.rmtree(self.path)
 
 
 class SeasonStats:
     def __init__(self, tag=None, depot=None, calibrate=False, abscal='201026',
-                 use_theta2=False, sort=False, verbose=False, planet=True, rundb=True):
+                 use_theta2=False, sort=False, verbose=False, planet=True, rundb=True,
+                 tods=None, lazy=True):
         """Show the season stats using the collected pickle file containing
         all pathological parameters. The most important attribute is called
         style which contains everything a plotting function needs to know such
@@ -52,6 +291,9 @@ class SeasonStats:
         planet: if True, it will attempt to load planet calibration data if it exists
         rundb: if True, it will attempt to load the runtime output file that contains
           some useful statistics of the cuts run
+        tods: list of tod names, slice or index of tods to load (default all)
+        lazy: if True and a season store ({tag}_results.h5) exists, fields are read
+          from it on demand instead of loading the pickle file (see SeasonStore)
         """
         # store metadata
         self.tag = tag
@@ -116,22 +358,36 @@ class SeasonStats:
         # unless the field is specified
         for k, v in self.style.items():
             update_if_not_exist(v, common_style)
-        # load pickle file
-        pickle_file = Depot(depot).get_deep(('Postprocess', tag,
-                                             f'{tag}_results.pickle'))
-        with open(pickle_file, "rb") as f:
-            data = pickle.load(f)
-        if calibrate:
-            data['rmsLive'] *= data['resp'] * data['ff'][:,None]
-            data['normLive'] *= data['resp'] * data['ff'][:,None]
-            data['MFELive'] *= data['resp'] * data['ff'][:,None]
-            data['DELive'] *= data['resp'] * data['ff'][:,None]
-            data['jumpLive'] *= data['resp'] * data['ff'][:,None]
+        # load season store if available, otherwise the pickle file
+        store_file = Depot(depot).get_deep(('Postprocess', tag, f'{tag}_results.h5'))
+        calib_fields = ['rmsLive', 'normLive', 'MFELive', 'DELive', 'jumpLive']
+        if lazy and op.exists(store_file):
+            data = SeasonStore(store_file)
+            if tods is not None: data.select_tods(self._tod_index(data['name'], tods))
+            if verbose: print("season store opened:", store_file)
+            if calibrate:
+                for k in calib_fields:
+                    data.transform(k, lambda v, s: v * data['resp'][:,s] * data['ff'][:,None])
+            if use_theta2:
+                data.transform('corrLive', lambda v, s: 2*(1-v))
+        else:
+            pickle_file = Depot(depot).get_deep(('Postprocess', tag,
+                                                 f'{tag}_results.pickle'))
+            with open(pickle_file, "rb") as f:
+                data = pickle.load(f)
+            if tods is not None:
+                idx = self._tod_index(data['name'], tods)
+                for k in T_FIELDS: data[k] = data[k][idx]
+                for k in TD_FIELDS: data[k] = data[k][:,idx]
+            if calibrate:
+                for k in calib_fields:
+                    data[k] *= data['resp'] * data['ff'][:,None]
+            if use_theta2:
+                # treat corr as cos\theta ~ 1-\theta^2/2
+                # -> \theta^2 = 2(1-\cos\theta)
+                # if \theta is gaussian, theta^2 should be chi-squared
+                data['corrLive'] = 2*(1-data['corrLive'])
         if use_theta2:
-            # treat corr as cos\theta ~ 1-\theta^2/2
-            # -> \theta^2 = 2(1-\cos\theta)
-            # if \theta is gaussian, theta^2 should be chi-squared
-            data['corrLive'] = 2*(1-data['corrLive'])
             # also update style accordingly
             self.style['corrLive'].update({
                 'name': 'theta^2',
@@ -147,6 +403,9 @@ class SeasonStats:
         if rundb:
             run_dir = get_rundir(tag)
             db = op.join(run_dir, f"{tag}.db")
+            # prefer the columnar report if it exists
+            if op.exists(op.join(run_dir, f"{tag}.h5")):
+                db = op.join(run_dir, f"{tag}.h5")
             if op.exists(db):
                 self.db = pathoReport(db)
                 self.db.addPWV()
@@ -182,36 +441,36 @@ class SeasonStats:
                 if verbose: print("planet measurements loaded ss.planet:", planet_file)
         # load absolute calibration if that's what we want
         if abscal:
-            abscal_file = SharedDepot().get_deep(('TODAbsCal',f'abscal_{abscal}.h5'))
-            if verbose: print("Loading abscal:", abscal_file)
-            with h5py.File(abscal_file, "r") as f:
-                abscal_data = f['abscal'][:]
-                # choose only one freq
-                bmask = abscal_data['band_id'].astype(str) == f"f{self.freq:03d}"
-                tod_id = abscal_data['tod_id'].astype(str)[bmask]
-                cal = abscal_data['cal'][bmask]
-                del abscal_data, bmask
-            # next we want to get the abscal for the tods we have
-            # this method below is okay but too slow
-            # idx = np.array([np.where(tod_id == n)[0] for n in self.name])
-            # here is a slightly faster approach
-            inc_idx = np.where(np.isin(tod_id, self.name))[0]
-            mat_idx = [np.where(self.name==tod_id[i])[0][0] for i in inc_idx]
-            idx = inc_idx[np.argsort(mat_idx)]
-            self.abscal = cal[idx]
+            abscal_ = get_abscal(abscal)
+            if verbose: print("Loading abscal:", abscal_.filename)
+            # tods missing in the abscal table get nan
+            self.abscal = abscal_.lookup(self.name, f"f{self.freq:03d}")
 
         # sort values if that's what we want
         if sort: self.sort_values()
 
-    def get_subset(self, todlist, verbose=True):
+    def get_subset(self, todlist, fields=None, verbose=True):
+        """Get the per-tod fields for the given list of tods. With a season
+        store only the requested fields of the matched tods are read"""
         match = np.isin(self.name, todlist)
         if verbose: print(f"match tods: {np.sum(match)}")
+        if isinstance(self.stats, SeasonStore):
+            return self.stats.subset(np.where(match)[0], fields)
         new_ss = {}
-        for k, v in self.ss.items():
+        for k, v in self.stats.items():
+            if fields is not None and k not in fields: continue
             if v.shape[-1] == len(self.name):
                 new_ss[k] = v[...,match]
         return new_ss
 
+    @staticmethod
+    def _tod_index(names, tods):
+        """Convert a list of tod names, a slice or an index into tod indices"""
+        if isinstance(tods, slice): return np.arange(len(names))[tods]
+        tods = np.asarray(tods)
+        if tods.dtype.kind in 'US': return np.where(np.isin(names, tods))[0]
+        return np.arange(len(names))[tods]
+
     def __getattr__(self, item):
         if item in self.__dict__:
             return self.__dict__[item]
@@ -258,17 +517,21 @@ class SeasonStats:
         # depending on the meaning of the fields (axes), sort them accordingly. Here i am
         # avoiding have a general loop that checks the shape of things before sorting, because
         # i don't want to have the bug of sometimes having 1024 TODs get mistaken as 1024 dets, etc.
-        t_fields = ['name', 'scan_freq', 'ctime', 'alt', 'pwv', 'tod_sel', 'tes_sel']
+        t_fields = ['name', 'scan_freq', 'ctime', 'alt', 'pwv', 'tes_sel']
         td_fields = ['sel', 'psel', 'resp', 'resp_sel', 'cal','gainLive', 'gainLive_sel', \
                      'corrLive', 'corrLive_sel', 'normLive', 'normLive_sel', 'rmsLive', 'rmsLive_sel', \
                      'kurtLive', 'kurtLive_sel', 'skewLive', 'skewLive_sel', 'MFELive', 'MFELive_sel', \
                      'DELive', 'DELive_sel', 'jumpLive', 'jumpLive_sel']
         # sorted index
         sorted_idx = np.argsort(self.stats['ctime'])
-        for f in t_fields:
-            self.stats[f] = self.stats[f][sorted_idx]
-        for f in td_fields:
-            self.stats[f] = self.stats[f][:,sorted_idx]
+        if isinstance(self.stats, SeasonStore):
+            # fields not loaded yet will be read in the sorted order
+            self.stats.select_tods(sorted_idx)
+        else:
+            for f in t_fields:
+                self.stats[f] = self.stats[f][sorted_idx]
+            for f in td_fields:
+                self.stats[f] = self.stats[f][:,sorted_idx]
         print("ss.stats sorted by ctime")
         # sort patho db in self.db if that's loaded
         if hasattr(self,'db'):
@@ -284,14 +547,14 @@ class SeasonStats:
         for f in fields:
             # get crit corresponding to the field
             crit = self.style[f]['crit']
-            # get pathology values
-            values = self.stats[f]
-            # apply the cuts
-            sel = np.ones_like(values, dtype=bool)
+            # apply the cuts, the pathology values are read in blocks of tods
+            # to avoid holding all of them in memory with a season store
+            sel = np.ones(self.stats['sel'].shape, dtype=bool)
             lo, hi = crit
             if crit[0] > crit[1]: lo, hi = crit[1], crit[0]
-            if lo: sel *= values > lo
-            if hi: sel *= values < hi
+            for s, values in self._iter_chunks(f):
+                if lo: sel[:,s] *= values > lo
+                if hi: sel[:,s] *= values < hi
             # repopulate the sel back to the stats
             self.stats[f"{f}_sel"] = sel
             if verbose: print(f"-> {f}_sel updated: {np.sum(sel)} dets passed")
@@ -300,6 +563,12 @@ class SeasonStats:
         if verbose: print("-> sel updated")
         return self
 
+    def _iter_chunks(self, field):
+        if isinstance(self.stats, SeasonStore):
+            yield from self.stats.iter_chunks(field)
+        else:
+            yield slice(None), self.stats[field]
+
     def update_style(self, style={}):
         """Update the internal style in place, one use case is to change the crit and
         then call update_critsel to regenerate det cuts"""
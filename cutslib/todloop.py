@@ -1,7 +1,8 @@
 """Migrate base class here from todloop to avoid light external dependency"""
 
 # external dependency
-import gc, os, os.path as op
+import gc, os, os.path as op, time, resource, glob, json, hashlib
+from collections import deque
 import numpy as np
 import traceback
 # from deprecated import deprecated
@@ -29,6 +30,14 @@ class TODLoop:
         self._output_dir = "."
         self.comm = None
         self.rank = 0
+        self._profiler = None
+        self._ledger = None
+        self._checkpoint = True
+        self._resume = False
+        self._finished = set()
+        self._vetoed = False
+        self._upcoming = []
+        self._pool = BufferPool()
         self.logger = logging.getLogger(self.__class__.__name__)
         self.logger.setLevel(logging.INFO)
 
@@ -57,16 +66,42 @@ class TODLoop:
 
     def add_done_list(self, done_list):
         if op.exists(done_list):
-            self._done_list = TODList.from_file(done_list)
+            import h5py
+            # hdf5 pathology reports keep the tod names in a column
+            if h5py.is_hdf5(done_list):
+                with h5py.File(done_list, "r") as f:
+                    self._done_list = TODList(f["todName"][()].astype(str))
+            else:
+                self._done_list = TODList.from_file(done_list)
 
     def set_output_dir(self, output_dir):
         self._output_dir = output_dir
 
+    def set_checkpoint(self, checkpoint=True, resume=False):
+        """Record the outcome of each TOD in a per-rank ledger
+        (ledger.txt.<rank> in output_dir)
+        @par:
+            checkpoint: keep the ledger (default True)
+            resume: skip the TODs that the ledgers of previous runs record
+                    as finished with the same routine chain, so that only
+                    the failed and missing TODs are processed"""
+        self._checkpoint = checkpoint
+        self._resume = resume
+
+    def enable_profiling(self, trace_dir=None):
+        """Record the wall time, cpu time and peak memory of each routine
+        for each TOD into a per-rank trace file profile.txt.<rank>
+        @par:
+            trace_dir: directory of the trace files (default: output_dir)"""
+        self._profiler = RoutineProfiler(trace_dir or self._output_dir or ".")
+
     def initialize(self):
         """Initialize the pipeline and all routines"""
         # initialize all routines
         for routine in self._routines:
             routine.initialize()
+        if self._profiler:
+            self._profiler.open(self.rank)
 
         # if output_dir is specified but not created, generating now
         if self._output_dir and not op.exists(self._output_dir):
@@ -79,6 +114,16 @@ class TODLoop:
                 if self.rank == 0:  # not pretty
                     os.makedirs(self._output_dir)
 
+        # load the finished tods before this run writes to the ledger
+        if self._output_dir and (self._checkpoint or self._resume):
+            fingerprint = self.fingerprint()
+            if self._resume:
+                self._finished = Ledger.finished(self._output_dir, fingerprint)
+                self.logger.info("Resuming: %d tods already finished" % \
+                                 len(self._finished))
+            if self._checkpoint:
+                self._ledger = Ledger(self._output_dir, self.rank, fingerprint)
+
     # @profile
     def execute(self, store):
         """Execute all routines"""
@@ -86,8 +131,15 @@ class TODLoop:
             # check veto signal, if received, skip subsequent routines
             if self._veto:
                 break
+            elif self._profiler:
+                self._profiler.start()
+                try:
+                    routine.execute(store)
+                finally:
+                    self._profiler.stop(self._tod_name, routine)
             else:
                 routine.execute(store)
+        self._vetoed = self._veto
         self._veto = False
 
     def finalize(self):
@@ -95,37 +147,104 @@ class TODLoop:
         # finalize all routines
         for routine in self._routines:
             routine.finalize()
-
-    def run(self, start=0, end=None, remove_done=True):
+        if self._profiler:
+            self._profiler.close()
+        if self._ledger:
+            self._ledger.close()
+            self._ledger = None
+        self._pool.clear()
+
+    def fingerprint(self):
+        """A short hash of the routine chain: the routine classes in order
+        and their plain (json serializable) parameters. Parameters listed
+        in the runtime_params of a routine don't change the results and
+        are left out."""
+        chain = []
+        for routine in self._routines:
+            params = {}
+            skip = ['_context', 'logger'] + list(getattr(routine, 'runtime_params', []))
+            for k, v in vars(routine).items():
+                if k in skip: continue
+                try:
+                    params[k] = json.dumps(v, sort_keys=True)
+                except (TypeError, ValueError):
+                    continue
+            chain.append([routine.__class__.__name__, params])
+        chain = json.dumps(chain, sort_keys=True).encode()
+        return hashlib.md5(chain).hexdigest()[:12]
+
+    def run(self, start=0, end=None, remove_done=True, profile=False,
+            resume=False):
         """Main driver function to run the loop
         @param:
             start: starting tod_id (default 0)
-            end:   ending tod_id (default None)"""
+            end:   ending tod_id (default None)
+            profile: record the cost of each routine (see enable_profiling)
+            resume: skip the tods finished in previous runs (see set_checkpoint)"""
+        if profile and not self._profiler:
+            self.enable_profiling()
+        if resume: self._resume = True
         if remove_done:
             self._check_done()
         self.initialize()
         # if end is not provided, run all
         if not end:
             end = len(self._tod_list)
-        for tod_id in range(start, end):
-            self._tod_id = tod_id
-            self._tod_name = self._tod_list[tod_id]
-            self.logger.info("TOD %d: %s" % (tod_id, self._tod_name))
-
-            # initialize data store
-            store = DataStore()
-            try:
-                self.execute(store)
-            except Exception as e:
-                self.logger.error("%s occurred, skipping..." % type(e))
-                traceback.print_exc()
-                # write to error log file
-                self._dump_error(e)
-            # clean memory
-            gc.collect()
-
+        for tod_id in self._lookahead(range(start, end)):
+            self._process(tod_id)
         self.finalize()
 
+    def _lookahead(self, tod_ids):
+        """Iterate over tod ids while keeping the next few in
+        self._upcoming, as many as the largest lookahead attribute of the
+        routines (e.g. a prefetching loader). Ids drawn from a shared queue
+        are claimed by this rank as soon as they enter the lookahead."""
+        n = max([getattr(r, 'lookahead', 0) for r in self._routines] + [0])
+        tod_ids = iter(tod_ids)
+        buf = deque()
+        while True:
+            while len(buf) <= n:
+                try:
+                    buf.append(next(tod_ids))
+                except StopIteration:
+                    break
+            if len(buf) == 0: break
+            tod_id = buf.popleft()
+            self._upcoming = list(buf)
+            yield tod_id
+        self._upcoming = []
+
+    def _process(self, tod_id):
+        """Run all routines on a single TOD"""
+        self._tod_id = tod_id
+        self._tod_name = self._tod_list[tod_id]
+        if self._tod_name in self._finished:
+            self.logger.info("TOD %d: %s finished in a previous run" % \
+                             (tod_id, self._tod_name))
+            return
+        self.logger.info("TOD %d: %s" % (tod_id, self._tod_name))
+
+        # initialize data store
+        store = DataStore()
+        try:
+            self.execute(store)
+        except Exception as e:
+            self.logger.error("%s occurred, skipping..." % type(e))
+            traceback.print_exc()
+            # write to error log file
+            self._dump_error(e)
+            if self._ledger:
+                self._ledger.record(self._tod_name, "failed", type(e).__name__)
+        else:
+            if self._ledger:
+                self._ledger.record(self._tod_name,
+                                    "vetoed" if self._vetoed else "done")
+        # the buffers lent for this tod can be reused for the next one
+        del store
+        self._pool.release()
+        # clean memory
+        gc.collect()
+
     def _dump_error(self, e):
         if self._output_dir:
             errfile = op.join(self._output_dir,
@@ -151,28 +270,82 @@ class TODLoop:
             self.logger.info("Removing %d tod already done from run list" % len(self._done_list))
             self._tod_list -= self._done_list
 
-    def run_parallel(self, start=0, end=None, n_workers=1):
+    def run_parallel(self, start=0, end=None, n_workers=1, dynamic=True,
+                     longest_first=False, catalog=None, profile=False,
+                     resume=False):
+        """Run the loop with mpi
+        @param:
+            start: starting tod_id (default 0)
+            end:   ending tod_id (default None)
+            n_workers: number of workers, only used if dynamic=False
+            dynamic: if True, tods are handed out on demand through a
+                     shared work queue so that ranks that finish early
+                     pick up more tods, otherwise the list is split
+                     into equal contiguous chunks (default True)
+            longest_first: hand out the longest tods first according to
+                     the durations in the observation catalog, only
+                     used if dynamic=True (default False)
+            catalog: Catalog or path to the catalog file to look up the
+                     durations (default: the one in moby2 config)
+            profile: record the cost of each routine (see enable_profiling)
+            resume: skip the tods finished in previous runs (see set_checkpoint)"""
+        if profile and not self._profiler:
+            self.enable_profiling()
+        if resume: self._resume = True
         self._check_done()
         n_total = len(self._tod_list)
-        self.logger.info("Distributing %d tods to %d workers" % \
-                         (n_total, n_workers))
         # setup mpi
-        from mpi4py import MPI
-        comm = MPI.COMM_WORLD
-        size = comm.Get_size()
-        rank = comm.Get_rank()
+        from cutslib import mpi
+        comm = mpi.COMM_WORLD
+        size = comm.size
+        rank = comm.rank
         self.comm = comm
         self.rank = rank
         self.logger.info("Node @ rank=%d\t size=%d" % (rank, size))
-        # distribute tasks
         if not end:
             end = n_total
-        tasks = np.array_split(np.arange(start, end), n_workers)
-        start = tasks[rank][0]
-        end = tasks[rank][-1]+1
-        self.run(start=start, end=end, remove_done=False)
+        if not dynamic:
+            self.logger.info("Distributing %d tods to %d workers" % \
+                             (end-start, n_workers))
+            tasks = np.array_split(np.arange(start, end), n_workers)
+            start = tasks[rank][0]
+            end = tasks[rank][-1]+1
+            self.run(start=start, end=end, remove_done=False)
+            return
+        self.logger.info("Sharing %d tods among %d workers on demand" % \
+                         (end-start, size))
+        tod_ids = list(range(start, end))
+        if longest_first:
+            # only the root reads the catalog, all ranks need the same order
+            if rank == 0:
+                tod_ids = self._sort_by_duration(tod_ids, catalog)
+            if size > 1:
+                tod_ids = comm.bcast(tod_ids, root=0)
+        queue = mpi.TaskQueue(tod_ids, comm=comm)
+        self.initialize()
+        for tod_id in self._lookahead(queue):
+            self._process(tod_id)
+        queue.free()
+        self.finalize()
 
-    def run_fparallel(self, start=0, end=None, n_workers=1, rank=0):
+    def _sort_by_duration(self, tod_ids, catalog=None):
+        """Order tod ids by decreasing duration in the observation
+        catalog, tods not found in the catalog are kept at the end"""
+        from cutslib import Catalog
+        if not isinstance(catalog, Catalog):
+            catalog = Catalog(filename=catalog)
+        names = [os.path.basename(self._tod_list[i]).replace('.zip','')
+                 for i in tod_ids]
+        durations = catalog.data.set_index('tod_name')['duration']
+        durations = durations[~durations.index.duplicated()]
+        durations = durations.reindex(names).fillna(-1).values
+        # stable sort keeps the list order for equal durations
+        order = np.argsort(-durations, kind='stable')
+        self.logger.info("Ordering %d tods by decreasing duration" % len(tod_ids))
+        return [tod_ids[i] for i in order]
+
+    def run_fparallel(self, start=0, end=None, n_workers=1, rank=0,
+                      profile=False, resume=False):
         """Fake parallel, don't judge me"""
         self._check_done()
         n_total = len(self._tod_list)
@@ -187,7 +360,8 @@ class TODLoop:
         tasks = np.array_split(np.arange(start, end), n_workers)
         start = tasks[rank][0]
         end = tasks[rank][-1]+1
-        self.run(start=start, end=end, remove_done=False)
+        self.run(start=start, end=end, remove_done=False, profile=profile,
+                 resume=resume)
 
     def veto(self):
         """Veto a TOD from subsequent routines"""
@@ -197,13 +371,24 @@ class TODLoop:
         """Return the index of current TOD in the list"""
         return self._tod_id
 
-    def get_name(self):
-        """Return name of the TOD"""
+    def get_name(self, tod_name=None):
+        """Return name of the TOD (default: the current one)"""
+        if tod_name is None: tod_name = self._tod_name
         # get metadata
         if self._abspath:
-            return os.path.basename(self._tod_name)
+            return os.path.basename(tod_name)
         else:
-            return self._tod_name
+            return tod_name
+
+    def get_pool(self):
+        """Return the buffer pool of the loop"""
+        return self._pool
+
+    def get_upcoming(self):
+        """Return the names of the TODs that this loop will process next,
+        as far as the lookahead of the routines goes"""
+        return [self.get_name(self._tod_list[i]) for i in self._upcoming
+                if self._tod_list[i] not in self._finished]
 
     def get_filename(self):
         # check if we are looking at abspath or not
@@ -249,6 +434,133 @@ class TODLoop:
             return self._metadata
 
 
+class RoutineProfiler:
+    """Measure the cost of each routine for each TOD and append it to a
+    trace file, one per rank. Each line records the wall time, cpu time,
+    peak resident memory during the routine and the change in resident
+    memory after it. The traces are summarized by the profile recipe."""
+    def __init__(self, trace_dir="."):
+        self.trace_dir = trace_dir
+        self._file = None
+
+    def open(self, rank=0):
+        if not op.exists(self.trace_dir):
+            os.makedirs(self.trace_dir, exist_ok=True)
+        self.filename = op.join(self.trace_dir, "profile.txt.%d" % rank)
+        self.rank = rank
+        new = not op.exists(self.filename)
+        # line buffered so that the trace survives a killed job
+        self._file = open(self.filename, "a", buffering=1)
+        if new:
+            self._file.write("# rank tod routine wall(s) cpu(s) peak_rss(MB) delta_rss(MB)\n")
+
+    def start(self):
+        self._reset_peak()
+        self._rss0 = self._rss()
+        self._cpu0 = time.process_time()
+        self._wall0 = time.perf_counter()
+
+    def stop(self, tod_name, routine):
+        wall = time.perf_counter() - self._wall0
+        cpu = time.process_time() - self._cpu0
+        rss = self._rss()
+        peak = max(self._peak(), rss)
+        if self._file:
+            self._file.write("%3d %s %s %.4f %.4f %.1f %.1f\n" % (
+                self.rank, tod_name, routine.__class__.__name__, wall, cpu,
+                peak, rss-self._rss0))
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    @staticmethod
+    def _status(field):
+        # memory fields in /proc/self/status are in kB
+        try:
+            with open("/proc/self/status") as f:
+                for line in f:
+                    if line.startswith(field):
+                        return int(line.split()[1]) / 1024.
+        except (IOError, ValueError):
+            pass
+        return None
+
+    def _rss(self):
+        rss = self._status("VmRSS:")
+        return rss if rss is not None else self._maxrss()
+
+    def _peak(self):
+        peak = self._status("VmHWM:")
+        return peak if peak is not None else self._maxrss()
+
+    @staticmethod
+    def _maxrss():
+        # ru_maxrss is in kB on linux, it can't be reset
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+    @staticmethod
+    def _reset_peak():
+        # reset the high water mark of the rss (linux >= 4.0), so that
+        # the peak is measured for each routine
+        try:
+            with open("/proc/self/clear_refs", "w") as f:
+                f.write("5")
+        except (IOError, OSError):
+            pass
+
+
+class Ledger:
+    """Append-only record of the outcome of each TOD, one file per rank
+    (ledger.txt.<rank>). Each line holds the tod name, its status (done,
+    vetoed or failed), the fingerprint of the routine chain, the time and
+    the error type if any. A line is written with a single append and
+    synced to disk before the next TOD starts, so a killed job loses at
+    most the TOD it was working on."""
+    FINISHED = ["done", "vetoed"]
+
+    def __init__(self, output_dir, rank=0, fingerprint=""):
+        self.filename = op.join(output_dir, "ledger.txt.%d" % rank)
+        self.fingerprint = fingerprint
+        self._fd = os.open(self.filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                           0o644)
+
+    def record(self, tod_name, status, error="-"):
+        line = "%s %s %s %d %s\n" % (tod_name, status, self.fingerprint,
+                                      int(time.time()), error)
+        os.write(self._fd, line.encode())
+        os.fsync(self._fd)
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    @staticmethod
+    def read(output_dir):
+        """Latest (status, fingerprint) of each tod in all ledgers of a
+        run directory"""
+        entries = {}
+        for f in glob.glob(op.join(output_dir, "ledger.txt*")):
+            with open(f) as ff:
+                for line in ff:
+                    fields = line.split()
+                    # skip a line truncated by a killed job
+                    if len(fields) != 5 or not line.endswith("\n"): continue
+                    tod, status, fp, t = fields[:4]
+                    if tod not in entries or int(t) >= entries[tod][2]:
+                        entries[tod] = (status, fp, int(t))
+        return entries
+
+    @classmethod
+    def finished(cls, output_dir, fingerprint=None):
+        """Set of tods finished (done or vetoed) with the given routine
+        chain fingerprint (any if None)"""
+        return set(tod for tod, (status, fp, _) in cls.read(output_dir).items()
+                   if status in cls.FINISHED and fingerprint in [None, fp])
+
+
 class Routine:
     """A routine is a reusable unit of a particular algorithm,
     for example, it can be filtering algorithms that can be used
@@ -306,6 +618,14 @@ class Routine:
         """A short cut to calling the get_name of parent pipeline"""
         return self.get_context().get_name()
 
+    def get_pool(self):
+        """A short cut to calling the get_pool of parent pipeline"""
+        return self.get_context().get_pool()
+
+    def get_upcoming(self):
+        """A short cut to calling the get_upcoming of parent pipeline"""
+        return self.get_context().get_upcoming()
+
     def get_comm(self):
         return self.get_context().comm
 
@@ -321,6 +641,63 @@ class Routine:
         return array_name
 
 
+class BufferPool:
+    """Arrays lent to the routines for the data of one TOD. All of them
+    are returned to the pool once the TOD is done, and the next TOD gets
+    the same memory back instead of allocating it again. A buffer can be
+    lent for any shape that fits in it, so TODs of slightly different
+    lengths share them. Buffers not used by the last TOD are freed.
+
+    A borrowed array must not be kept beyond the TOD it was lent for.
+    """
+    def __init__(self, headroom=0.05):
+        """
+        @par:
+            headroom: new buffers are made larger by this fraction so
+                      that longer TODs still fit"""
+        self.headroom = headroom
+        self._free = []  # flat buffers available
+        self._lent = []  # flat buffers lent for the current tod
+
+    def empty(self, shape, dtype=np.float64, alloc=np.empty):
+        """Borrow an uninitialized array
+        @par:
+            shape, dtype: of the array
+            alloc: function (shape, dtype) making a new flat buffer when
+                   none fits, e.g. fft.empty for aligned fft buffers
+        @ret:
+            C-contiguous array of the given shape and dtype"""
+        shape = tuple(np.atleast_1d(shape))
+        dtype = np.dtype(dtype)
+        size = int(np.prod(shape))
+        fits = [b for b in self._free if b.dtype == dtype and b.size >= size]
+        if fits:
+            buf = min(fits, key=lambda b: b.size)
+            self._free = [b for b in self._free if b is not buf]
+        else:
+            buf = alloc(int(size*(1+self.headroom))+1, dtype)
+        self._lent.append(buf)
+        return buf[:size].reshape(shape)
+
+    def zeros(self, shape, dtype=np.float64, alloc=np.empty):
+        """Borrow an array filled with zeros"""
+        arr = self.empty(shape, dtype, alloc)
+        arr[...] = 0
+        return arr
+
+    def release(self):
+        """Take back all lent buffers, free the ones not lent this time"""
+        self._free = self._lent
+        self._lent = []
+
+    def clear(self):
+        self._free, self._lent = [], []
+
+    @property
+    def nbytes(self):
+        return sum(b.nbytes for b in self._free + self._lent)
+
+
 class DataStore:
     """Cache class for event loop"""
     def __init__(self):
@@ -4,6 +4,7 @@ from __future__ import division
 from past.builtins import basestring
 
 import numpy as np
+from scipy.special import ndtr
 from cutslib.errors import PreselectionError
 # import pyfftw
 
@@ -144,6 +145,35 @@ def checksize(n):
     while not (n%2): n//=2
     return (1 if n == 1 else 0)
 
+def blocked_std(data, block=0):
+    """Standard deviation of each row of data, computed on blocks of
+    rows so that the temporary (data - mean) is the size of a block
+    instead of the size of data. block=0 computes it at once."""
+    if not block or block >= len(data): return np.std(data, axis=1)
+    return np.concatenate([np.std(data[i:i+block], axis=1)
+                           for i in range(0, len(data), block)])
+
+def peak_rss():
+    """Peak resident memory of the process in MB"""
+    # VmHWM is in kB, ru_maxrss too on linux
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024.
+    except (IOError, ValueError):
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+def reset_peak_rss():
+    """Reset the peak resident memory to the current one (linux >= 4.0)"""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except (IOError, OSError):
+        pass
+
 def presel_by_median(cc, sel=None, **kwargs):
     """
     minCorr: minimum correlation requiered for preselection
@@ -287,6 +317,28 @@ def get_iharm(frange, df, scan_freq, wide = False):
     return i_harm
 
 
+def get_top_modes(c, nmodes=1):
+    """Leading eigenvalues and eigenvectors of a hermitian matrix such as
+    a gram matrix X X^H, for which they give the leading singular values
+    (squared) and left singular vectors of X. A truncated Lanczos solver
+    is used when only a few modes of a large matrix are needed so the cost
+    scales with the number of modes kept.
+
+    Returns:
+        w: eigenvalues in decreasing order, shape (nmodes,)
+        u: corresponding eigenvectors as columns, shape (n, nmodes)
+    """
+    n = c.shape[0]
+    if n > max(50, 4*nmodes):
+        from scipy.sparse.linalg import eigsh
+        w, u = eigsh(c, k=nmodes, which='LA')
+    else:
+        w, u = np.linalg.eigh(c)
+        w, u = w[-nmodes:], u[:,-nmodes:]
+    order = np.argsort(w)[::-1]
+    return w[order], u[:,order]
+
+
 def get_time_domain_modes(fmodes, n_l, nsamps, df=1.,):
     """What's happening here is: supposed fmodes has shape (ndet, nfreq)
               n_l      nfreq-1       1
@@ -300,10 +352,11 @@ def get_time_domain_modes(fmodes, n_l, nsamps, df=1.,):
     # Get modes in time domain
     if fmodes.ndim == 1:
         fmodes = fmodes[np.newaxis,:]
-    fcm = np.hstack([np.zeros((len(fmodes),n_l)),
+    fcm = np.hstack([np.zeros((len(fmodes),n_l), dtype=fmodes.dtype),
                      fmodes[:,:-1],
                      np.expand_dims(np.real(fmodes[:,-1]),1)])
-    modes = np.fft.irfft(fcm)
+    # keep the precision of fmodes (numpy may transform in double)
+    modes = np.fft.irfft(fcm).astype(fcm.real.dtype, copy=False)
     modes_dt = 1./modes.shape[1]/df
     modes *= np.sqrt(2.*fmodes.shape[1]/nsamps)
     return modes, modes_dt
@@ -382,6 +435,74 @@ def kurtosisTest(kurt, n):
     kt[~mask] = -1000
     return kt
 
+def normal_tests(data):
+    """
+    @brief Find the standard deviation and the normality tests of the skewness and
+           the kurtosis of data along its last axis, with a single pass of moments.
+           The tests are the same as stat.skewtest and stat.kurtosistest (two sided).
+    @param data  Array with the vectors to analyze along the last axis
+    @return std, (skew, skewp), (kurt, kurtp)  each with the shape of data.shape[:-1]
+    """
+    n = float(data.shape[-1])
+    mean = data.mean(axis=-1)
+    d = data - mean[...,np.newaxis]
+    d2 = d*d
+    m2 = d2.mean(axis=-1)
+    # the higher powers are made in place, keeping the two temporaries
+    m3 = np.multiply(d, d2, out=d).mean(axis=-1)
+    m4 = np.multiply(d2, d2, out=d2).mean(axis=-1)
+    del d, d2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # constant vectors have no skewness and kurtosis (as in scipy)
+        zero = m2 <= (np.finfo(m2.dtype).resolution*mean)**2
+        skew = np.where(zero, np.nan, m3/m2**1.5)
+        kurt = np.where(zero, np.nan, m4/m2**2)
+        # skewness test (D'Agostino)
+        ns = n if n >= 8 else np.nan
+        y = skew*np.sqrt((ns+1)*(ns+3)/(6.*(ns-2)))
+        beta2 = 3.*(ns**2+27*ns-70)*(ns+1)*(ns+3)/((ns-2.)*(ns+5)*(ns+7)*(ns+9))
+        W2 = -1 + np.sqrt(2*(beta2-1))
+        delta = 1/np.sqrt(0.5*np.log(W2))
+        alpha = np.sqrt(2./(W2-1))
+        y = np.where(y == 0, 1., y)
+        zs = delta*np.log(y/alpha + np.sqrt((y/alpha)**2+1))
+        # kurtosis test (Anscombe & Glynn)
+        nk = n if n >= 5 else np.nan
+        E = 3.*(nk-1)/(nk+1)
+        varb2 = 24.*nk*(nk-2)*(nk-3)/((nk+1)*(nk+1.)*(nk+3)*(nk+5))
+        x = (kurt-E)/varb2**0.5
+        sqrtbeta1 = 6.*(nk*nk-5*nk+2)/((nk+7)*(nk+9))*((6.*(nk+3)*(nk+5))/(nk*(nk-2)*(nk-3)))**0.5
+        A = 6. + 8./sqrtbeta1*(2./sqrtbeta1 + (1+4./sqrtbeta1**2)**0.5)
+        denom = 1 + x*(2/(A-4.))**0.5
+        term2 = np.sign(denom)*np.where(denom == 0., np.nan,
+                                        ((1-2./A)/np.abs(denom))**(1/3.))
+        zk = (1 - 2/(9.*A) - term2)/(2/(9.*A))**0.5
+    pvalue = lambda z: 2*ndtr(-np.abs(z))
+    return np.sqrt(m2), (zs, pvalue(zs)), (zk, pvalue(zk))
+
+def chunk_normal_tests(data, T, pivot, N):
+    """
+    @brief Find the standard deviation and the normality tests of the N scan chunks
+           data[:,c*T+pivot:(c+1)*T+pivot] of every vector, in a few array passes over
+           a (ndet, N, T) view of data.
+    @return std (ndet, N), skewt (N, 2, ndet), kurtt (N, 2, ndet) with the statistic
+            and the p-value of the tests, as the stacked stat.skewtest and
+            stat.kurtosistest of each chunk
+    """
+    ndet, nsamps = data.shape
+    # chunks fully inside the data are analyzed at once, those running
+    # past its end are shorter and are analyzed one by one
+    nfull = min(N, max((nsamps-pivot)//T, 0)) if (pivot >= 0 and T > 0) else 0
+    chunks = data[:,pivot:pivot+nfull*T].reshape(ndet, nfull, T)
+    std, skewt, kurtt = normal_tests(chunks)
+    res = [[std], [skewt[0]], [skewt[1]], [kurtt[0]], [kurtt[1]]]
+    for c in range(nfull, N):
+        std, skewt, kurtt = normal_tests(data[:,c*T+pivot:(c+1)*T+pivot])
+        for r, v in zip(res, [std, skewt[0], skewt[1], kurtt[0], kurtt[1]]):
+            r.append(v[:,np.newaxis])
+    std, zs, ps, zk, pk = [np.hstack(r) for r in res]
+    return std, np.array([zs, ps]).transpose(2,0,1), np.array([zk, pk]).transpose(2,0,1)
+
 # This must be called after removing the common mode
 def findNoiseLevel(data, nwin = 10, winsize = 1000):
     """
@@ -467,26 +588,98 @@ def find_common_cuts(cuts, min_dets=5, nsamps=None):
     """
     Args:
         cuts: list of cuts for each det
-        min_dets: minimum dets required for common cuts
+        min_dets: common cuts have more than min_dets dets cut
         nsamps (int): number of samples, default to max in cuts
+    Returns:
+        dets: list of the dets cut somewhere in each common cut
+        ranges: list of [first, last] sample of each common cut (both
+                included, a one sample common cut has first == last)
         """
+    det, start, stop = flatten_cuts(cuts)
+    if len(det) == 0: return [],[]
     # find the maximum sample in cuts if nsamps is not speficied
-    if not nsamps:
-        cuts_ends = [c[-1][-1] for c in cuts if len(c)!=0]
-        if len(cuts_ends) == 0:
-            return [],[]
-        nsamps = np.max([c[-1][-1] for c in cuts if len(c)!=0])
-
-    # make a mask
-    mask = np.zeros(nsamps, dtype=int)
-    for i, c in enumerate(cuts):
-        for dc in c:
-            mask[dc[0]:dc[1]] += 1
+    if not nsamps: nsamps = stop.max()
+    start, stop = np.clip(start, 0, nsamps), np.clip(stop, 0, nsamps)
     # find common cuts enforce min dets
-    t_ = np.where(mask > min_dets)[0]
-    ranges = find_ranges_from_list(t_)
-    dets = [find_dets_with_cut(cuts, r) for r in ranges]
-    return dets, ranges
+    edges, count = sweep_cuts(start, stop)
+    ranges = ranges_from_sweep(edges, count, min_dets+1)
+    if len(ranges) == 0: return [],[]
+    iq, ir = find_overlaps(start, stop, ranges[:,0], ranges[:,1])
+    dets = np.split(det[ir], np.searchsorted(iq, np.arange(1, len(ranges))))
+    dets = [np.unique(d).tolist() for d in dets]
+    return dets, [[r[0], r[1]-1] for r in ranges.tolist()]
+
+def flatten_cuts(cuts):
+    """Flatten a list of cuts (one list of [start, stop) per det) into
+    the arrays det, start and stop of all the cut ranges"""
+    cuts = [np.asarray(c, dtype=int).reshape(-1,2) for c in cuts]
+    det = np.repeat(np.arange(len(cuts)), [len(c) for c in cuts])
+    if len(det) == 0: return det, det.copy(), det.copy()
+    ranges = np.concatenate(cuts, axis=0)
+    return det, ranges[:,0], ranges[:,1]
+
+def sweep_cuts(start, stop):
+    """Sweep over the sorted boundaries of the ranges [start, stop) to
+    count how many of them cover each sample, in O(n log n) for n ranges
+    and independently of the number of samples.
+    Returns:
+        edges: sorted samples where the count changes
+        count: number of ranges covering edges[i]:edges[i+1]
+    """
+    start, stop = np.asarray(start, dtype=int), np.asarray(stop, dtype=int)
+    keep = stop > start
+    pos = np.r_[start[keep], stop[keep]]
+    delta = np.r_[np.ones(keep.sum(), dtype=int), -np.ones(keep.sum(), dtype=int)]
+    if len(pos) == 0: return pos, pos[:0]
+    order = np.argsort(pos, kind='stable')
+    pos, delta = pos[order], delta[order]
+    edges, first = np.unique(pos, return_index=True)
+    count = np.cumsum(np.add.reduceat(delta, first))[:-1]
+    return edges, count
+
+def ranges_from_sweep(edges, count, min_count=1):
+    """Merge the intervals of a sweep (see sweep_cuts) covered at least
+    min_count times into an (n, 2) array of [start, stop) ranges"""
+    sel = np.asarray(count) >= min_count
+    if not np.any(sel): return np.zeros((0,2), dtype=int)
+    # an interval begins a range unless the previous one is selected too
+    first = sel & ~np.r_[False, sel[:-1]]
+    last = sel & ~np.r_[sel[1:], False]
+    return np.stack([edges[:-1][first], edges[1:][last]], axis=1)
+
+def _expand(lo, hi):
+    # (owner, member) pairs of the index intervals lo[i]:hi[i]
+    n = np.maximum(hi - lo, 0)
+    owner = np.repeat(np.arange(len(lo)), n)
+    member = np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n) + np.repeat(lo, n)
+    return owner, member
+
+def find_overlaps(start, stop, qstart, qstop):
+    """Find the pairs of ranges [start, stop) and query ranges
+    [qstart, qstop) that share samples, in O((n+m) log(n+m)) plus the
+    number of pairs. A range overlaps a query either if it starts inside
+    the query or if it covers the start of the query.
+    Returns:
+        iq, ir: index of the query and of the range of every pair, sorted
+                by query then range
+    """
+    start, stop = np.asarray(start, dtype=int), np.asarray(stop, dtype=int)
+    qstart, qstop = np.asarray(qstart, dtype=int), np.asarray(qstop, dtype=int)
+    rkeep = np.where(stop > start)[0]
+    qkeep = np.where(qstop > qstart)[0]
+    ro = rkeep[np.argsort(start[rkeep], kind='stable')]
+    qo = qkeep[np.argsort(qstart[qkeep], kind='stable')]
+    rs, qs = start[ro], qstart[qo]
+    # ranges starting inside each query
+    q1, r1 = _expand(np.searchsorted(rs, qstart[qo], 'left'),
+                     np.searchsorted(rs, qstop[qo], 'left'))
+    # queries starting strictly inside each range
+    r2, q2 = _expand(np.searchsorted(qs, start[ro], 'right'),
+                     np.searchsorted(qs, stop[ro], 'left'))
+    iq = np.r_[qo[q1], qo[q2]]
+    ir = np.r_[ro[r1], ro[r2]]
+    order = np.lexsort((ir, iq))
+    return iq[order], ir[order]
 
 def find_ranges_from_list(lst, min_sep=1):
     """Find ranges in the list, for example, the input
@@ -515,16 +708,9 @@ def find_dets_with_cut(cuts, target_cut):
     Args:
         cuts: cuts for all dets
         target_cut: a cut to find among dets"""
-    dets = []
-    for i,c in enumerate(cuts):
-        if len(c) > 0:
-            for dc in c:
-                start_ = max([dc[0],target_cut[0]])
-                end_ = min([dc[-1],target_cut[-1]])
-                if end_ - start_ > 0:
-                    dets.append(i)
-                    break
-    return dets
+    det, start, stop = flatten_cuts(cuts)
+    _, ir = find_overlaps(start, stop, [target_cut[0]], [target_cut[-1]])
+    return np.unique(det[ir]).tolist()
 
 
 ################
@@ -573,11 +759,12 @@ def quick_cuts_and_cal(data, dt=1):
 
 def cuts_rfft(data, dt=1, use_regular=True):
     """Quick tool to get rfft for tod-like data"""
+    from cutslib.fft import tod_rfft
     if use_regular:
-        nf = tools.nextregular(data.shape[-1])
+        nf = nextregular(data.shape[-1])
     else:
         nf = data.shape[-1]
-    fdata = np.fft.rfft(data, nf)
+    fdata = tod_rfft(data, nf)
     nf = fdata.shape[-1]
     nu = np.arange(nf) / nf / (2*dt)
     return nu, fdata